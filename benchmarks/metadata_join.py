@@ -0,0 +1,102 @@
+"""Benchmark of the metadata join on a synthetic hit table.
+
+Compares the former join (sorted CREATE TABLE AS followed by an UPDATE of the status)
+with add_metadata.merge_in_additional_data, which looks up the metadata once per process id
+for the final_results view.
+
+    python benchmarks/metadata_join.py --sequences 100000 --hits 100
+"""
+
+import argparse, shutil, tempfile, time
+import duckdb
+from pathlib import Path
+from boldigger3 import add_metadata, id_engine
+
+
+def make_hit_table(directory: Path, sequences: int, hits: int) -> tuple:
+    """Function to write a project database and a metadata database with random hits.
+    The hits are saved in random request order, like the id engine writes them.
+    """
+    database_path = directory.joinpath("project.duckdb")
+    metadata_path = directory.joinpath("bold.duckdb")
+
+    with duckdb.connect(database_path) as connection:
+        id_engine.create_results_table(connection)
+        connection.execute(
+            f"""
+            INSERT INTO id_engine_results
+            SELECT 'OTU_' || request.fasta_order, 'Arthropoda', 'Insecta', 'Diptera', 'Culicidae', 'Culex',
+            'Culex ' || (hit % 7), 100 - random() * 20, 'P' || (request.fasta_order * {hits} + hit),
+            'BOLD:AAA0001', '2025-01-01 00:00:00', 1, 3, NULL, request.fasta_order
+            FROM (SELECT range AS fasta_order FROM range({sequences}) ORDER BY hash(range)) AS request,
+            range({hits}) AS hits(hit)
+            """
+        )
+
+    with duckdb.connect(metadata_path) as connection:
+        # two thirds of the hits have public metadata
+        connection.execute(
+            f"""
+            CREATE TABLE bold_public AS
+            SELECT 'P' || range AS processid, 'F' AS sex, 'A' AS life_stage, 'Museum' AS inst,
+            'Germany' AS "country/ocean", 'Someone' AS identified_by, 'Morphology' AS identification_method,
+            '[50.0, 7.0]' AS coord, 'ACGT' AS nuc, 'COI-5P' AS marker_code, 'unused' AS unused
+            FROM range({sequences * hits}) WHERE range % 3 <> 0
+            """
+        )
+
+    return database_path, metadata_path
+
+
+def former_join(database_path: Path, metadata_path: Path) -> None:
+    with duckdb.connect(database_path) as connection:
+        connection.execute(f"ATTACH DATABASE '{metadata_path}' AS metadata")
+        connection.execute(
+            """
+            CREATE TABLE final_results AS
+            SELECT *
+            FROM id_engine_results
+            LEFT JOIN metadata.bold_public
+            ON id_engine_results.process_id = metadata.bold_public.processid
+            ORDER BY id_engine_results.fasta_order ASC, id_engine_results.pct_identity DESC
+            """
+        )
+        connection.execute(
+            """
+            UPDATE final_results
+            SET status = CASE
+                WHEN processid IS NULL THEN 'private'
+                ELSE 'public'
+            END;
+            """
+        )
+
+
+def main(sequences: int, hits: int) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        database_path, metadata_path = make_hit_table(directory, sequences, hits)
+        print(f"{sequences * hits:,} hits, project database {database_path.stat().st_size / 1e6:.0f} MB")
+
+        for name, join in [
+            ("former join", former_join),
+            ("metadata lookup", add_metadata.merge_in_additional_data),
+        ]:
+            run_path = directory.joinpath(f"{name.replace(' ', '_')}.duckdb")
+            shutil.copy(database_path, run_path)
+
+            start = time.perf_counter()
+            join(run_path, metadata_path)
+            elapsed = time.perf_counter() - start
+
+            print(
+                f"{name}: {elapsed:.1f} s, project database {run_path.stat().st_size / 1e6:.0f} MB"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sequences", type=int, default=100_000)
+    parser.add_argument("--hits", type=int, default=100)
+    arguments = parser.parse_args()
+    main(arguments.sequences, arguments.hits)
@@ -3,6 +3,8 @@ from boldigger3 import id_engine
 from boldigger3 import add_metadata
 from boldigger3 import select_top_hit
 from boldigger3 import download_database
+from boldigger3 import batch
+from boldigger3 import pipeline
 from importlib.metadata import version
 
 
@@ -25,9 +27,111 @@ def main() -> None:
     # add the subparsers
     subparsers = parser.add_subparsers(dest="function")
 
+    # options shared by the identification of a single fasta file and the batch mode
+    identification_options = argparse.ArgumentParser(add_help=False)
+
+    # add the database argument
+    identification_options.add_argument(
+        "--db",
+        required=True,
+        nargs="+",
+        help="Integer that defines which database to use (1 to 8). Several databases can be passed. See readme for details",
+        type=int,
+        choices=range(1, 9),
+    )
+
+    # add the operating mode argument
+    identification_options.add_argument(
+        "--mode",
+        required=True,
+        nargs="+",
+        help="Integer that defines which operating mode to use (1 to 3). Several operating modes can be passed. See readme for details.",
+        type=int,
+        choices=range(1, 4),
+    )
+
+    # add the optional argument thresholds
+    identification_options.add_argument(
+        "--thresholds",
+        nargs="+",
+        type=int,
+        help="Thresholds to use for the selection of the top hit.",
+    )
+
+    # add the optional argument for the connection pool size
+    identification_options.add_argument(
+        "--pool_size",
+        default=10,
+        help="Number of pooled connections to the BOLD identification engine.",
+        type=int,
+    )
+
+    # add the optional argument for hedging slow requests
+    identification_options.add_argument(
+        "--hedge",
+        default=None,
+        help="Submit requests a second time once they take longer than this percentile of the observed turnarounds, e.g. 95. Disabled by default.",
+        type=float,
+    )
+
+    # add the optional argument for the largest batches
+    identification_options.add_argument(
+        "--max_batch_factor",
+        default=4.0,
+        help="Largest batches relative to the fixed batch sizes of earlier versions (100, 20 and 10 sequences for operating mode 1, 2 and 3). Defaults to 4.",
+        type=float,
+    )
+
+    # add the optional argument for the top hit engine
+    identification_options.add_argument(
+        "--engine",
+        default="pandas",
+        help="Engine to use for the top hit selection. The pandas engine reads all hits in a single scan, the duckdb engine selects all top hits in a single query.",
+        type=str,
+        choices=["pandas", "duckdb"],
+    )
+
+    # add the optional argument for parallel top hit calculation
+    identification_options.add_argument(
+        "--workers",
+        default=1,
+        help="Number of processes to use for the top hit selection with the pandas engine.",
+        type=int,
+    )
+
+    # add the optional arguments for the shared hit cache
+    identification_options.add_argument(
+        "--cache",
+        default=None,
+        help="Path to a local hit cache that is shared between projects. Cached sequences are not sent to the identification engine again.",
+        type=str,
+    )
+
+    identification_options.add_argument(
+        "--cache_max_age",
+        default=None,
+        help="Maximum age of cached hits in days.",
+        type=int,
+    )
+
+    identification_options.add_argument(
+        "--cache_max_size",
+        default=None,
+        help="Maximum number of sequences in the hit cache, the least recently used ones are evicted first.",
+        type=int,
+    )
+
+    identification_options.add_argument(
+        "--materialize",
+        action="store_true",
+        help="Store the hits with their metadata as a table in the project database, e.g. to open it without BOLDigger3.",
+    )
+
     # add the identify parser
     parser_identify = subparsers.add_parser(
-        "identify", help="Run the BOLD v5 identification engine"
+        "identify",
+        help="Run the BOLD v5 identification engine",
+        parents=[identification_options],
     )
 
     # add the fasta path argument
@@ -41,30 +145,38 @@ def main() -> None:
         "db_path", help="Path to the locally downloaded database.", type=str
     )
 
-    # add the database argument
+    # add the optional argument for processing requests during the download
     parser_identify.add_argument(
-        "--db",
-        required=True,
-        help="Integer that defines which database to use (1 to 8). See readme for details",
-        type=int,
-        choices=range(1, 9),
+        "--pipeline",
+        action="store_true",
+        help="Add the metadata and select the top hits of every request as soon as it is downloaded.",
     )
 
-    # add the operating mode argument
-    parser_identify.add_argument(
-        "--mode",
-        required=True,
-        help="Integer that defines which operating mode to use (1 to 3). See readme for details.",
-        type=int,
-        choices=range(1, 4),
+    # add the batch parser
+    parser_batch = subparsers.add_parser(
+        "batch",
+        help="Run the BOLD v5 identification engine for many fasta files with a single download queue",
+        parents=[identification_options],
     )
 
-    # add the optional argument thresholds
-    parser_identify.add_argument(
-        "--thresholds",
+    # add the fasta files argument
+    parser_batch.add_argument(
+        "fasta_files",
         nargs="+",
-        type=int,
-        help="Thresholds to use for the selection of the top hit.",
+        help="Paths or glob patterns of the fasta files to be identified.",
+        type=str,
+    )
+
+    parser_batch.add_argument(
+        "db_path", help="Path to the locally downloaded database.", type=str
+    )
+
+    # add the optional argument for the directory of the pooled data
+    parser_batch.add_argument(
+        "--batch_dir",
+        default=None,
+        help="Directory to store the pooled sequences and downloads in. Defaults to a boldigger3_batch folder next to the first fasta file.",
+        type=str,
     )
 
     # add the database download parse
@@ -79,6 +191,12 @@ def main() -> None:
         type=str,
     )
 
+    parser_download.add_argument(
+        "--without_sequences",
+        action="store_true",
+        help="Do not store the sequences of the BOLD records, the database is much smaller.",
+    )
+
     # add version control
     # get the installed version
     current_version = version("boldigger3")
@@ -107,8 +225,8 @@ def main() -> None:
     default_thresholds = [97, 95, 90, 85, 75]
     thresholds = []
 
-    # run the identification engine
-    if arguments.function == "identify":
+    # collect the thresholds for the identification of one or many fasta files
+    if arguments.function in ("identify", "batch"):
         for i in range(5):
             try:
                 thresholds.append(arguments.thresholds[i])
@@ -128,23 +246,88 @@ def main() -> None:
                 )
             )
 
+    # run the identification engine
+    if arguments.function == "identify":
+        # every database is identified with every operating mode
+        combinations = id_engine.build_combinations(arguments.db, arguments.mode)
+
+        # metadata and top hits of downloaded requests are processed during the download
+        if arguments.pipeline:
+            result_pipeline = pipeline.ResultPipeline(
+                arguments.fasta_file,
+                arguments.db_path,
+                thresholds,
+                arguments.db,
+                arguments.mode,
+            )
+            result_pipeline.reset()
+        else:
+            result_pipeline = None
+
         # run the id engine
         id_engine.main(
             arguments.fasta_file,
             database=arguments.db,
             operating_mode=arguments.mode,
+            pool_size=arguments.pool_size,
+            hedge_percentile=arguments.hedge,
+            max_batch_factor=arguments.max_batch_factor,
+            cache_path=arguments.cache,
+            cache_max_age=arguments.cache_max_age,
+            cache_max_size=arguments.cache_max_size,
+            pipeline=result_pipeline,
         )
 
-        # add additional data via the metadata
-        add_metadata.main(fasta_path=arguments.fasta_file, db_path=arguments.db_path)
+        if result_pipeline:
+            # only the requests that could not be processed during the download are left
+            result_pipeline.finish(engine=arguments.engine, workers=arguments.workers)
+        else:
+            # add additional data via the metadata
+            add_metadata.main(
+                fasta_path=arguments.fasta_file, db_path=arguments.db_path
+            )
+
+            # select the top hit
+            select_top_hit.main(
+                fasta_path=arguments.fasta_file,
+                thresholds=thresholds,
+                engine=arguments.engine,
+                workers=arguments.workers,
+                combinations=combinations,
+            )
 
-        # select the top hit
-        select_top_hit.main(fasta_path=arguments.fasta_file, thresholds=thresholds)
+        # drop everything that is not needed after the run
+        add_metadata.finish_project(
+            arguments.fasta_file, materialize=arguments.materialize
+        )
+
+    # run the identification engine for many fasta files at once
+    if arguments.function == "batch":
+        batch.main(
+            arguments.fasta_files,
+            arguments.db_path,
+            database=arguments.db,
+            operating_mode=arguments.mode,
+            thresholds=thresholds,
+            batch_dir=arguments.batch_dir,
+            engine=arguments.engine,
+            workers=arguments.workers,
+            materialize=arguments.materialize,
+            pool_size=arguments.pool_size,
+            hedge_percentile=arguments.hedge,
+            max_batch_factor=arguments.max_batch_factor,
+            cache_path=arguments.cache,
+            cache_max_age=arguments.cache_max_age,
+            cache_max_size=arguments.cache_max_size,
+        )
 
     # run the database download
     if arguments.function == "download_db":
         # download and save the database
-        download_database.main(output_dir=arguments.output_dir)
+        download_database.main(
+            output_dir=arguments.output_dir,
+            sequences=not arguments.without_sequences,
+        )
 
 
 # run only if called as a top level script
@@ -2,6 +2,27 @@ import duckdb, importlib, datetime
 from pathlib import Path
 from boldigger3.id_engine import parse_fasta
 
+# columns of the metadata database that are stored in hit_metadata, in the order of the table
+METADATA_COLUMNS = [
+    "processid",
+    "sex",
+    "life_stage",
+    "inst",
+    "country/ocean",
+    "identified_by",
+    "identification_method",
+    "nuc",
+    "marker_code",
+    "coord",
+]
+
+# metadata of every process id that has been looked up, coordinates are split into lat and lon
+HIT_METADATA_SCHEMA = ",\n".join(
+    ["process_id VARCHAR"]
+    + [f'"{column}" VARCHAR' for column in METADATA_COLUMNS if column != "coord"]
+    + ["lat DOUBLE", "lon DOUBLE"]
+)
+
 
 def merge_in_additional_data(id_engine_db: Path, metadata_db: Path) -> None:
     """Function to merge in the additional metadata into the ID engine results
@@ -13,45 +34,275 @@ def merge_in_additional_data(id_engine_db: Path, metadata_db: Path) -> None:
     # connect to both databases
     id_engine_con = duckdb.connect(id_engine_db)
 
-    # attach metadata db to the id engine connection
-    id_engine_con.execute(f"ATTACH DATABASE '{metadata_db}' AS metadata")
+    # attach metadata db to the id engine connection, final_results is created as a view
+    attach_metadata(id_engine_con, metadata_db)
+
+    # only process ids that have been downloaded after the last run are looked up
+    merged = merge_missing_results(id_engine_con)
 
-    # check if the table exists
-    tables = id_engine_con.execute("SHOW TABLES").fetchall()
-    tables = [name[0] for name in tables]
-    if "final_results" in tables:
+    if not merged:
         print(
             f"{datetime.datetime.now().strftime('%H:%M:%S')}: Metadata has already been added in a previous run."
         )
-        id_engine_con.close()
-        return
-
-    # SQL Command definition
-    sql_command = f"""
-    CREATE TABLE IF NOT EXISTS final_results AS
-    SELECT *
-    FROM id_engine_results
-    LEFT JOIN metadata.bold_public
-    ON id_engine_results.process_id = metadata.bold_public.processid
-    ORDER BY id_engine_results.fasta_order ASC, id_engine_results.pct_identity DESC
+
+    id_engine_con.execute("DETACH DATABASE IF EXISTS metadata")
+    id_engine_con.close()
+
+
+def table_type(connection: object, table: str, catalog: str = None) -> str:
+    """Function to find out if a table of the project database is a table or a view.
+
+    Args:
+        connection (object): Connection to the project database.
+        table (str): Name of the table.
+        catalog (str, optional): Attached database of the table. Defaults to None (project database).
+
+    Returns:
+        str: "BASE TABLE", "VIEW" or None if the table does not exist.
     """
+    result = connection.execute(
+        """
+        SELECT table_type FROM information_schema.tables
+        WHERE table_name = ? AND table_catalog = coalesce(?, current_database())
+        AND table_schema = 'main'
+        """,
+        [table, catalog],
+    ).fetchone()
 
-    # perform the action
-    id_engine_con.execute(sql_command)
+    return result[0] if result else None
 
-    # update the status - needed for DB 2
-    update_status = """
-    UPDATE final_results
-    SET status = CASE
-        WHEN processid IS NULL THEN 'private'
-        ELSE 'public'
-    END;
+
+def metadata_expressions(connection: object, catalog: str, table: str) -> str:
+    """Function to select the columns of hit_metadata from a metadata table.
+    Metadata databases of earlier versions store the coordinates as text and the sequences
+    in bold_public, slim databases store lat and lon and the sequences in bold_sequences.
+
+    Args:
+        connection (object): Connection to the project database.
+        catalog (str): Database of the table, e.g. metadata.
+        table (str): Name of the table, e.g. bold_public.
+
+    Returns:
+        str: SQL expressions in the order of HIT_METADATA_SCHEMA, without the process id.
     """
+    columns = {
+        row[0]
+        for row in connection.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_catalog = ? AND table_name = ?",
+            [catalog, table],
+        ).fetchall()
+    }
+    source = f'"{catalog}"."{table}"'
 
-    # Example execution using DuckDB connection 'con':
-    id_engine_con.execute(update_status)
+    expressions = []
 
-    id_engine_con.close()
+    for column in METADATA_COLUMNS:
+        if column == "coord" and "lat" in columns:
+            expressions += [f"{source}.lat", f"{source}.lon"]
+        elif column == "coord":
+            expressions += [
+                f"TRY_CAST({source}.coord AS DOUBLE[])[1] AS lat",
+                f"TRY_CAST({source}.coord AS DOUBLE[])[2] AS lon",
+            ]
+        elif column == "nuc" and "nuc" not in columns:
+            expressions.append(
+                f'"{catalog}".bold_sequences.nuc'
+                if table_type(connection, "bold_sequences", catalog)
+                else "NULL AS nuc"
+            )
+        else:
+            expressions.append(f'CAST({source}."{column}" AS VARCHAR) AS "{column}"')
+
+    return ",\n".join(expressions)
+
+
+def create_final_results(connection: object) -> None:
+    """Function to create final_results as a view of the id engine results and their metadata.
+    The metadata of every process id is stored once in hit_metadata, so the hits are not
+    copied into a second table. Tables of earlier versions are converted, materialized tables
+    are replaced by the view, so new hits show up.
+
+    Args:
+        connection (object): Connection to the project database.
+    """
+    # one row per process id that has been looked up, without metadata if it is private
+    connection.execute(f"CREATE TABLE IF NOT EXISTS hit_metadata ({HIT_METADATA_SCHEMA})")
+
+    if table_type(connection, "final_results") == "BASE TABLE":
+        database_name = connection.execute("SELECT current_database()").fetchone()[0]
+        connection.execute(
+            f"""
+            INSERT INTO hit_metadata
+            SELECT DISTINCT process_id, {metadata_expressions(connection, database_name, "final_results")}
+            FROM final_results
+            WHERE process_id IS NOT NULL
+            AND process_id NOT IN (SELECT process_id FROM hit_metadata)
+            """
+        )
+        connection.execute("DROP TABLE final_results")
+
+    # the status is derived from the join - needed for DB 2, the rowid keeps the order of hits with the same similarity
+    connection.execute(
+        """
+        CREATE OR REPLACE VIEW final_results AS
+        SELECT id_engine_results.* REPLACE (
+            CASE WHEN hit_metadata.processid IS NULL THEN 'private' ELSE 'public' END AS status
+        ),
+        hit_metadata.* EXCLUDE (process_id),
+        id_engine_results.rowid AS hit_order
+        FROM id_engine_results
+        LEFT JOIN hit_metadata
+        ON id_engine_results.process_id = hit_metadata.process_id
+        """
+    )
+
+
+def attach_metadata(connection: object, metadata_db: Path) -> None:
+    """Function to attach the metadata database and create the final_results view if there is none yet.
+
+    Args:
+        connection (object): Connection to the id engine database.
+        metadata_db (Path): Path to the metadata database.
+    """
+    metadata_db = str(metadata_db).replace("'", "''")
+    connection.execute(f"ATTACH IF NOT EXISTS '{metadata_db}' AS metadata")
+
+    if table_type(connection, "final_results") != "VIEW":
+        create_final_results(connection)
+
+
+def merge_batch(connection: object, batch: str) -> int:
+    """Function to look up the metadata of all process ids of a batch of id engine results
+    that have not been looked up before.
+
+    Args:
+        connection (object): Connection to the id engine database with the metadata attached.
+        batch (str): Name of a table or registered relation with the columns of id_engine_results.
+
+    Returns:
+        int: Number of process ids that have been looked up.
+    """
+    # slim metadata databases are sorted by process id, so the lookup only reads the matching blocks
+    sequences = ""
+    if table_type(connection, "bold_sequences", "metadata"):
+        sequences = """
+        LEFT JOIN metadata.bold_sequences
+        ON metadata.bold_public.processid = metadata.bold_sequences.processid
+        AND metadata.bold_public.marker_code IS NOT DISTINCT FROM metadata.bold_sequences.marker_code
+        """
+
+    return connection.execute(
+        f"""
+        INSERT INTO hit_metadata
+        SELECT new_ids.process_id, {metadata_expressions(connection, "metadata", "bold_public")}
+        FROM (
+            SELECT DISTINCT process_id FROM {batch}
+            WHERE process_id IS NOT NULL
+            AND process_id NOT IN (SELECT process_id FROM hit_metadata)
+        ) AS new_ids
+        LEFT JOIN metadata.bold_public
+        ON new_ids.process_id = metadata.bold_public.processid
+        {sequences}
+        """
+    ).fetchone()[0]
+
+
+def merge_missing_results(connection: object) -> int:
+    """Function to merge the metadata into all id engine results that are not in final_results yet,
+    e.g. sequences that have been added to the fasta file or batches that could not be processed
+    while they were downloaded.
+
+    Args:
+        connection (object): Connection to the id engine database with the metadata attached.
+
+    Returns:
+        int: Number of process ids that have been looked up.
+    """
+    return merge_batch(connection, "id_engine_results")
+
+
+def materialize_final_results(id_engine_db: Path) -> None:
+    """Function to store final_results as a table, e.g. to open the project database without BOLDigger3.
+    The next run replaces the table by the view again.
+
+    Args:
+        id_engine_db (Path): Path to the id engine database.
+    """
+    with duckdb.connect(id_engine_db) as connection:
+        if table_type(connection, "final_results") != "VIEW":
+            return
+
+        connection.execute("BEGIN TRANSACTION")
+        connection.execute(
+            """
+            CREATE TABLE materialized_results AS
+            SELECT * FROM final_results
+            ORDER BY fasta_order ASC, pct_identity DESC, hit_order ASC
+            """
+        )
+        connection.execute("DROP VIEW final_results")
+        connection.execute("ALTER TABLE materialized_results RENAME TO final_results")
+        connection.execute("COMMIT")
+
+
+def compact_database(id_engine_db: Path) -> None:
+    """Function to drop the intermediates of a finished run and checkpoint the project database.
+    DuckDB reuses the space of dropped tables but does not give it back, so the database is
+    rewritten if more than half of it is free.
+
+    Args:
+        id_engine_db (Path): Path to the id engine database.
+    """
+    id_engine_db = Path(id_engine_db)
+
+    with duckdb.connect(id_engine_db) as connection:
+        # the journal is only needed to resume unfinished downloads
+        if table_type(connection, "download_journal") and not connection.execute(
+            "SELECT count(*) FROM download_journal WHERE state IN ('waiting', 'submitted', 'late')"
+        ).fetchone()[0]:
+            connection.execute("DROP TABLE download_journal")
+
+        connection.execute("CHECKPOINT")
+        used_blocks, free_blocks = connection.execute(
+            "SELECT used_blocks, free_blocks FROM pragma_database_size()"
+        ).fetchone()
+
+        if free_blocks <= used_blocks:
+            return
+
+        # copying keeps the order of the rows, so the order of the hits does not change
+        compact_path = id_engine_db.with_suffix(".compact.duckdb")
+        compact_path.unlink(missing_ok=True)
+        database_name = connection.execute("SELECT current_database()").fetchone()[0]
+        connection.execute(
+            "ATTACH '{}' AS compact".format(str(compact_path).replace("'", "''"))
+        )
+        connection.execute(f'COPY FROM DATABASE "{database_name}" TO compact')
+        connection.execute("DETACH compact")
+
+    compact_path.replace(id_engine_db)
+
+
+def finish_project(fasta_path: str, materialize: bool = False) -> None:
+    """Function to compact the project database once the run has finished.
+
+    Args:
+        fasta_path (str): Path to the fasta file that was identified.
+        materialize (bool, optional): Store final_results as a table. Defaults to False.
+    """
+    fasta_path = Path(fasta_path)
+    id_engine_db_path = fasta_path.parent.joinpath(
+        "boldigger3_data", f"{fasta_path.stem}.duckdb"
+    )
+
+    print(
+        f"{datetime.datetime.now().strftime('%H:%M:%S')}: Compacting the project database."
+    )
+
+    if materialize:
+        materialize_final_results(id_engine_db_path)
+
+    compact_database(id_engine_db_path)
 
 
 def main(fasta_path: str, db_path: str) -> None:
@@ -0,0 +1,270 @@
+import datetime, duckdb, glob, filecmp, sys, contextlib
+import pandas as pd
+from pathlib import Path
+from tqdm import tqdm
+from boldigger3 import id_engine, add_metadata, select_top_hit
+from boldigger3.id_engine import parse_fasta, create_results_table
+
+
+def expand_fasta_paths(fasta_files: list) -> list:
+    """Function to expand the fasta files and glob patterns passed to the batch mode.
+
+    Args:
+        fasta_files (list): Paths or glob patterns of the fasta files.
+
+    Returns:
+        list: Unique paths of all fasta files in the given order.
+    """
+    fasta_paths = []
+
+    for fasta_file in fasta_files:
+        matches = sorted(glob.glob(fasta_file)) if glob.has_magic(fasta_file) else []
+        fasta_paths += [Path(match) for match in matches] or [Path(fasta_file)]
+
+    # the same file may be matched by several patterns
+    fasta_paths = list(dict.fromkeys(fasta_paths))
+
+    missing = [fasta_path for fasta_path in fasta_paths if not fasta_path.is_file()]
+    if missing:
+        for fasta_path in missing:
+            print(
+                f"{datetime.datetime.now().strftime('%H:%M:%S')}: Fasta file {fasta_path} does not exist."
+            )
+        sys.exit()
+
+    return fasta_paths
+
+
+def pooled_id(seq_hash: int) -> str:
+    """Function to generate the id of a sequence in the pooled fasta file from its hash."""
+    return f"seq_{int(seq_hash):016x}"
+
+
+def write_pooled_fasta(fasta_indices: list, pooled_path: Path) -> int:
+    """Function to write every unique sequence of all fasta files to a single fasta file.
+    The ids are derived from the sequence hash, so they are stable between runs and
+    downloads of a previous run can be resumed. The file is only replaced if its content
+    has changed, so the index of the pooled file is not rebuilt without need.
+
+    Args:
+        fasta_indices (list): Indices of all fasta files of the batch.
+        pooled_path (Path): Path of the pooled fasta file.
+
+    Raises:
+        ValueError: If two different sequences share the same hash.
+
+    Returns:
+        int: Number of unique sequences in the pooled fasta file.
+    """
+    pooled_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = pooled_path.with_suffix(".tmp")
+    seen_hashes = {}
+
+    try:
+        with open(temporary_path, "w") as pooled_file:
+            for fasta_index in fasta_indices:
+                for position in fasta_index.unique_ids().values():
+                    seq_hash = int(fasta_index.records[position]["seq_hash"])
+                    if seq_hash in seen_hashes:
+                        # the pooled id is derived from the hash, so a collision cannot be pooled
+                        seen_index, seen_position = seen_hashes[seq_hash]
+                        if (
+                            seen_index.sequence(seen_position).upper()
+                            != fasta_index.sequence(position).upper()
+                        ):
+                            raise ValueError(
+                                f"Sequence {fasta_index.ids[position]} shares its hash with another sequence and cannot be pooled."
+                            )
+                        continue
+                    seen_hashes[seq_hash] = (fasta_index, position)
+                    pooled_file.write(
+                        f">{pooled_id(seq_hash)}\n{fasta_index.sequence(position)}\n"
+                    )
+    except ValueError:
+        temporary_path.unlink()
+        raise
+
+    if pooled_path.is_file() and filecmp.cmp(temporary_path, pooled_path, shallow=False):
+        temporary_path.unlink()
+    else:
+        temporary_path.replace(pooled_path)
+
+    return len(seen_hashes)
+
+
+def demultiplex(fasta_index, database_path: Path, pooled_database_path: Path) -> None:
+    """Function to copy the results of the pooled project into the project of a single fasta file.
+    The hits of every unique sequence of the file are copied with its own id and fasta order,
+    so the project looks as if it has been identified on its own. Results of every database
+    and operating mode in the pooled project replace the results of the same combination.
+
+    Args:
+        fasta_index (FastaIndex): Index of the fasta file.
+        database_path (Path): Path to the project database of the fasta file.
+        pooled_database_path (Path): Path to the project database of the pooled fasta file.
+    """
+    unique_ids = fasta_index.unique_ids()
+    positions = list(unique_ids.values())
+    seq_hashes = fasta_index.records["seq_hash"][positions]
+    members = pd.DataFrame(
+        {
+            "id": list(unique_ids),
+            "fasta_order": positions,
+            "seq_hash": seq_hashes,
+            "pooled_id": [pooled_id(seq_hash) for seq_hash in seq_hashes],
+        }
+    )
+
+    connection = duckdb.connect(database_path)
+    create_results_table(connection)
+    pooled_path = str(pooled_database_path).replace("'", "''")
+    connection.execute(f"ATTACH DATABASE '{pooled_path}' AS pooled (READ_ONLY)")
+
+    try:
+        connection.register("members", members)
+        combinations = connection.execute(
+            "SELECT DISTINCT database, operating_mode FROM pooled.id_engine_completed ORDER BY ALL"
+        ).fetchall()
+        pooled_tables = [
+            row[0]
+            for row in connection.execute(
+                "SELECT table_name FROM information_schema.tables WHERE table_catalog = 'pooled'"
+            ).fetchall()
+        ]
+
+        # the metadata of the pooled hits is copied with them, final_results is a view of both
+        if "hit_metadata" in pooled_tables:
+            add_metadata.create_final_results(connection)
+
+        # the pooled hits are copied in fasta order of the file, ties keep their order
+        connection.execute("BEGIN TRANSACTION")
+        for combination in combinations:
+            connection.execute(
+                "DELETE FROM id_engine_results WHERE database = ? AND operating_mode = ?",
+                list(combination),
+            )
+            connection.execute(
+                """
+                INSERT INTO id_engine_results
+                SELECT hits.* REPLACE (members.id AS id, members.fasta_order AS fasta_order)
+                FROM pooled.id_engine_results AS hits
+                JOIN members ON members.pooled_id = hits.id
+                WHERE hits.database = ? AND hits.operating_mode = ?
+                ORDER BY members.fasta_order, hits.rowid
+                """,
+                list(combination),
+            )
+            connection.execute(
+                "DELETE FROM id_engine_completed WHERE database = ? AND operating_mode = ?",
+                list(combination),
+            )
+            connection.execute(
+                """
+                INSERT INTO id_engine_completed
+                SELECT members.id, completed.database, completed.operating_mode,
+                members.fasta_order, members.seq_hash
+                FROM pooled.id_engine_completed AS completed
+                JOIN members ON members.pooled_id = completed.id
+                WHERE completed.database = ? AND completed.operating_mode = ?
+                """,
+                list(combination),
+            )
+        if "hit_metadata" in pooled_tables:
+            connection.execute(
+                """
+                INSERT INTO hit_metadata
+                SELECT * FROM pooled.hit_metadata
+                WHERE process_id IN (SELECT process_id FROM id_engine_results)
+                AND process_id NOT IN (SELECT process_id FROM hit_metadata)
+                """
+            )
+        connection.execute("COMMIT")
+    finally:
+        connection.execute("DETACH DATABASE IF EXISTS pooled")
+        connection.close()
+
+
+def main(
+    fasta_files: list,
+    db_path: str,
+    database,
+    operating_mode,
+    thresholds: list,
+    batch_dir: str = None,
+    batch_name: str = "boldigger3_batch",
+    engine: str = "pandas",
+    workers: int = 1,
+    materialize: bool = False,
+    **id_engine_options,
+) -> None:
+    """Main function to identify many fasta files in one run.
+    All sequences are pooled into a single deduplicated download queue, the metadata is
+    added once and the results are demultiplexed back to the projects of the single files.
+
+    Args:
+        fasta_files (list): Paths or glob patterns of the fasta files.
+        db_path (str): Path to the locally downloaded BOLD database (.ddb file).
+        database (int | list): The database or databases to use, see readme for details.
+        operating_mode (int | list): The operating mode or modes to use, see readme for details.
+        thresholds (list): Thresholds for the top hit selection.
+        batch_dir (str, optional): Directory of the pooled project. Defaults to None (next to the first fasta file).
+        batch_name (str, optional): Name of the pooled fasta file. Defaults to "boldigger3_batch".
+        engine (str, optional): Engine to use for the top hit selection. Defaults to "pandas".
+        workers (int, optional): Number of processes for the top hit selection. Defaults to 1.
+        materialize (bool, optional): Store final_results of every file as a table. Defaults to False.
+        **id_engine_options: Further arguments for the id engine, e.g. the pool size or the hit cache.
+    """
+    fasta_paths = expand_fasta_paths(fasta_files)
+
+    tqdm.write(
+        f"{datetime.datetime.now().strftime('%H:%M:%S')}: Reading {len(fasta_paths)} fasta files."
+    )
+    # the fasta files are closed once the run ends
+    with contextlib.ExitStack() as stack:
+        fasta_indices = [
+            stack.enter_context(parse_fasta(fasta_path)[0]) for fasta_path in fasta_paths
+        ]
+
+        # the pooled project lives in its own directory, so it does not clash with the inputs
+        batch_dir = (
+            Path(batch_dir) if batch_dir else fasta_paths[0].parent.joinpath(batch_name)
+        )
+        pooled_path = batch_dir.joinpath(f"{batch_name}.fasta")
+        unique_sequences = write_pooled_fasta(fasta_indices, pooled_path)
+
+        tqdm.write(
+            "{}: Pooled {} sequences into {} unique sequences.".format(
+                datetime.datetime.now().strftime("%H:%M:%S"),
+                sum(len(fasta_index) for fasta_index in fasta_indices), unique_sequences
+            )
+        )
+
+        # all files share one download queue and one metadata join
+        id_engine.main(pooled_path, database, operating_mode, **id_engine_options)
+        add_metadata.main(fasta_path=pooled_path, db_path=db_path)
+
+        combinations = id_engine.build_combinations(database, operating_mode)
+        pooled_database_path = batch_dir.joinpath(
+            "boldigger3_data", f"{batch_name}.duckdb"
+        )
+
+        for fasta_path, fasta_index in zip(fasta_paths, fasta_indices):
+            tqdm.write(
+                f"{datetime.datetime.now().strftime('%H:%M:%S')}: Writing the results of {fasta_path.name}."
+            )
+
+            demultiplex(
+                fasta_index,
+                fasta_path.parent.joinpath("boldigger3_data", f"{fasta_path.stem}.duckdb"),
+                pooled_database_path,
+            )
+            select_top_hit.main(
+                fasta_path=fasta_path,
+                thresholds=thresholds,
+                engine=engine,
+                workers=workers,
+                combinations=combinations,
+            )
+            add_metadata.finish_project(fasta_path, materialize=materialize)
+
+        add_metadata.finish_project(pooled_path)
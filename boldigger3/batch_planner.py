@@ -0,0 +1,321 @@
+import json, math, statistics, threading
+from collections import deque
+from pathlib import Path
+
+# the learned batch sizes are shared by all projects of a user
+BATCH_STATE_PATH = Path.home().joinpath(".boldigger3", "batch_planner.json")
+
+# fixed batch sizes of earlier versions per identity threshold of the operating mode,
+# batches start from them until something has been learned
+BASE_BATCH_SIZES = {0.94: 100, 0.9: 20, 0.75: 10}
+
+# batches are never planned smaller than this, single failing batches are still bisected
+MIN_BATCH_SIZES = {0.94: 10, 0.9: 2, 0.75: 1}
+
+
+class BatchPlanner:
+    """A class to size the batches that are submitted to the BOLD id engine.
+
+    Batches are limited by the number of sequences and by their total length in base
+    pairs. They start from the fixed sizes of earlier versions and may grow up to a
+    multiple of them, since the id engine does not document a largest batch. Small queues
+    are split into enough batches to be submitted side by side. The target turnaround is a multiple of the median turnaround of the recent
+    batches, since the id engine often takes much longer than a few minutes. The number of
+    sequences grows by a factor with every batch that finishes within the target and is
+    only cut if batches time out or fail, or if several batches in a row are slower than
+    the target. A single slow batch is left to the rate controller, which reacts to the
+    same latencies. The base pair limit is the number of base pairs that fits into the
+    target turnaround at the measured turnaround per base pair, so a batch of long
+    sequences is cut before it takes much longer than the recent batches. All values are learned per
+    identity threshold of the operating mode and persisted, so the next run starts where
+    the last one stopped.
+
+    Attributes
+    ----------
+    batch_sizes (dict): Current number of sequences per batch for every identity threshold.
+    max_batch_sizes (dict): Largest number of sequences per batch for every identity threshold.
+    queue_limits (dict): Number of sequences per batch that splits the queue into enough batches.
+    seconds_per_bp (dict): Smoothed turnaround per base pair for every identity threshold.
+    turnarounds (dict): Recent turnarounds for every identity threshold.
+    """
+
+    def __init__(
+        self,
+        state_path: Path = None,
+        target_factor: float = 2.0,
+        growth_factor: float = 1.25,
+        decrease_factor: float = 0.5,
+        smoothing: float = 0.3,
+        min_samples: int = 5,
+        slow_batches: int = 3,
+        history: int = 50,
+        max_batch_factor: float = 4.0,
+        min_batches: int = 10,
+    ):
+        """Constructs the neccessary attributes for the BatchPlanner object
+
+        Args:
+            state_path (Path, optional): File to persist the learned values to. Defaults to None (not persisted).
+            target_factor (float, optional): Target turnaround relative to the median of the recent turnarounds. Defaults to 2.0.
+            growth_factor (float, optional): Multiplicative increase per batch that finished in time. Defaults to 1.25.
+            decrease_factor (float, optional): Multiplicative decrease per failed batch or series of slow batches. Defaults to 0.5.
+            smoothing (float, optional): Weight of the latest batch in the turnaround per base pair. Defaults to 0.3.
+            min_samples (int, optional): Number of turnarounds that is needed before the target is used. Defaults to 5.
+            slow_batches (int, optional): Number of slow batches in a row that shrink the batches. Defaults to 3.
+            history (int, optional): Number of recent turnarounds the target is computed from. Defaults to 50.
+            max_batch_factor (float, optional): Largest batches relative to the fixed sizes of earlier versions. Defaults to 4.0.
+            min_batches (int, optional): Number of batches a queue is at least split into, like the initial submission window. Defaults to 10.
+        """
+        self.state_path = state_path
+        self.target_factor = target_factor
+        self.growth_factor = growth_factor
+        self.decrease_factor = decrease_factor
+        self.smoothing = smoothing
+        self.min_samples = min_samples
+        self.slow_batches = slow_batches
+        self.min_batches = min_batches
+        self.batch_sizes = dict(BASE_BATCH_SIZES)
+        self.max_batch_sizes = {
+            identity: max(int(size * max_batch_factor), MIN_BATCH_SIZES[identity])
+            for identity, size in BASE_BATCH_SIZES.items()
+        }
+        self.queue_limits = {}
+        self.seconds_per_bp = {}
+        self.turnarounds = {
+            identity: deque(maxlen=history) for identity in BASE_BATCH_SIZES
+        }
+        self.slow_streaks = dict.fromkeys(BASE_BATCH_SIZES, 0)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, state_path: Path, **kwargs) -> "BatchPlanner":
+        """Function to create a batch planner from a previously persisted state.
+
+        Args:
+            state_path (Path): File the learned values have been persisted to.
+
+        Returns:
+            BatchPlanner: Planner starting from the persisted values or the defaults.
+        """
+        planner = cls(state_path=state_path, **kwargs)
+
+        try:
+            with open(state_path, "r") as state_file:
+                state = json.load(state_file)
+            for identity, values in state.items():
+                identity = float(identity)
+                if identity not in BASE_BATCH_SIZES:
+                    continue
+                planner.batch_sizes[identity] = planner.clamp_size(
+                    identity, float(values["batch_size"])
+                )
+                if values.get("seconds_per_bp"):
+                    planner.seconds_per_bp[identity] = float(values["seconds_per_bp"])
+                planner.turnarounds[identity].extend(
+                    float(turnaround) for turnaround in values.get("turnarounds", [])
+                )
+        except (
+            FileNotFoundError,
+            json.JSONDecodeError,
+            AttributeError,
+            KeyError,
+            TypeError,
+            ValueError,
+        ):
+            # start with the defaults if nothing has been learned yet
+            pass
+
+        return planner
+
+    def save(self) -> None:
+        """Function to persist the learned values."""
+        if self.state_path is None:
+            return
+
+        with self.lock:
+            state = {
+                str(identity): {
+                    "batch_size": batch_size,
+                    "seconds_per_bp": self.seconds_per_bp.get(identity),
+                    "turnarounds": list(self.turnarounds[identity]),
+                }
+                for identity, batch_size in self.batch_sizes.items()
+            }
+
+        Path(self.state_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(self.state_path, "w") as state_file:
+            json.dump(state, state_file)
+
+    def clamp_size(self, identity: float, batch_size: float) -> float:
+        return min(
+            max(batch_size, MIN_BATCH_SIZES[identity]), self.max_batch_sizes[identity]
+        )
+
+    def limit_to_queue(self, identity: float, sequences: int) -> None:
+        """Function to limit the batches by the number of queued sequences.
+        A small file is split into several batches that run side by side instead of a
+        single batch that keeps the other slots idle.
+
+        Args:
+            identity (float): Identity threshold of the operating mode.
+            sequences (int): Number of sequences that are queued for the identity threshold.
+        """
+        with self.lock:
+            self.queue_limits[identity] = max(
+                math.ceil(sequences / self.min_batches), MIN_BATCH_SIZES[identity]
+            )
+
+    def target_turnaround(self, identity: float) -> float:
+        """Function to compute the target turnaround from the recent turnarounds, call with the lock held.
+
+        Args:
+            identity (float): Identity threshold of the operating mode.
+
+        Returns:
+            float: Target turnaround in seconds, None if too few turnarounds have been measured yet.
+        """
+        if len(self.turnarounds[identity]) < self.min_samples:
+            return None
+
+        return self.target_factor * statistics.median(self.turnarounds[identity])
+
+    def limits(self, identity: float) -> tuple:
+        """Function to return the current limits of a batch.
+
+        Args:
+            identity (float): Identity threshold of the operating mode.
+
+        Returns:
+            tuple: Maximum number of sequences and maximum number of base pairs, None if no turnaround has been measured yet.
+        """
+        with self.lock:
+            max_sequences = int(
+                min(
+                    self.batch_sizes[identity],
+                    self.queue_limits.get(identity, math.inf),
+                )
+            )
+            seconds_per_bp = self.seconds_per_bp.get(identity)
+            target_turnaround = self.target_turnaround(identity)
+
+        max_base_pairs = (
+            target_turnaround / seconds_per_bp
+            if seconds_per_bp and target_turnaround
+            else None
+        )
+
+        return max_sequences, max_base_pairs
+
+    def take(self, lengths: list, identity: float) -> int:
+        """Function to compute how many of the next sequences form the next batch.
+
+        Args:
+            lengths (list): Lengths of the next sequences in base pairs.
+            identity (float): Identity threshold of the operating mode.
+
+        Returns:
+            int: Number of sequences in the next batch, at least one.
+        """
+        max_sequences, max_base_pairs = self.limits(identity)
+        base_pairs = 0
+
+        for count, length in enumerate(lengths[:max_sequences]):
+            base_pairs += length
+            # a single sequence is always sent, even if it exceeds the limit
+            if max_base_pairs is not None and base_pairs > max_base_pairs and count:
+                return count
+
+        return min(len(lengths), max_sequences)
+
+    def plan(self, seq_ids: list, lengths: list, identity: float) -> list:
+        """Function to split sequences into batches with the current limits.
+
+        Args:
+            seq_ids (list): Ids of the sequences.
+            lengths (list): Lengths of the sequences in base pairs.
+            identity (float): Identity threshold of the operating mode.
+
+        Returns:
+            list: Lists of sequence ids, one per batch.
+        """
+        batches, start = [], 0
+
+        while start < len(seq_ids):
+            end = start + self.take(
+                lengths[start : start + self.max_batch_sizes[identity]], identity
+            )
+            batches.append(seq_ids[start:end])
+            start = end
+
+        return batches
+
+    def on_completed(self, identity: float, base_pairs: int, turnaround: float) -> None:
+        """Function to adapt the batch limits to the turnaround of a completed batch.
+
+        Args:
+            identity (float): Identity threshold of the operating mode.
+            base_pairs (int): Total length of the batch in base pairs.
+            turnaround (float): Seconds between submission and availability of the result.
+        """
+        with self.lock:
+            if base_pairs:
+                seconds_per_bp = turnaround / base_pairs
+                previous = self.seconds_per_bp.get(identity)
+                self.seconds_per_bp[identity] = (
+                    seconds_per_bp
+                    if previous is None
+                    else self.smoothing * seconds_per_bp
+                    + (1 - self.smoothing) * previous
+                )
+
+            # the batch is compared to the target of the batches before it
+            target_turnaround = self.target_turnaround(identity)
+            self.turnarounds[identity].append(turnaround)
+
+            # grow while the server keeps up, shrink only if it stays too slow
+            if target_turnaround is None or turnaround <= target_turnaround:
+                self.slow_streaks[identity] = 0
+                factor = self.growth_factor
+            else:
+                self.slow_streaks[identity] += 1
+                if self.slow_streaks[identity] < self.slow_batches:
+                    return
+                self.slow_streaks[identity] = 0
+                factor = self.decrease_factor
+
+            self.batch_sizes[identity] = self.clamp_size(
+                identity, self.batch_sizes[identity] * factor
+            )
+
+    def on_failed(self, identity: float, batch_size: int = None) -> None:
+        """Function to shrink the batches after a batch timed out or failed.
+
+        Args:
+            identity (float): Identity threshold of the operating mode.
+            batch_size (int, optional): Number of sequences in the failed batch. Defaults to None.
+        """
+        with self.lock:
+            # never go back to the size of the failed batch
+            current_size = min(
+                self.batch_sizes[identity], batch_size or self.batch_sizes[identity]
+            )
+            self.batch_sizes[identity] = self.clamp_size(
+                identity, current_size * self.decrease_factor
+            )
+
+    @staticmethod
+    def split(seq_ids: list) -> list:
+        """Function to bisect a failed batch.
+
+        Args:
+            seq_ids (list): Ids of the sequences in the batch.
+
+        Returns:
+            list: Two halves of the batch, or the batch itself if it holds a single sequence.
+        """
+        if len(seq_ids) < 2:
+            return [list(seq_ids)]
+
+        middle = len(seq_ids) // 2
+
+        return [list(seq_ids[:middle]), list(seq_ids[middle:])]
@@ -1,17 +1,21 @@
 import datetime, sys, getpass, requests_html, duckdb
 from pathlib import Path
-from tqdm import tqdm
-import urllib.request
+from requests.exceptions import RequestException
+from boldigger3.exceptions import PackageDownloadError
+from boldigger3.package_download import PackageDownload
 import math
 
+BOLD_URL = "https://bench.boldsystems.org"
 
-class DownloadProgressBar(tqdm):
-    """tqdm subclass that integrates with urllib.request.urlretrieve's reporthook."""
-
-    def update_to(self, b=1, bsize=1, tsize=None):
-        if tsize is not None:
-            self.total = tsize
-        self.update(b * bsize - self.n)
+# low cardinality columns of the metadata database, stored as enums
+ENUM_COLUMNS = [
+    "sex",
+    "life_stage",
+    "inst",
+    "country/ocean",
+    "identification_method",
+    "marker_code",
+]
 
 
 def login() -> requests_html.HTMLSession:
@@ -37,9 +41,9 @@ def login() -> requests_html.HTMLSession:
     }
 
     session = requests_html.HTMLSession()
-    session.post("https://bench.boldsystems.org/index.php/Login", data=data)
+    session.post(f"{BOLD_URL}/index.php/Login", data=data)
 
-    r = session.get("https://bench.boldsystems.org/index.php/datapackages/Latest")
+    r = session.get(f"{BOLD_URL}/index.php/datapackages/Latest")
     log_out_text = r.html.find(".site-navigation > li:nth-child(4) > a:nth-child(1)")[
         0
     ].text
@@ -71,7 +75,7 @@ def check_db_status(
     Returns:
         Tuple of (up_to_date, data_url, package_id).
     """
-    r = session.get("https://bench.boldsystems.org/index.php/datapackages/Latest")
+    r = session.get(f"{BOLD_URL}/index.php/datapackages/Latest")
     r = r.html.find(
         "div.row:nth-child(5) > div:nth-child(1) > table:nth-child(3) > tbody:nth-child(1) > tr:nth-child(4) > td:nth-child(2) > button:nth-child(1)"
     )
@@ -90,46 +94,115 @@ def check_db_status(
         return False, data_url, package_id
 
 
+def build_database(parquet_path: Path, ddb_path: Path, sequences: bool = True) -> None:
+    """Build the metadata database from the BOLD data package.
+
+    The metadata is sorted by process id, so lookups of a few process ids only read the
+    matching blocks. Low cardinality columns are stored as enums and the coordinates are
+    split into lat and lon. The large sequence column is stored in its own table.
+
+    Args:
+        parquet_path: Path to the parquet file of the data package.
+        ddb_path: Path of the database to create.
+        sequences: Store the sequences of the records in bold_sequences. Defaults to True.
+    """
+    source = "read_parquet('{}')".format(str(parquet_path).replace("'", "''"))
+
+    with duckdb.connect(ddb_path) as con:
+        for column in ENUM_COLUMNS:
+            con.execute(f"""
+                        CREATE TYPE "{column}_values" AS ENUM (
+                            SELECT DISTINCT CAST("{column}" AS VARCHAR) FROM {source}
+                            WHERE "{column}" IS NOT NULL ORDER BY ALL
+                        )
+                        """)
+
+        enum_columns = {
+            column: f'CAST(CAST("{column}" AS VARCHAR) AS "{column}_values") AS "{column}"'
+            for column in ENUM_COLUMNS
+        }
+
+        con.execute(f"""
+                    CREATE TABLE bold_public
+                    AS SELECT
+                        processid,
+                        {enum_columns["sex"]},
+                        {enum_columns["life_stage"]},
+                        {enum_columns["inst"]},
+                        {enum_columns["country/ocean"]},
+                        identified_by,
+                        {enum_columns["identification_method"]},
+                        {enum_columns["marker_code"]},
+                        TRY_CAST(coord AS DOUBLE[])[1] AS lat,
+                        TRY_CAST(coord AS DOUBLE[])[2] AS lon
+                    FROM {source}
+                    ORDER BY processid
+                    """)
+
+        if sequences:
+            con.execute(f"""
+                        CREATE TABLE bold_sequences
+                        AS SELECT
+                            processid,
+                            {enum_columns["marker_code"]},
+                            nuc
+                        FROM {source}
+                        ORDER BY processid
+                        """)
+
+
+def fetch_download_url(session: requests_html.HTMLSession, data_url: str) -> str:
+    """Fetch a one-time UID from the BOLD API and build the download URL with it.
+
+    Args:
+        session: Authenticated requests_html.HTMLSession.
+        data_url: Relative download URL obtained from check_db_status.
+
+    Returns:
+        The download URL of the package.
+    """
+    uid = session.get(f"{BOLD_URL}{data_url}")
+    uid = uid.text.replace('"', "")
+
+    return f"{BOLD_URL}{data_url}&uid={uid}"
+
+
 def download_and_save_database(
     output_dir: Path,
     session: requests_html.HTMLSession,
     data_url: str,
     package_id: str,
+    sequences: bool = True,
+    parts: int = 4,
 ) -> None:
     """Download the latest BOLD public database and convert it to DuckDB format.
 
-    Fetches a one-time UID from the BOLD API, downloads the Parquet file with a
-    progress bar, builds a DuckDB table from it, and removes the Parquet file
-    afterwards. Any outdated .ddb file is deleted before writing the new one.
+    Fetches a one-time UID from the BOLD API for every refused request, downloads the
+    Parquet file in parallel byte ranges, builds a DuckDB table from it, and removes the Parquet file
+    afterwards. An interrupted download is continued in the next run. Any outdated
+    .ddb file is deleted before writing the new one.
 
     Args:
         output_dir: Directory to save the database to.
         session: Authenticated requests_html.HTMLSession.
         data_url: Relative download URL obtained from check_db_status.
         package_id: Package identifier used to name the output files.
+        sequences: Store the sequences of the records. Defaults to True.
+        parts: Number of byte ranges downloaded at the same time. Defaults to 4.
     """
-    uid = session.get(f"https://bench.boldsystems.org{data_url}")
-    uid = uid.text.replace('"', "")
-    download_url = f"https://bench.boldsystems.org{data_url}&uid={uid}"
-
     download_filename = output_dir.joinpath(f"{package_id}.parquet")
 
-    with session.get(download_url, stream=True) as r:
-        r.raise_for_status()
-        total = int(r.headers.get("content-length", 0))
-
-        with DownloadProgressBar(
-            total=total,
-            unit="B",
-            unit_scale=True,
-            miniters=1,
-            desc="Downloading public database",
-        ) as t:
-            with open(download_filename, "wb") as f:
-                for chunk in r.iter_content(chunk_size=1024 * 1024):
-                    if chunk:
-                        f.write(chunk)
-                        t.update(len(chunk))
+    # the parts of an interrupted download are kept and continued in the next run
+    try:
+        PackageDownload(session, download_filename, parts=parts).run(
+            lambda: fetch_download_url(session, data_url)
+        )
+    except (PackageDownloadError, RequestException) as error:
+        print(f"{datetime.datetime.now():%H:%M:%S}: Download failed: {error}")
+        print(
+            f"{datetime.datetime.now():%H:%M:%S}: Please run the download again, it continues where it stopped."
+        )
+        sys.exit()
 
     ddb_output_path = output_dir.joinpath(f"{package_id}.ddb")
 
@@ -141,22 +214,7 @@ def download_and_save_database(
 
     print(f"{datetime.datetime.now():%H:%M:%S}: Building new database.")
 
-    with duckdb.connect(ddb_output_path) as con:
-        con.execute(f"""
-                    CREATE TABLE bold_public
-                    AS SELECT
-                        processid,
-                        sex,
-                        life_stage,
-                        inst,
-                        "country/ocean",
-                        identified_by,
-                        identification_method,
-                        coord,
-                        nuc,
-                        marker_code
-                    FROM read_parquet('{download_filename}')
-                    """)
+    build_database(download_filename, ddb_output_path, sequences=sequences)
 
     print(
         f"{datetime.datetime.now():%H:%M:%S}: New database saved at {ddb_output_path}."
@@ -166,7 +224,7 @@ def download_and_save_database(
         download_filename.unlink()
 
 
-def main(output_dir: str) -> None:
+def main(output_dir: str, sequences: bool = True) -> None:
     """Main function to download the BOLD public database via BOLDigger3."""
     print(f"{datetime.datetime.now():%H:%M:%S}: Welcome to BOLDigger3.")
     print(f"{datetime.datetime.now():%H:%M:%S}: This is the database download module.")
@@ -195,6 +253,7 @@ def main(output_dir: str) -> None:
                 session=session,
                 data_url=data_url,
                 package_id=package_id,
+                sequences=sequences,
             )
         else:
             return None
@@ -0,0 +1,233 @@
+import duckdb, threading
+import pandas as pd
+from pathlib import Path
+
+
+class DownloadJournal:
+    """A class to persist the state of the download queue in the project database.
+
+    Every request is a single row in the download_journal table that moves from waiting
+    to submitted (with its result url) to downloaded. Submitted requests that time out
+    are marked as late, batches that are merged or split are replaced by new waiting
+    requests. Requests only reference the ids of their sequences, the sequences themselves
+    are read from the fasta index again when a request is resumed. The hashes of the
+    sequences are stored with them, so requests of sequences that have been edited since
+    can be recognized. Every state transition is one small update, so the journal never
+    has to be rewritten as a whole.
+
+    Attributes
+    ----------
+    database_path (Path): Path to the project database.
+    connection (object): Connection to the project database used for the journal.
+    """
+
+    def __init__(self, database_path: Path):
+        self.database_path = database_path
+        self.connection = duckdb.connect(database_path)
+        # the scheduler updates the journal from worker threads
+        self.lock = threading.Lock()
+
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS download_journal (
+                request_id BIGINT PRIMARY KEY,
+                state VARCHAR,
+                seq_ids VARCHAR[],
+                database BIGINT,
+                operating_mode BIGINT,
+                result_url VARCHAR,
+                submitted_at TIMESTAMP,
+                seq_hashes UBIGINT[]
+            )
+            """
+        )
+        # journals of earlier versions did not store the hashes
+        self.connection.execute(
+            "ALTER TABLE download_journal ADD COLUMN IF NOT EXISTS seq_hashes UBIGINT[]"
+        )
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> "DownloadJournal":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def has_open_requests(self) -> bool:
+        """Function to check if a previous run left unfinished requests.
+
+        Returns:
+            bool: True if any request is waiting, submitted or late.
+        """
+        with self.lock:
+            open_requests = self.connection.execute(
+                "SELECT count(*) FROM download_journal WHERE state IN ('waiting', 'submitted', 'late')"
+            ).fetchone()[0]
+
+        return open_requests > 0
+
+    def replace(self, download_queue: dict) -> None:
+        """Function to replace the journal with a new download queue.
+
+        Args:
+            download_queue (dict): Download queue with waiting and optionally active or late requests.
+        """
+        # active requests are stored as submitted, with their result url
+        queued = [
+            (request_id, state, bold_request)
+            for queue, state in (
+                ("waiting", "waiting"),
+                ("active", "submitted"),
+                ("late", "late"),
+            )
+            for request_id, bold_request in download_queue.get(queue, {}).items()
+        ]
+        requests = pd.DataFrame(
+            {
+                "request_id": pd.Series(
+                    [request_id for request_id, _, _ in queued], dtype="int64"
+                ),
+                "state": [state for _, state, _ in queued],
+                "seq_ids": [bold_request.seq_ids for _, _, bold_request in queued],
+                "database": [bold_request.database for _, _, bold_request in queued],
+                "operating_mode": [
+                    bold_request.operating_mode for _, _, bold_request in queued
+                ],
+                "result_url": [
+                    bold_request.result_url or None for _, _, bold_request in queued
+                ],
+                "submitted_at": pd.Series(
+                    [bold_request.timestamp for _, _, bold_request in queued],
+                    dtype="datetime64[us]",
+                ),
+                "seq_hashes": [
+                    bold_request.seq_hashes for _, _, bold_request in queued
+                ],
+            }
+        )
+
+        with self.lock:
+            self.connection.execute("BEGIN TRANSACTION")
+            self.connection.execute("DELETE FROM download_journal")
+            if not requests.empty:
+                self.connection.register("requests", requests)
+                self.connection.execute(
+                    """
+                    INSERT INTO download_journal BY NAME
+                    SELECT request_id, state, seq_ids, database, operating_mode, result_url,
+                    submitted_at, CAST(seq_hashes AS UBIGINT[]) AS seq_hashes
+                    FROM requests
+                    """
+                )
+                self.connection.unregister("requests")
+            self.connection.execute("COMMIT")
+
+    def clear(self) -> None:
+        """Function to remove all requests once the download is finished."""
+        with self.lock:
+            self.connection.execute("DELETE FROM download_journal")
+
+    def open_requests(self) -> list:
+        """Function to read all waiting, submitted and late requests in queue order.
+
+        Returns:
+            list: Tuples of request id, state, sequence ids, database, operating mode, result url, submission time and sequence hashes.
+        """
+        with self.lock:
+            return self.connection.execute(
+                """
+                SELECT request_id, state, seq_ids, database, operating_mode, result_url, submitted_at, seq_hashes
+                FROM download_journal
+                WHERE state IN ('waiting', 'submitted', 'late')
+                ORDER BY request_id
+                """
+            ).fetchall()
+
+    def last_request_id(self) -> int:
+        """Function to find the highest request id in the journal, including downloaded requests.
+
+        Returns:
+            int: The highest request id, 0 if the journal is empty.
+        """
+        with self.lock:
+            return self.connection.execute(
+                "SELECT coalesce(max(request_id), 0) FROM download_journal"
+            ).fetchone()[0]
+
+    def mark_submitted(self, request_id: int, result_url: str, submitted_at) -> None:
+        """Function to store the result url of a request that has been accepted by BOLD.
+
+        Args:
+            request_id (int): Id of the request.
+            result_url (str): Url to download the result from.
+            submitted_at (datetime): Time of the submission.
+        """
+        with self.lock:
+            self.connection.execute(
+                """
+                UPDATE download_journal
+                SET state = 'submitted', result_url = ?, submitted_at = ?
+                WHERE request_id = ?
+                """,
+                [result_url, submitted_at, request_id],
+            )
+
+    def mark_late(self, request_id: int) -> None:
+        """Function to mark a submitted request that has timed out, its result url is kept.
+
+        Args:
+            request_id (int): Id of the request.
+        """
+        with self.lock:
+            self.connection.execute(
+                "UPDATE download_journal SET state = 'late' WHERE request_id = ?",
+                [request_id],
+            )
+
+    def rebatch(self, request_ids: list, new_requests: dict) -> None:
+        """Function to replace requests with new waiting requests, if batches are merged or split.
+
+        Args:
+            request_ids (list): Ids of the requests that are replaced.
+            new_requests (dict): New request ids -> requests with the sequences of the replaced requests.
+        """
+        with self.lock:
+            self.connection.execute("BEGIN TRANSACTION")
+            self.connection.executemany(
+                "DELETE FROM download_journal WHERE request_id = ?",
+                [[request_id] for request_id in request_ids],
+            )
+            if new_requests:
+                self.connection.executemany(
+                    """
+                    INSERT INTO download_journal (request_id, state, seq_ids, database, operating_mode, seq_hashes)
+                    VALUES (?, 'waiting', ?, ?, ?, ?)
+                    """,
+                    [
+                        [
+                            request_id,
+                            bold_request.seq_ids,
+                            bold_request.database,
+                            bold_request.operating_mode,
+                            bold_request.seq_hashes,
+                        ]
+                        for request_id, bold_request in new_requests.items()
+                    ],
+                )
+            self.connection.execute("COMMIT")
+
+    @staticmethod
+    def mark_downloaded(connection: object, request_id: int) -> None:
+        """Function to mark a request as downloaded. Called by the writer inside the
+        transaction that saves the results, so results and journal never disagree.
+
+        Args:
+            connection (object): Connection of the writer to the project database.
+            request_id (int): Id of the request.
+        """
+        connection.execute(
+            "UPDATE download_journal SET state = 'downloaded' WHERE request_id = ?",
+            [request_id],
+        )
@@ -1,4 +1,4 @@
-# build a custom exception to handle bad responses from BOLD
-class DownloadFinished(Exception):
+# raised if the data package could not be downloaded completely or is corrupted
+class PackageDownloadError(Exception):
     def __init__(self, *args: object) -> None:
         super().__init__(*args)
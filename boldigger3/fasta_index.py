@@ -0,0 +1,311 @@
+import hashlib, json, threading
+import numpy as np
+from collections.abc import Mapping
+from pathlib import Path
+
+# all valid DNA characters
+VALID_CHARACTERS = b"ACGTMRWSYKVHDBXN"
+
+# bump the version whenever the layout of the index changes, old indices are rebuilt
+INDEX_VERSION = 2
+
+INDEX_DTYPE = np.dtype(
+    [
+        ("offset", "<i8"),
+        ("span", "<i8"),
+        ("length", "<i8"),
+        ("order", "<i8"),
+        ("seq_hash", "<u8"),
+    ]
+)
+
+
+class InvalidFastaError(ValueError):
+    """Raised when sequences in a fasta file contain invalid characters."""
+
+    def __init__(self, invalid_ids: list) -> None:
+        self.invalid_ids = invalid_ids
+        super().__init__(f"{len(invalid_ids)} sequences contain invalid characters.")
+
+
+class FastaIndex(Mapping):
+    """A class to read the sequences of a fasta file lazily through a persistent index.
+
+    The index is built with a single streaming pass over the fasta file and stored next to
+    the project data. For every record it holds the byte offset and span of the sequence,
+    the number of bases, the position in the file and a hash of the upper case sequence,
+    which is used to find identical sequences. The offsets are memory-mapped, so only the
+    ids are held in memory. It behaves like a read-only dict of id -> sequence
+    in fasta order. Used as a context manager the fasta file is closed on exit.
+
+    Attributes
+    ----------
+    fasta_path (Path): Path to the indexed fasta file.
+    ids (list): All sequence ids in fasta order.
+    records (np.ndarray): Memory-mapped offset, span, length and order per id.
+    """
+
+    def __init__(self, fasta_path: Path, ids: list, records: np.ndarray):
+        self.fasta_path = Path(fasta_path)
+        self.ids = ids
+        self.records = records
+        self.handle = None
+        self.lock = threading.Lock()
+        self._fasta_order = None
+        self._representatives = None
+
+    @staticmethod
+    def index_paths(fasta_path: Path, index_directory: Path) -> tuple:
+        """Function to generate the paths of all files belonging to the index.
+
+        Args:
+            fasta_path (Path): Path to the indexed fasta file.
+            index_directory (Path): Directory to store the index in.
+
+        Returns:
+            tuple: Paths to the records, the ids and the metadata of the index.
+        """
+        fasta_name = Path(fasta_path).stem
+
+        return (
+            index_directory.joinpath(f"{fasta_name}_fasta_index.npy"),
+            index_directory.joinpath(f"{fasta_name}_fasta_index.ids"),
+            index_directory.joinpath(f"{fasta_name}_fasta_index.json"),
+        )
+
+    @staticmethod
+    def source_metadata(fasta_path: Path) -> dict:
+        """Function to describe the fasta file, so a stale index can be detected."""
+        stat = Path(fasta_path).stat()
+
+        return {
+            "version": INDEX_VERSION,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+
+    @classmethod
+    def open(cls, fasta_path: Path, index_directory: Path) -> "FastaIndex":
+        """Function to open the index of a fasta file, it is built if it does not exist or is outdated.
+
+        Args:
+            fasta_path (Path): Path to the fasta file.
+            index_directory (Path): Directory to store the index in.
+
+        Returns:
+            FastaIndex: Index of the fasta file.
+        """
+        records_path, ids_path, metadata_path = cls.index_paths(
+            fasta_path, index_directory
+        )
+
+        try:
+            with open(metadata_path, "r") as metadata_file:
+                metadata = json.load(metadata_file)
+            if metadata == cls.source_metadata(fasta_path):
+                records = np.load(records_path, mmap_mode="r")
+                with open(ids_path, "r", encoding="utf-8") as ids_file:
+                    ids = ids_file.read().split("\n")[: len(records)]
+                return cls(fasta_path, ids, records)
+        except (FileNotFoundError, json.JSONDecodeError, ValueError):
+            pass
+
+        return cls.build(fasta_path, index_directory)
+
+    @classmethod
+    def build(cls, fasta_path: Path, index_directory: Path) -> "FastaIndex":
+        """Function to build the index with a single streaming pass over the fasta file.
+        All sequences are checked for invalid characters on the way.
+
+        Args:
+            fasta_path (Path): Path to the fasta file.
+            index_directory (Path): Directory to store the index in.
+
+        Raises:
+            ValueError: If an id occurs more than once.
+            InvalidFastaError: If any sequence contains invalid characters.
+
+        Returns:
+            FastaIndex: Index of the fasta file.
+        """
+        ids, records, invalid_ids = [], [], []
+        seen_ids = set()
+
+        def close_record(seq_id, offset, end, length, valid, seq_hash):
+            if seq_id is None:
+                return
+            if not valid:
+                invalid_ids.append(seq_id)
+            seq_hash = int.from_bytes(seq_hash.digest(), "little")
+            records.append((offset, end - offset, length, len(ids), seq_hash))
+            ids.append(seq_id)
+
+        seq_id, offset, length, valid = None, 0, 0, True
+        seq_hash = hashlib.blake2b(digest_size=8)
+        position = 0
+
+        with open(fasta_path, "rb") as fasta_file:
+            for line in fasta_file:
+                if line.startswith(b">"):
+                    close_record(seq_id, offset, position, length, valid, seq_hash)
+
+                    # the id is everything up to the first whitespace, like in SeqIO
+                    title = line[1:].decode("utf-8").split(None, 1)
+                    seq_id = title[0] if title else ""
+                    if seq_id in seen_ids:
+                        raise ValueError(f"Duplicate key '{seq_id}'")
+                    seen_ids.add(seq_id)
+
+                    offset, length, valid = position + len(line), 0, True
+                    seq_hash = hashlib.blake2b(digest_size=8)
+                elif seq_id is not None:
+                    bases = line.strip().replace(b" ", b"").upper()
+                    length += len(bases)
+                    seq_hash.update(bases)
+                    if bases.translate(None, VALID_CHARACTERS):
+                        valid = False
+
+                position += len(line)
+
+        close_record(seq_id, offset, position, length, valid, seq_hash)
+
+        if invalid_ids:
+            raise InvalidFastaError(invalid_ids)
+
+        records = np.array(records, dtype=INDEX_DTYPE)
+
+        # persist the index, the metadata is written last so a partial index is never used
+        index_directory.mkdir(parents=True, exist_ok=True)
+        records_path, ids_path, metadata_path = cls.index_paths(
+            fasta_path, index_directory
+        )
+        np.save(records_path, records)
+        with open(ids_path, "w", encoding="utf-8") as ids_file:
+            ids_file.write("\n".join(ids))
+        with open(metadata_path, "w") as metadata_file:
+            json.dump(cls.source_metadata(fasta_path), metadata_file)
+
+        return cls(fasta_path, ids, np.load(records_path, mmap_mode="r"))
+
+    @property
+    def fasta_order(self) -> dict:
+        """Dict of id -> position in the fasta file."""
+        if self._fasta_order is None:
+            self._fasta_order = {seq_id: idx for idx, seq_id in enumerate(self.ids)}
+
+        return self._fasta_order
+
+    @property
+    def representatives(self) -> np.ndarray:
+        """Position of the first record with the same sequence for every record.
+        Records with the same hash are only merged if their sequences are identical."""
+        if self._representatives is None:
+            _, first, inverse = np.unique(
+                self.records["seq_hash"], return_index=True, return_inverse=True
+            )
+            representatives = first[inverse.ravel()]
+
+            # a hash collision must not give a sequence the hits of another one
+            known = {}
+            for position in np.flatnonzero(
+                representatives != np.arange(len(representatives))
+            ):
+                first_position = int(representatives[position])
+                sequences = known.setdefault(
+                    first_position,
+                    {self.sequence(first_position).upper(): first_position},
+                )
+                representatives[position] = sequences.setdefault(
+                    self.sequence(int(position)).upper(), int(position)
+                )
+
+            self._representatives = representatives
+
+        return self._representatives
+
+    def representative_ids(self) -> list:
+        """Function to map every id to the id of the first record with the same sequence.
+
+        Returns:
+            list: The representative id for every id in fasta order.
+        """
+        return [self.ids[position] for position in self.representatives]
+
+    def unique_ids(self) -> dict:
+        """Function to collect one id per unique sequence, the first one in the fasta file.
+
+        Returns:
+            dict: Representative id -> position in the fasta file, in fasta order.
+        """
+        positions = np.flatnonzero(self.representatives == np.arange(len(self.ids)))
+
+        return {self.ids[position]: int(position) for position in positions}
+
+    def lengths(self, seq_ids: list) -> list:
+        """Function to look up the sequence lengths without reading the sequences.
+
+        Args:
+            seq_ids (list): Ids of the sequences.
+
+        Returns:
+            list: Length of every sequence in base pairs.
+        """
+        return [int(self.records[self.fasta_order[seq_id]]["length"]) for seq_id in seq_ids]
+
+    def seq_hashes(self, seq_ids: list) -> list:
+        """Function to look up the hashes of the sequences without reading the sequences.
+
+        Args:
+            seq_ids (list): Ids of the sequences.
+
+        Returns:
+            list: Hash of every sequence.
+        """
+        return [
+            int(self.records[self.fasta_order[seq_id]]["seq_hash"]) for seq_id in seq_ids
+        ]
+
+    def sequence(self, position: int) -> str:
+        """Function to read a single sequence from the fasta file.
+
+        Args:
+            position (int): Position of the sequence in the fasta file.
+
+        Returns:
+            str: The sequence without line breaks.
+        """
+        offset, span = int(self.records[position]["offset"]), int(
+            self.records[position]["span"]
+        )
+
+        with self.lock:
+            if self.handle is None:
+                self.handle = open(self.fasta_path, "rb")
+            self.handle.seek(offset)
+            data = self.handle.read(span)
+
+        return b"".join(data.split()).decode("utf-8")
+
+    def __getitem__(self, seq_id: str) -> str:
+        return self.sequence(self.fasta_order[seq_id])
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, seq_id: object) -> bool:
+        return seq_id in self.fasta_order
+
+    def __enter__(self) -> "FastaIndex":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Function to close the fasta file, it is opened again on the next read."""
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
@@ -0,0 +1,307 @@
+import datetime, duckdb
+import pandas as pd
+from contextlib import contextmanager
+from pathlib import Path
+
+# taxonomy and hit columns that are cached per sequence, in the order of id_engine_results
+HIT_COLUMNS = [
+    "phylum",
+    "class",
+    "order",
+    "family",
+    "genus",
+    "species",
+    "pct_identity",
+    "process_id",
+    "bin_uri",
+    "request_date",
+    "database",
+    "operating_mode",
+    "status",
+]
+
+
+class HitCache:
+    """A class to share downloaded hits between projects.
+
+    The cache is a local duckdb database that stores the parsed id engine results per
+    sequence hash, database and operating mode. The sequence is stored with its hash, so
+    hits are only served to the same sequence, even if two sequences share the hash of
+    different projects. Sequences that are found in the cache are copied into the project database instead of being sent to the id engine again.
+    Entries older than the maximum age are dropped, if the cache holds more than the
+    maximum number of sequences the least recently used ones are evicted.
+
+    Attributes
+    ----------
+    cache_path (Path): Path to the cache database.
+    max_age (int): Maximum age of an entry in days, None to keep entries forever.
+    max_size (int): Maximum number of cached sequences, None for no limit.
+    """
+
+    def __init__(self, cache_path: Path, max_age: int = None, max_size: int = None):
+        self.cache_path = Path(cache_path)
+        self.max_age = max_age
+        self.max_size = max_size
+
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with duckdb.connect(self.cache_path) as connection:
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cache_entries (
+                    seq_hash UBIGINT,
+                    database BIGINT,
+                    operating_mode BIGINT,
+                    request_date TIMESTAMP,
+                    last_used TIMESTAMP,
+                    sequence VARCHAR,
+                    PRIMARY KEY (seq_hash, database, operating_mode)
+                )
+                """
+            )
+            # entries of earlier versions cannot be checked against the sequence
+            connection.execute(
+                "ALTER TABLE cache_entries ADD COLUMN IF NOT EXISTS sequence VARCHAR"
+            )
+            connection.execute("DELETE FROM cache_entries WHERE sequence IS NULL")
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cache_hits (
+                    seq_hash UBIGINT,
+                    hit_rank BIGINT,
+                    phylum VARCHAR,
+                    class VARCHAR,
+                    "order" VARCHAR,
+                    family VARCHAR,
+                    genus VARCHAR,
+                    species VARCHAR,
+                    pct_identity DOUBLE,
+                    process_id VARCHAR,
+                    bin_uri VARCHAR,
+                    request_date VARCHAR,
+                    database BIGINT,
+                    operating_mode BIGINT,
+                    status VARCHAR
+                )
+                """
+            )
+
+    @contextmanager
+    def connect(self, database_path: Path):
+        """Function to open the project database with the cache attached as hit_cache.
+        The cache is detached again afterwards, other connections to the project
+        database of the same process share the attached databases.
+
+        Args:
+            database_path (Path): Path to the project database.
+
+        Yields:
+            object: Duckdb connection.
+        """
+        connection = duckdb.connect(database_path)
+        cache_path = str(self.cache_path).replace("'", "''")
+        connection.execute(f"ATTACH DATABASE '{cache_path}' AS hit_cache")
+
+        try:
+            yield connection
+        finally:
+            connection.execute("DETACH DATABASE IF EXISTS hit_cache")
+            connection.close()
+
+    def evict(self, connection: object) -> None:
+        """Function to drop expired entries and the least recently used entries above the maximum size.
+
+        Args:
+            connection (object): Connection with the cache attached as hit_cache.
+        """
+        connection.execute("BEGIN TRANSACTION")
+
+        if self.max_age is not None:
+            cutoff = datetime.datetime.now() - datetime.timedelta(days=self.max_age)
+            connection.execute(
+                "DELETE FROM hit_cache.cache_entries WHERE request_date < ?", [cutoff]
+            )
+
+        if self.max_size is not None:
+            connection.execute(
+                """
+                DELETE FROM hit_cache.cache_entries
+                WHERE rowid NOT IN (
+                    SELECT rowid
+                    FROM hit_cache.cache_entries
+                    ORDER BY last_used DESC
+                    LIMIT ?
+                )
+                """,
+                [self.max_size],
+            )
+
+        # remove all hits that no longer belong to an entry
+        connection.execute(
+            """
+            DELETE FROM hit_cache.cache_hits AS hits
+            WHERE NOT EXISTS (
+                SELECT 1 FROM hit_cache.cache_entries AS entries
+                WHERE entries.seq_hash = hits.seq_hash
+                AND entries.database = hits.database
+                AND entries.operating_mode = hits.operating_mode
+            )
+            """
+        )
+
+        connection.execute("COMMIT")
+
+    def serve(
+        self,
+        database_path: Path,
+        requested: pd.DataFrame,
+        database: int,
+        operating_mode: int,
+    ) -> int:
+        """Function to copy the cached hits of the requested sequences into id_engine_results.
+
+        Args:
+            database_path (Path): Path to the project database, id_engine_results and id_engine_completed have to exist.
+            requested (pd.DataFrame): Sequences to look up with the columns id, fasta_order, seq_hash and the upper case sequence.
+            database (int): Database the hits have to come from.
+            operating_mode (int): Operating mode the hits have to come from.
+
+        Returns:
+            int: Number of sequences that have been served from the cache.
+        """
+        hit_columns = ", ".join(f'hits."{column}"' for column in HIT_COLUMNS)
+
+        with self.connect(database_path) as connection:
+            self.evict(connection)
+
+            connection.register("requested", requested)
+            served = connection.execute(
+                """
+                SELECT requested.id, requested.seq_hash
+                FROM requested
+                JOIN hit_cache.cache_entries AS entries
+                ON entries.seq_hash = requested.seq_hash
+                AND entries.sequence = requested.sequence
+                AND entries.database = ?
+                AND entries.operating_mode = ?
+                """,
+                [database, operating_mode],
+            ).df()
+
+            if served.empty:
+                return 0
+
+            # keep the order of the hits, ties in the top hit selection depend on it
+            connection.register("served", served)
+            connection.execute("BEGIN TRANSACTION")
+            connection.execute(
+                f"""
+                INSERT INTO id_engine_results
+                SELECT requested.id, {hit_columns}, requested.fasta_order
+                FROM requested
+                JOIN hit_cache.cache_hits AS hits
+                ON hits.seq_hash = requested.seq_hash
+                AND hits.database = ?
+                AND hits.operating_mode = ?
+                WHERE requested.id IN (SELECT id FROM served)
+                ORDER BY requested.fasta_order, hits.hit_rank
+                """,
+                [database, operating_mode],
+            )
+
+            # the served ids count as downloaded
+            connection.execute(
+                """
+                INSERT OR IGNORE INTO id_engine_completed
+                SELECT id, ?, ?, fasta_order, seq_hash FROM requested
+                WHERE id IN (SELECT id FROM served)
+                """,
+                [database, operating_mode],
+            )
+            connection.execute("COMMIT")
+
+            # mark the served entries as recently used
+            connection.execute(
+                """
+                UPDATE hit_cache.cache_entries
+                SET last_used = current_localtimestamp()
+                WHERE database = ? AND operating_mode = ?
+                AND seq_hash IN (SELECT seq_hash FROM served)
+                """,
+                [database, operating_mode],
+            )
+
+            return len(served)
+
+    def store(
+        self,
+        database_path: Path,
+        downloaded: pd.DataFrame,
+        database: int,
+        operating_mode: int,
+    ) -> int:
+        """Function to add the hits of all downloaded sequences that are not cached yet.
+
+        Args:
+            database_path (Path): Path to the project database.
+            downloaded (pd.DataFrame): Downloaded sequences with the columns id, seq_hash and the upper case sequence.
+            database (int): Database the hits have been downloaded from.
+            operating_mode (int): Operating mode the hits have been downloaded with.
+
+        Returns:
+            int: Number of sequences that have been added to the cache.
+        """
+        result_columns = ", ".join(f'results."{column}"' for column in HIT_COLUMNS)
+        hit_columns = ", ".join(f'"{column}"' for column in HIT_COLUMNS)
+
+        # a hash is cached for a single sequence
+        downloaded = downloaded.drop_duplicates("seq_hash")
+
+        with self.connect(database_path) as connection:
+            connection.register("downloaded", downloaded)
+
+            # collect the new hits first, a transaction may only write to one database
+            connection.execute(
+                f"""
+                CREATE TEMP TABLE new_hits AS
+                SELECT downloaded.seq_hash, downloaded.sequence,
+                row_number() OVER (PARTITION BY results.id ORDER BY results.rowid) AS hit_rank,
+                {result_columns}
+                FROM id_engine_results AS results
+                JOIN downloaded ON downloaded.id = results.id
+                WHERE results.database = ? AND results.operating_mode = ?
+                AND NOT EXISTS (
+                    SELECT 1 FROM hit_cache.cache_entries AS entries
+                    WHERE entries.seq_hash = downloaded.seq_hash
+                    AND entries.database = results.database
+                    AND entries.operating_mode = results.operating_mode
+                )
+                """,
+                [database, operating_mode],
+            )
+
+            connection.execute("BEGIN TRANSACTION")
+            connection.execute(
+                f"""
+                INSERT INTO hit_cache.cache_hits (seq_hash, hit_rank, {hit_columns})
+                SELECT seq_hash, hit_rank, {hit_columns} FROM new_hits
+                """
+            )
+            stored = connection.execute(
+                """
+                INSERT INTO hit_cache.cache_entries
+                SELECT seq_hash, database, operating_mode,
+                coalesce(
+                    min(try_strptime(request_date, '%Y-%m-%d %H:%M:%S')),
+                    current_localtimestamp()
+                ),
+                current_localtimestamp(),
+                sequence
+                FROM new_hits
+                GROUP BY seq_hash, database, operating_mode, sequence
+                """
+            ).fetchone()[0]
+            connection.execute("COMMIT")
+
+            self.evict(connection)
+
+            return stored
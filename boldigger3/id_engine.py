@@ -1,14 +1,68 @@
-import datetime, duckdb, sys, pickle, more_itertools, requests_html, json, time, os
+import datetime, duckdb, sys, more_itertools, itertools, requests_html, json, time, asyncio, pickle
 import pandas as pd
-from Bio import SeqIO
+import pyarrow as pa
+import pyarrow.compute as pc
 from pathlib import Path
 from tqdm import tqdm
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict, deque
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-from boldigger3.exceptions import DownloadFinished
 from json.decoder import JSONDecodeError
 from requests.exceptions import ReadTimeout
+from boldigger3.rate_control import RateController, RATE_STATE_PATH
+from boldigger3.batch_planner import BatchPlanner, BATCH_STATE_PATH
+from boldigger3.fasta_index import FastaIndex, InvalidFastaError
+from boldigger3.hit_cache import HitCache
+from boldigger3.download_journal import DownloadJournal
+
+# use the faster orjson decoder if it is installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+# base url of the BOLD identification engine
+ID_ENGINE_URL = "https://id.boldsystems.org"
+
+# column definitions of the id engine results table
+ID_ENGINE_RESULTS_SCHEMA = """
+    id VARCHAR,
+    phylum VARCHAR,
+    class VARCHAR,
+    "order" VARCHAR,
+    family VARCHAR,
+    genus VARCHAR,
+    species VARCHAR,
+    pct_identity DOUBLE,
+    process_id VARCHAR,
+    bin_uri VARCHAR,
+    request_date VARCHAR,
+    database BIGINT,
+    operating_mode BIGINT,
+    status VARCHAR,
+    fasta_order BIGINT
+"""
+
+# the same columns as arrow schema, used when parsing the responses
+ID_ENGINE_RESULTS_ARROW_SCHEMA = pa.schema(
+    [
+        ("id", pa.string()),
+        ("phylum", pa.string()),
+        ("class", pa.string()),
+        ("order", pa.string()),
+        ("family", pa.string()),
+        ("genus", pa.string()),
+        ("species", pa.string()),
+        ("pct_identity", pa.float64()),
+        ("process_id", pa.string()),
+        ("bin_uri", pa.string()),
+        ("request_date", pa.string()),
+        ("database", pa.int64()),
+        ("operating_mode", pa.int64()),
+        ("status", pa.string()),
+        ("fasta_order", pa.int64()),
+    ]
+)
 
 
 class BoldIdRequest:
@@ -39,6 +93,9 @@ class BoldIdRequest:
             timestamp (object): Timestamp that is set when the request is sent to BOLD
             result_url (str): The result url to download the data from
             last_checked (object): The last time the download url was checked for updates
+            hedge (BoldIdRequest): Second submission of the same sequences if the request is slow
+            ready_at (object): Estimated time the result became available
+            seq_hashes (list): Hashes of the sequences at the time the request has been built
 
         """
         self.base_url = ""
@@ -50,100 +107,87 @@ class BoldIdRequest:
         self.operating_mode = None
         self.download_url = ""
         self.last_checked = None
+        self.seq_ids = []
+        self.hedge = None
+        self.ready_at = None
+        self.seq_hashes = []
 
 
 def parse_fasta(fasta_path: str) -> tuple:
-    """Function to read a fasta file and parse it into a dictionary.
+    """Function to open the index of a fasta file. The index is built with a single streaming
+    pass over the fasta file the first time, later stages reuse it.
 
     Args:
         fasta_path (str): Path to the fasta file to be identified.
 
     Returns:
-        tuple: Data of the fasta file in a dict, the full path to the fasta file, the directory where this fasta file is located.
+        tuple: Index of the fasta file that reads sequences lazily, the name of the fasta file, the directory where this fasta file is located.
     """
     # extract the directory from the fasta path
     fasta_path = Path(fasta_path)
     fasta_name = fasta_path.stem
     project_directory = fasta_path.parent
 
-    # use SeqIO to read the data into dict- automatically check fir the type of fasta
-    fasta_dict = SeqIO.to_dict(SeqIO.parse(fasta_path, "fasta"))
-
-    # trim header to maximum allowed chars of 99. names are preserved in the SeqRecord object
-    fasta_dict = {key: value for key, value in fasta_dict.items()}
-
-    # create a set of all valid DNA characters
-    valid_chars = {
-        "A",
-        "C",
-        "G",
-        "T",
-        "M",
-        "R",
-        "W",
-        "S",
-        "Y",
-        "K",
-        "V",
-        "H",
-        "D",
-        "B",
-        "X",
-        "N",
-    }
-
-    # check all sequences for invalid characters
-    raise_invalid_fasta = False
-
-    # check if the sequences contain invalid chars
-    for key in fasta_dict.keys():
-        if not set(fasta_dict[key].seq.upper()).issubset(valid_chars):
+    # the index also checks all sequences for invalid characters
+    try:
+        fasta_index = FastaIndex.open(
+            fasta_path, project_directory.joinpath("boldigger3_data")
+        )
+    except InvalidFastaError as error:
+        for key in error.invalid_ids:
             print(
                 f"{datetime.datetime.now().strftime('%H:%M:%S')}: Sequence {key} contains invalid characters."
             )
-            raise_invalid_fasta = True
-
-    if not raise_invalid_fasta:
-        return fasta_dict, fasta_name, project_directory
-    else:
         sys.exit()
 
+    return fasta_index, fasta_name, project_directory
+
 
-def already_downloaded(fasta_dict: dict, database_path: Path) -> dict:
+def already_downloaded(
+    fasta_index: FastaIndex, database_path: Path, database: int, operating_mode: int
+) -> list:
     """Function to check if any of the requests has been downloaded and stored in the duckdb database.
+    Only one id per unique sequence is downloaded, the hits are shared with all duplicates later.
 
     Args:
-        fasta_dict (dict): The dictionary with the fasta data.
+        fasta_index (FastaIndex): The index of the fasta file.
         database_path (str): Path to the duckdb database
+        database (int): The database the ids have to be downloaded from.
+        operating_mode (int): The operating mode the ids have to be downloaded with.
 
     Returns:
-        dict: The dictionary with the fasta data with already downloaded sequences removed.
+        list: The representative ids that have not been downloaded yet, in fasta order.
     """
-    if database_path.is_file():
-        # connect to the database
-        database = duckdb.connect(database_path)
-
-        # collect all unique values from the id column
-        downloaded_ids = database.execute(
-            "SELECT DISTINCT id FROM id_engine_results"
-        ).fetchall()
-
-        # close the connection
-        database.close()
-
-        # flatten the downloaded ids into a set for faster lookup
-        downloaded_ids = {row[0] for row in downloaded_ids}
+    unique_ids = fasta_index.unique_ids()
 
-        # filter the fasta_dict
-        fasta_dict = {
-            id: seq for (id, seq) in fasta_dict.items() if id not in downloaded_ids
-        }
+    if database_path.is_file():
+        unique_ids = pd.DataFrame(
+            {"id": list(unique_ids), "fasta_order": list(unique_ids.values())}
+        )
 
-        # return the updated dict
-        return fasta_dict
+        with duckdb.connect(database_path) as connection:
+            create_results_table(connection)
+
+            # only the missing ids are returned, the completion table has one row per id and combination
+            connection.register("unique_ids", unique_ids)
+            missing_ids = connection.execute(
+                """
+                SELECT unique_ids.id
+                FROM unique_ids
+                ANTI JOIN (
+                    SELECT id FROM id_engine_completed
+                    WHERE database = ? AND operating_mode = ?
+                ) AS completed
+                USING (id)
+                ORDER BY unique_ids.fasta_order
+                """,
+                [database, operating_mode],
+            ).fetchall()
+
+        return [row[0] for row in missing_ids]
     else:
-        # return the fasta dict unchanged
-        return fasta_dict
+        # nothing has been downloaded yet
+        return list(unique_ids)
 
 
 def build_url_params(database: int, operating_mode: int) -> tuple:
@@ -186,507 +230,1598 @@ def build_url_params(database: int, operating_mode: int) -> tuple:
     }
 
     # format the base url
-    base_url = f"https://id.boldsystems.org/submission?db={params['db']}&mi={params['mi']}&mo={params['mo']}&maxh={params['maxh']}&order={params['order']}"
+    base_url = f"{ID_ENGINE_URL}/submission?db={params['db']}&mi={params['mi']}&mo={params['mo']}&maxh={params['maxh']}&order={params['order']}"
 
     return base_url, params
 
 
-def build_download_queue(fasta_dict: dict, database: int, operating_mode: int) -> dict:
+def build_bold_request(
+    fasta_index: FastaIndex, seq_ids: list, database: int, operating_mode: int
+) -> BoldIdRequest:
+    """Function to build a single request for the id engine.
+
+    Args:
+        fasta_index (FastaIndex): Index to read the sequences from.
+        seq_ids (list): Ids of the sequences to send with the request.
+        database (int): Between 1 and 8 referring to the database, see readme for details.
+        operating_mode (int): Between 1 and 3 referring to the operating mode, see readme for details
+
+    Returns:
+        BoldIdRequest: The request, sequences are only read from the index when it is submitted.
+    """
+    base_url, params = build_url_params(database, operating_mode)
+
+    bold_request = BoldIdRequest()
+    bold_request.base_url = base_url
+    bold_request.params = params
+    bold_request.seq_ids = list(seq_ids)
+    bold_request.seq_hashes = fasta_index.seq_hashes(bold_request.seq_ids)
+    bold_request.query_data = (
+        f">{key}\n{fasta_index[key]}\n" for key in bold_request.seq_ids
+    )
+    bold_request.database = database
+    bold_request.operating_mode = operating_mode
+
+    return bold_request
+
+
+def build_download_queue(
+    fasta_index: FastaIndex,
+    seq_ids: list,
+    database: int,
+    operating_mode: int,
+    batch_planner: BatchPlanner = None,
+) -> dict:
     """Function to build the download queue.
 
     Args:
-        fasta_dict (dict): Dict that holds the data in the fasta file.
-        download_queue_name (str): String that holds the path where the download queue is saved.
+        fasta_index (FastaIndex): Index to read the sequences from.
+        seq_ids (list): Ids of the sequences to download.
         database (int): Between 1 and 8 referring to the database, see readme for details.
         operating_mode (int): Between 1 and 3 referring to the operating mode, see readme for details
+        batch_planner (BatchPlanner, optional): Planner for the batch sizes. Defaults to None (largest batches).
 
     Returns:
         dict: The dictionary with the downloaded queue
 
     """
     # initialize the download queue
-    download_queue = {"waiting": OrderedDict(), "active": dict()}
+    download_queue = {"waiting": OrderedDict(), "active": dict(), "late": dict()}
 
-    # build the base url and the params
-    base_url, params = build_url_params(database, operating_mode)
+    # the batch limits depend on the identity threshold of the operating mode
+    _, params = build_url_params(database, operating_mode)
+    batch_planner = batch_planner or BatchPlanner()
 
-    # determine the query size from the params
-    query_size_dict = {0.94: 100, 0.9: 20, 0.75: 10}
-    query_size = query_size_dict[params["mi"]]
+    # split the ids in batches by number of sequences and base pairs
+    query_data = batch_planner.plan(
+        list(seq_ids), fasta_index.lengths(seq_ids), params["mi"]
+    )
 
-    # split the fasta dict in query sized chunks
-    query_data = more_itertools.chunked(fasta_dict.keys(), query_size)
+    for idx, query_subset in enumerate(query_data, start=1):
+        download_queue["waiting"][idx] = build_bold_request(
+            fasta_index, query_subset, database, operating_mode
+        )
 
-    # produce a generator that holds all sequence and key data to loop over for the post requests
-    query_generators = (
-        [f">{key}\n{fasta_dict[key].seq}\n" for key in query_subset]
-        for query_subset in query_data
-    )
+    return download_queue
+
+
+def interleave_queues(download_queues: list) -> dict:
+    """Function to combine the download queues of several databases and operating modes.
+    The batches are interleaved, so all combinations progress at the same pace.
+
+    Args:
+        download_queues (list): Download queues with waiting requests.
+
+    Returns:
+        dict: A single download queue with renumbered request ids.
+    """
+    download_queue = {"waiting": OrderedDict(), "active": dict(), "late": dict()}
 
-    for idx, query_generator in enumerate(query_generators, start=1):
-        # initialize the bold id engine request
-        bold_request = BoldIdRequest()
-        bold_request.base_url = base_url
-        bold_request.params = params
-        bold_request.query_data = query_generator
-        bold_request.database = database
-        bold_request.operating_mode = operating_mode
+    batches = more_itertools.interleave_longest(
+        *[queue["waiting"].values() for queue in download_queues]
+    )
+    for idx, bold_request in enumerate(batches, start=1):
         download_queue["waiting"][idx] = bold_request
 
     return download_queue
 
 
-def build_post_request(BoldIdRequest: object) -> object:
-    """Function to send the POST request for the dataset to the BOLD id engine.
+def load_download_queue(journal: DownloadJournal, fasta_index: FastaIndex) -> dict:
+    """Function to rebuild the download queue from the unfinished requests in the journal.
+    Requests holding sequences that have been removed from the fasta file or edited since
+    they were queued are replaced by a waiting request with the remaining sequences, the
+    results of a submitted request would belong to the old sequences.
 
     Args:
-        bold_id_request (object): A BoldIdRequest object that holds all the information needed to send the request
+        journal (DownloadJournal): Journal of the download queue.
+        fasta_index (FastaIndex): Index to read the sequences from.
 
     Returns:
-        object: Returns the BoldIdRequest object with an added result url
+        dict: The dictionary with the waiting, the active and the late requests.
     """
-    # send the post requests
-    with requests_html.HTMLSession() as session:
+    download_queue = {"waiting": OrderedDict(), "active": dict(), "late": dict()}
+    replaced, new_requests = [], {}
+    last_request_id = journal.last_request_id()
+
+    for (
+        request_id,
+        state,
+        seq_ids,
+        database,
+        operating_mode,
+        result_url,
+        submitted_at,
+        seq_hashes,
+    ) in journal.open_requests():
+        present_ids = [seq_id for seq_id in seq_ids if seq_id in fasta_index]
+        bold_request = build_bold_request(
+            fasta_index, present_ids, database, operating_mode
+        )
 
-        # build a retry strategy for the html session
-        session.headers.update(
-            {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/98.0.4758.82 Safari/537.36"
-            }
+        # requests of earlier versions did not store the hashes, they are trusted
+        unchanged = len(present_ids) == len(seq_ids) and (
+            seq_hashes is None or seq_hashes == bold_request.seq_hashes
         )
-        retry_strategy = Retry(total=10, backoff_factor=1)
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        session.mount("https://", adapter)
+        if not unchanged:
+            replaced.append(request_id)
+            if present_ids:
+                last_request_id += 1
+                new_requests[last_request_id] = bold_request
+                download_queue["waiting"][last_request_id] = bold_request
+            continue
 
-        data = "".join(BoldIdRequest.query_data)
+        # submitted and late requests are polled again
+        if state in ("submitted", "late"):
+            bold_request.result_url = result_url
+            bold_request.timestamp = submitted_at
+            download_queue["active" if state == "submitted" else "late"][
+                request_id
+            ] = bold_request
+        else:
+            download_queue["waiting"][request_id] = bold_request
 
-        # generate the files to send via the id engine
-        files = {"fasta_file": ("submitted.fas", data, "text/plain")}
-        backoff_time = 0
+    if replaced:
+        journal.rebatch(replaced, new_requests)
+        tqdm.write(
+            "{}: {} unfinished requests hold removed or changed sequences. Queued them again.".format(
+                datetime.datetime.now().strftime("%H:%M:%S"), len(replaced)
+            )
+        )
 
-        while True:
-            try:
-                # submit the post request
-                response = session.post(
-                    BoldIdRequest.base_url,
-                    params=BoldIdRequest.params,
-                    files=files,
-                    timeout=10000,
-                )
+    return download_queue
 
-                # fetch the result
-                result = json.loads(response.text)
-                if "detail" in result.keys():
-                    tqdm.write(
-                        f"{datetime.datetime.now().strftime('%H:%M:%S')}: Limit reached. Waiting."
-                    )
-                    # wait for the backoff time
-                    backoff_time += 30
-                    time.sleep(backoff_time)
-                    continue
-                break
-            except (JSONDecodeError, ReadTimeout, KeyError):
-                # user output
-                tqdm.write(
-                    f"{datetime.datetime.now().strftime('%H:%M:%S')}: Building the request failed. Waiting."
-                )
-                backoff_time += 30
-                # wait for the backoff_time
-                time.sleep(backoff_time)
 
-        result_url = f"https://id.boldsystems.org/submission/results/{result['sub_id']}"
+def import_legacy_queue(
+    queue_path: Path, journal: DownloadJournal, fasta_index: FastaIndex, missing_ids: dict
+) -> int:
+    """Function to move the unfinished requests of a download queue pickled by earlier versions
+    into the journal. Submitted requests keep their result url if all of their sequences are
+    unchanged, the sequences of all other requests are queued again. The pickled queue is
+    removed afterwards.
+
+    Args:
+        queue_path (Path): Path to the pickled download queue.
+        journal (DownloadJournal): Journal of the download queue.
+        fasta_index (FastaIndex): Index of the current fasta file.
+        missing_ids (dict): (database, operating mode) -> ids that have not been downloaded yet.
+
+    Returns:
+        int: Number of requests that have been moved into the journal.
+    """
+    try:
+        with open(queue_path, "rb") as queue_file:
+            legacy_queue = pickle.load(queue_file)
+        legacy_requests = sorted(
+            [
+                (request_id, state, legacy_request)
+                for state in ("waiting", "active")
+                for request_id, legacy_request in legacy_queue[state].items()
+            ],
+            key=lambda request: request[0],
+        )
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, KeyError, TypeError):
+        legacy_requests = []
+
+    missing_ids = {
+        combination: set(seq_ids) for combination, seq_ids in missing_ids.items()
+    }
+    download_queue = {"waiting": OrderedDict(), "active": dict(), "late": dict()}
+
+    for request_id, (_, state, legacy_request) in enumerate(legacy_requests, start=1):
+        combination = (legacy_request.database, legacy_request.operating_mode)
+        # the requests hold the submitted records as fasta text
+        sequences = dict(
+            record.strip().lstrip(">").split("\n", 1)
+            for record in legacy_request.query_data
+        )
+        seq_ids = [
+            seq_id
+            for seq_id in sequences
+            if seq_id in missing_ids.get(combination, ())
+        ]
+        if not seq_ids:
+            continue
+
+        bold_request = build_bold_request(fasta_index, seq_ids, *combination)
+        unchanged = len(seq_ids) == len(sequences) and all(
+            fasta_index[seq_id].upper() == "".join(sequences[seq_id].split()).upper()
+            for seq_id in seq_ids
+        )
+
+        if state == "active" and legacy_request.result_url and unchanged:
+            bold_request.result_url = legacy_request.result_url
+            bold_request.timestamp = legacy_request.timestamp
+            download_queue["active"][request_id] = bold_request
+        else:
+            download_queue["waiting"][request_id] = bold_request
 
-        # append the resulting url
-        BoldIdRequest.result_url = result_url
-        BoldIdRequest.timestamp = datetime.datetime.now()
+    journal.replace(download_queue)
+    queue_path.unlink()
 
-        return BoldIdRequest
+    return len(download_queue["waiting"]) + len(download_queue["active"])
 
 
-def add_no_match(result: object, BoldIdRequest: object, fasta_order: dict) -> dict:
-    """Function to add a no match in case BOLD does not return any results
+def build_session(pool_size: int = 10) -> requests_html.HTMLSession:
+    """Function to build the HTML session that is shared by all requests to the id engine.
+    Connections are kept alive and reused, so the TLS handshake only happens once per connection.
 
     Args:
-        result (object): JSON returned from BOLD.
-        BoldIdRequest (object): Id Request object.
-        fasta_order (dict): Order of the original fasta file
+        pool_size (int, optional): Maximum number of pooled connections. Defaults to 10.
 
     Returns:
-        dict: A no match row for the dataframe
+        requests_html.HTMLSession: Session with a single retry policy and a connection pool.
     """
-    seq_id = result["seqid"]
-
-    row = {
-        "id": seq_id,
-        "phylum": "no-match",
-        "class": "no-match",
-        "order": "no-match",
-        "family": "no-match",
-        "subfamily": "no-match",
-        "genus": "no-match",
-        "species": "no-match",
-        "taxid_count": 0.0,
-        "pct_identity": 0.0,
-        "process_id": "",
-        "bin_uri": "",
-        "request_date": pd.Timestamp.now().strftime("%Y-%m-%d %X"),
-        "database": BoldIdRequest.database,
-        "operating_mode": BoldIdRequest.operating_mode,
-        "status": "",
-        "fasta_order": fasta_order[seq_id],
-    }
+    session = requests_html.HTMLSession()
+
+    session.headers.update(
+        {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/98.0.4758.82 Safari/537.36"
+        }
+    )
+
+    # build a retry strategy for the html session
+    retry_strategy = Retry(total=10, backoff_factor=1)
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry_strategy
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+
+def build_post_request(
+    BoldIdRequest: object, session: object, rate_controller: RateController = None
+) -> object:
+    """Function to send the POST request for the dataset to the BOLD id engine.
+
+    Args:
+        bold_id_request (object): A BoldIdRequest object that holds all the information needed to send the request
+        session (object): Shared HTML session to send the request with.
+        rate_controller (RateController, optional): Controller to report limit responses to. Defaults to None.
+
+    Returns:
+        object: Returns the BoldIdRequest object with an added result url
+    """
+    if rate_controller is None:
+        rate_controller = RateController()
+
+    data = "".join(BoldIdRequest.query_data)
+
+    # generate the files to send via the id engine
+    files = {"fasta_file": ("submitted.fas", data, "text/plain")}
+
+    while True:
+        try:
+            # submit the post request
+            response = session.post(
+                BoldIdRequest.base_url,
+                params=BoldIdRequest.params,
+                files=files,
+                timeout=10000,
+            )
+
+            # fetch the result
+            result = json.loads(response.text)
+            if "detail" in result.keys():
+                tqdm.write(
+                    f"{datetime.datetime.now().strftime('%H:%M:%S')}: Limit reached. Waiting."
+                )
+                # slow down and wait for the new submission interval
+                rate_controller.on_limit_reached()
+                time.sleep(rate_controller.interval)
+                continue
+            break
+        except (JSONDecodeError, ReadTimeout, KeyError):
+            # user output
+            tqdm.write(
+                f"{datetime.datetime.now().strftime('%H:%M:%S')}: Building the request failed. Waiting."
+            )
+            # wait for the submission interval
+            time.sleep(rate_controller.interval)
+
+    result_url = f"{ID_ENGINE_URL}/submission/results/{result['sub_id']}"
+
+    # append the resulting url
+    BoldIdRequest.result_url = result_url
+    BoldIdRequest.timestamp = datetime.datetime.now()
 
-    return row
+    return BoldIdRequest
 
 
 def safe_status(record_key, index, default=""):
     return record_key[index] if len(record_key) > index else default
 
 
-def parse_and_save_data(
-    BoldIdRequest: object,
-    response: object,
-    fasta_order: dict,
-    request_id: int,
-    database_path: Path,
-    fasta_name: str,
-):
-    """Function to parse the JSON returned by BOLD and save it as parquet.
+def parse_response(
+    BoldIdRequest: object, response: object, fasta_order: dict
+) -> pa.Table:
+    """Function to parse the JSON lines returned by BOLD into an arrow table.
+    The response is decoded line by line and the values are collected per column,
+    so no intermediate row dicts or dataframes are built.
 
     Args:
         BoldIdRequest (object): BoldIdRequest object.
         response (object): http response to parse.
         fasta_order (dict): Order of the original fasta file, can be used to order the table after metadata addition.
-        request_id (int): Request id, used to save the file.
-        database_path (str): Path to the database to write to.
+
+    Returns:
+        pa.Table: Table with the schema of id_engine_results.
     """
-    # parse out all objects from the response
-    json_objects = [json.loads(line) for line in response.iter_lines()]
+    taxonomy_levels = ["phylum", "class", "order", "family", "genus", "species"]
 
-    # store the resulting tables rows here when parsing the jsons
-    rows = []
+    # collect the values per column
+    ids, pct_identities, process_ids, bin_uris, statuses = [], [], [], [], []
+    taxonomy_columns = {level: [] for level in taxonomy_levels}
 
-    for result in json_objects:
-        # handle no-matches here
-        if not result["results"]:
-            # create a no-match hit
-            row = add_no_match(result, BoldIdRequest, fasta_order)
-            rows.append(row)
+    for line in response.iter_lines():
+        # skip keep-alive new lines
+        if not line:
             continue
 
-        # parse the json
+        result = json_loads(line)
         seq_id = result["seqid"]
 
+        # handle no-matches here
+        if not result["results"]:
+            ids.append(seq_id)
+            for level in taxonomy_levels:
+                taxonomy_columns[level].append("no-match")
+            pct_identities.append(0.0)
+            process_ids.append("")
+            bin_uris.append("")
+            statuses.append("")
+            continue
+
         for record_key, record_data in result["results"].items():
             record_key = record_key.split("|")
+            taxonomy = record_data.get("taxonomy", {})
 
-            row = {
-                "id": seq_id,
-                "process_id": record_key[0],
-                "bin_uri": record_key[2],
-                "status": safe_status(record_key, 4),
-                "pct_identity": 100.0 - record_data.get("pdist"),
-            }  # definition changed, now 100 - pdist
+            ids.append(seq_id)
+            for level in taxonomy_levels:
+                taxonomy_columns[level].append(taxonomy.get(level))
+            # definition changed, now 100 - pdist
+            pct_identities.append(100.0 - record_data.get("pdist"))
+            process_ids.append(record_key[0])
+            bin_uris.append(record_key[2])
+            statuses.append(safe_status(record_key, 4))
+
+    # columns that are the same for the whole request
+    rows = len(ids)
+    request_date = pd.Timestamp.now().strftime("%Y-%m-%d %X")
+
+    columns = {
+        "id": ids,
+        **taxonomy_columns,
+        "pct_identity": pct_identities,
+        "process_id": process_ids,
+        "bin_uri": bin_uris,
+        "request_date": [request_date] * rows,
+        "database": [BoldIdRequest.database] * rows,
+        "operating_mode": [BoldIdRequest.operating_mode] * rows,
+        "status": statuses,
+        "fasta_order": [fasta_order.get(seq_id) for seq_id in ids],
+    }
 
-            taxonomy = record_data.get("taxonomy", {})
-            row.update(taxonomy)
-            rows.append(row)
+    return pa.Table.from_pydict(columns, schema=ID_ENGINE_RESULTS_ARROW_SCHEMA)
 
-    # transform to dataframe, drop unused labels, add ordering column, use correct type annotations
-    id_engine_result = pd.DataFrame(rows)
-    id_engine_result = id_engine_result.drop(
-        labels=["subfamily", "taxid_count"], axis=1
-    )
-    id_engine_result["pct_identity"] = id_engine_result["pct_identity"].astype(
-        "float64"
+
+def create_results_table(connection: object) -> None:
+    """Function to create the id engine results table and the completion table if they do not exist yet.
+    The completion table holds one row per downloaded id, database and operating mode with the hash
+    of the downloaded sequence and is maintained whenever results are added.
+
+    Args:
+        connection (object): Connection to the project database.
+    """
+    connection.execute(
+        f"CREATE TABLE IF NOT EXISTS id_engine_results ({ID_ENGINE_RESULTS_SCHEMA})"
     )
-    id_engine_result["request_date"] = pd.Timestamp.now().strftime("%Y-%m-%d %X")
-    id_engine_result["database"] = BoldIdRequest.database
-    id_engine_result["operating_mode"] = BoldIdRequest.operating_mode
-    id_engine_result["fasta_order"] = id_engine_result["id"].map(fasta_order)
 
-    # reorder the columns
-    id_engine_result = id_engine_result[
-        [
-            "id",
-            "phylum",
-            "class",
-            "order",
-            "family",
-            "genus",
-            "species",
-            "pct_identity",
-            "process_id",
-            "bin_uri",
-            "request_date",
-            "database",
-            "operating_mode",
-            "status",
-            "fasta_order",
-        ]
+    completion_columns = [
+        row[0]
+        for row in connection.execute(
+            """
+            SELECT column_name FROM information_schema.columns
+            WHERE table_name = 'id_engine_completed'
+            AND table_catalog = current_database() AND table_schema = current_schema()
+            """
+        ).fetchall()
     ]
 
-    # finally stream to parquet to later load into duckdb, update the active queue
-    output_file = database_path.joinpath(
-        "boldigger3_data", f"request_id_{request_id}_{fasta_name}.parquet.snappy"
+    if "database" not in completion_columns:
+        connection.execute("BEGIN TRANSACTION")
+        # completion tables without database and operating mode are rebuilt
+        connection.execute("DROP TABLE IF EXISTS id_engine_completed")
+        connection.execute(
+            """
+            CREATE TABLE id_engine_completed (
+                id VARCHAR,
+                database BIGINT,
+                operating_mode BIGINT,
+                fasta_order BIGINT,
+                seq_hash UBIGINT,
+                PRIMARY KEY (id, database, operating_mode)
+            )
+            """
+        )
+        # projects from earlier versions are indexed once
+        connection.execute(
+            """
+            INSERT INTO id_engine_completed (id, database, operating_mode, fasta_order)
+            SELECT id, database, operating_mode, min(fasta_order)
+            FROM id_engine_results
+            WHERE database IS NOT NULL AND operating_mode IS NOT NULL
+            GROUP BY id, database, operating_mode
+            """
+        )
+        connection.execute("COMMIT")
+    elif "seq_hash" not in completion_columns:
+        # the hashes of earlier downloads are filled in from the fasta index
+        connection.execute("ALTER TABLE id_engine_completed ADD COLUMN seq_hash UBIGINT")
+
+
+def sync_completed(fasta_index: FastaIndex, database_path: Path) -> int:
+    """Function to bring the downloaded results in line with the current fasta file.
+    Results of ids that have been removed or whose sequence has changed are dropped, so they
+    are downloaded again. Ids that have moved within the file get their new fasta order.
+
+    Args:
+        fasta_index (FastaIndex): The index of the fasta file.
+        database_path (Path): Path to the project database.
+
+    Returns:
+        int: Number of ids whose results have been dropped.
+    """
+    unique_ids = fasta_index.unique_ids()
+    positions = list(unique_ids.values())
+    fasta_ids = pd.DataFrame(
+        {
+            "id": list(unique_ids),
+            "fasta_order": positions,
+            "seq_hash": fasta_index.records["seq_hash"][positions],
+        }
     )
 
-    id_engine_result.to_parquet(output_file)
+    with duckdb.connect(database_path) as connection:
+        create_results_table(connection)
+        connection.register("fasta_ids", fasta_ids)
+
+        # completions of earlier versions did not record the hash, trust the current sequence
+        connection.execute(
+            """
+            UPDATE id_engine_completed SET seq_hash = fasta_ids.seq_hash
+            FROM fasta_ids
+            WHERE id_engine_completed.id = fasta_ids.id AND id_engine_completed.seq_hash IS NULL
+            """
+        )
+
+        stale = connection.execute(
+            """
+            SELECT DISTINCT completed.id
+            FROM id_engine_completed AS completed
+            LEFT JOIN fasta_ids USING (id)
+            WHERE fasta_ids.id IS NULL OR fasta_ids.seq_hash <> completed.seq_hash
+            """
+        ).df()
+        moved = connection.execute(
+            """
+            SELECT DISTINCT fasta_ids.id, fasta_ids.fasta_order
+            FROM id_engine_completed AS completed
+            JOIN fasta_ids USING (id)
+            WHERE fasta_ids.fasta_order <> completed.fasta_order
+            AND fasta_ids.seq_hash = completed.seq_hash
+            """
+        ).df()
+
+        if stale.empty and moved.empty:
+            return 0
+
+        # the final_results view follows id_engine_results, materialized tables are updated as well
+        tables = ["id_engine_results", "id_engine_completed"]
+        if connection.execute(
+            """
+            SELECT count(*) FROM information_schema.tables
+            WHERE table_name = 'final_results' AND table_type = 'BASE TABLE'
+            AND table_catalog = current_database() AND table_schema = current_schema()
+            """
+        ).fetchone()[0]:
+            tables.append("final_results")
+
+        connection.register("stale", stale)
+        connection.register("moved", moved)
+        connection.execute("BEGIN TRANSACTION")
+        for table in tables:
+            if not stale.empty:
+                connection.execute(
+                    f"DELETE FROM {table} WHERE id IN (SELECT id FROM stale)"
+                )
+            if not moved.empty:
+                connection.execute(
+                    f"""
+                    UPDATE {table} SET fasta_order = moved.fasta_order
+                    FROM moved WHERE {table}.id = moved.id
+                    """
+                )
+        connection.execute("COMMIT")
+
+    return len(stale)
 
 
-def download_json(
-    active_queue: dict, fasta_order: dict, project_directory: Path, fasta_name: str
+def parse_and_save_data(
+    BoldIdRequest: object,
+    response: object,
+    fasta_order: dict,
+    connection: object,
+    request_id: int = None,
+    seq_hashes: dict = None,
 ):
-    """Function to download the JSON results from the id engine and store them in temporary parquet files.
+    """Function to parse the JSON returned by BOLD and append it to id_engine_results.
+    Every request is written in its own transaction, so the table always holds complete requests.
 
     Args:
-        active_queue (dict): Queue with active BOLD requests.
-        fasta_order (dict): Dict that can be appended to the results. Needed for creating a sorted duckdb table later.
+        BoldIdRequest (object): BoldIdRequest object.
+        response (object): http response to parse.
+        fasta_order (dict): Order of the original fasta file, can be used to order the table after metadata addition.
+        connection (object): Connection to the project database.
+        request_id (int, optional): Id of the request in the download journal, marked as downloaded in the same transaction. Defaults to None.
+        seq_hashes (dict, optional): Ids -> hashes of the submitted sequences, stored in the completion table. Defaults to None.
+
+    Returns:
+        object: Arrow table with the parsed hits of the request.
+    """
+    id_engine_result = parse_response(BoldIdRequest, response, fasta_order)
+
+    seq_hashes = seq_hashes or {}
+    request_hashes = pd.DataFrame(
+        {
+            "id": pd.Series(list(seq_hashes), dtype="string"),
+            "seq_hash": pd.Series(list(seq_hashes.values()), dtype="uint64"),
+        }
+    )
+
+    connection.register("id_engine_result", id_engine_result)
+    connection.register("request_hashes", request_hashes)
+
+    try:
+        connection.execute("BEGIN TRANSACTION")
+        if id_engine_result.num_rows:
+            # requests cover a small range of the fasta order, this lets duckdb skip most of the table
+            order_range = pc.min_max(id_engine_result["fasta_order"])
+
+            # a request that has been saved before a crash may be downloaded again, replace it
+            connection.execute(
+                """
+                DELETE FROM id_engine_results
+                WHERE fasta_order BETWEEN ? AND ?
+                AND database = ? AND operating_mode = ?
+                AND id IN (SELECT DISTINCT id FROM id_engine_result)
+                """,
+                [
+                    order_range["min"].as_py(),
+                    order_range["max"].as_py(),
+                    BoldIdRequest.database,
+                    BoldIdRequest.operating_mode,
+                ],
+            )
+            connection.execute(
+                "INSERT INTO id_engine_results SELECT * FROM id_engine_result"
+            )
+            connection.execute(
+                """
+                INSERT OR IGNORE INTO id_engine_completed
+                SELECT DISTINCT results.id, results.database, results.operating_mode,
+                results.fasta_order, request_hashes.seq_hash
+                FROM id_engine_result AS results
+                LEFT JOIN request_hashes USING (id)
+                """
+            )
+        if request_id is not None:
+            DownloadJournal.mark_downloaded(connection, request_id)
+        connection.execute("COMMIT")
+    except duckdb.Error:
+        connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.unregister("id_engine_result")
+        connection.unregister("request_hashes")
+
+    return id_engine_result
+
+
+class DownloadScheduler:
+    """A class to process the download queue. Submitting, polling and saving run as
+    concurrent tasks, so results are downloaded while new requests are still being submitted.
+
+    Requests that are not finished after the timeout are moved to the late requests. They
+    no longer block a slot for new submissions but are still polled less frequently, since
+    BOLD often finishes them a little later. A request is only submitted again if its
+    result url expires or keeps returning errors.
+
+    If hedging is enabled, a request that takes longer than a high percentile of the
+    observed turnarounds of its database and operating mode is submitted a second time,
+    as long as a slot is free and the pacing allows another submission. The copy that
+    finishes first is saved, the other one is abandoned.
+
+    Every result url is polled by its own task. The interval grows with every check that
+    finds no result yet, and the checks only ask for the headers. The result itself is
+    downloaded once as a stream when it is ready.
+
+    Attributes
+    ----------
+    download_queue (dict): Download queue with waiting, active and late requests.
+    journal (DownloadJournal): Journal that persists every state change of the requests.
+    fasta_index (FastaIndex): Index of the fasta file, used to rebuild resubmitted requests.
+    session (object): Shared HTML session to send all requests with.
+    rate_controller (RateController): Controller for the submission rate and the number of active requests.
+    pbar (object): Progress bar to update.
+    batch_planner (BatchPlanner): Planner for the batch sizes, waiting batches are merged or split to its limits before submission.
+    polling_interval (int): Seconds until the first check of a result url.
+    max_polling_interval (int): Upper limit of the growing interval between two checks.
+    backoff_factor (float): Factor the interval grows with after every check without result.
+    timeout (int): Seconds after submission until a request counts as late.
+    late_polling_interval (int): Seconds between two checks of a late result url.
+    expiry (int): Seconds after submission until the result url is given up and the request is resubmitted.
+    max_poll_errors (int): Number of consecutive error responses until the request is resubmitted.
+    hedge_percentile (float): Percentile of the observed turnarounds after which a request is submitted a second time, None to disable hedging.
+    hedge_min_samples (int): Number of observed turnarounds that is needed before requests are hedged.
+    pipeline (ResultPipeline): Pipeline that adds the metadata and selects the top hits of every saved request, None to only download.
+
+    Methods
+    -------
+    run(): Process the download queue until all requests are finished.
     """
-    # initialize the last check's for the active queue
-    for key in active_queue.keys():
-        if not active_queue[key].last_checked:
-            active_queue[key].last_checked = datetime.datetime.now()
-
-    # check the requests every ten seconds
-    with requests_html.HTMLSession() as session:
-        # loop over the active queue until any request is finished
-        while active_queue:
-            for key in active_queue.keys():
-                now = datetime.datetime.now()
-                # check the timestamp of the key, if it is older than 10 minutes, pop it from the active
-                # queue to fetch it in a later run
-                if now - active_queue[key].timestamp > datetime.timedelta(minutes=30):
+
+    def __init__(
+        self,
+        download_queue: dict,
+        journal: DownloadJournal,
+        fasta_index: FastaIndex,
+        session: object,
+        rate_controller: RateController,
+        pbar: object,
+        batch_planner: BatchPlanner = None,
+        polling_interval: int = 15,
+        max_polling_interval: int = 240,
+        backoff_factor: float = 1.5,
+        timeout: int = 1800,
+        late_polling_interval: int = 60,
+        expiry: int = 21600,
+        max_poll_errors: int = 3,
+        hedge_percentile: float = None,
+        hedge_min_samples: int = 10,
+        pipeline: object = None,
+    ):
+        self.download_queue = download_queue
+        self.journal = journal
+        self.fasta_index = fasta_index
+        self.fasta_order = fasta_index.fasta_order
+        self.session = session
+        self.rate_controller = rate_controller
+        self.pbar = pbar
+        self.batch_planner = batch_planner or BatchPlanner()
+        # merged and split batches get new ids after all existing ones
+        self.last_request_id = max(
+            [
+                request_id
+                for requests in download_queue.values()
+                for request_id in requests
+            ]
+            + [journal.last_request_id()],
+        )
+        self.polling_interval = polling_interval
+        self.max_polling_interval = max_polling_interval
+        self.backoff_factor = backoff_factor
+        # switched off if the server does not answer head requests
+        self.head_requests = True
+        self.timeout = timeout
+        self.late_polling_interval = late_polling_interval
+        self.expiry = expiry
+        self.max_poll_errors = max_poll_errors
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        # recent turnarounds per database and operating mode
+        self.turnarounds = defaultdict(lambda: deque(maxlen=200))
+        # requests with a hedge in flight, every hedge occupies a slot
+        self.hedged = set()
+        self.last_submission = datetime.datetime.min
+        self.pipeline = pipeline
+
+    def get_request(self, request_id: int) -> BoldIdRequest:
+        """Function to find a submitted request in the active or the late requests."""
+        if request_id in self.download_queue["active"]:
+            return self.download_queue["active"][request_id]
+
+        return self.download_queue["late"][request_id]
+
+    async def notify(self) -> None:
+        """Function to wake up the submitter after the queue has changed."""
+        async with self.queue_changed:
+            self.queue_changed.notify_all()
+
+    async def finish_request(self, request_id: int) -> None:
+        """Function to remove a request from the active or late queue and free its slot.
+
+        Args:
+            request_id (int): Id of the request in the active or late queue.
+        """
+        self.download_queue["active"].pop(request_id, None)
+        self.download_queue["late"].pop(request_id, None)
+        self.hedged.discard(request_id)
+
+        await self.notify()
+
+    async def move_to_late(self, request_id: int) -> None:
+        """Function to move a timed out request to the late requests, its slot is freed.
+
+        Args:
+            request_id (int): Id of the request in the active queue.
+        """
+        bold_request = self.download_queue["active"].pop(request_id)
+        self.download_queue["late"][request_id] = bold_request
+        self.batch_planner.on_failed(
+            bold_request.params["mi"], len(bold_request.seq_ids)
+        )
+        await asyncio.to_thread(self.journal.mark_late, request_id)
+
+        await self.notify()
+
+    def new_request_id(self) -> int:
+        """Function to get an unused request id for a merged or split batch."""
+        self.last_request_id += 1
+
+        return self.last_request_id
+
+    def add_waiting(self, bold_request: BoldIdRequest, seq_ids: list) -> tuple:
+        """Function to queue a new batch at the front of the waiting queue.
+
+        Args:
+            bold_request (BoldIdRequest): Request the batch has been taken from.
+            seq_ids (list): Ids of the sequences of the batch.
+
+        Returns:
+            tuple: Id and request of the new batch.
+        """
+        request_id = self.new_request_id()
+        self.download_queue["waiting"][request_id] = build_bold_request(
+            self.fasta_index,
+            seq_ids,
+            bold_request.database,
+            bold_request.operating_mode,
+        )
+        self.download_queue["waiting"].move_to_end(request_id, last=False)
+
+        return request_id, self.download_queue["waiting"][request_id]
+
+    async def resubmit_request(self, request_id: int) -> None:
+        """Function to bisect a request with an expired or failing result url, both halves are submitted again.
+
+        Args:
+            request_id (int): Id of the request in the active or late queue.
+        """
+        bold_request = self.get_request(request_id)
+        self.batch_planner.on_failed(
+            bold_request.params["mi"], len(bold_request.seq_ids)
+        )
+
+        # the halves go to the front of the waiting queue, in fasta order
+        new_requests = dict(
+            self.add_waiting(bold_request, seq_ids)
+            for seq_ids in reversed(BatchPlanner.split(bold_request.seq_ids))
+        )
+        await asyncio.to_thread(self.journal.rebatch, [request_id], new_requests)
+
+        await self.finish_request(request_id)
+
+    def next_request(self) -> tuple:
+        """Function to take the next batch from the waiting queue. Waiting requests of the
+        same database and operating mode are merged or split to the current batch limits.
+
+        Returns:
+            tuple: Id and request of the next batch, ids of the replaced waiting requests and the new waiting requests.
+        """
+        waiting = self.download_queue["waiting"]
+        request_id, bold_request = waiting.popitem(last=False)
+        identity = bold_request.params["mi"]
+        max_sequences, _ = self.batch_planner.limits(identity)
+        replaced, seq_ids = [request_id], list(bold_request.seq_ids)
+
+        # merge the following requests of the same combination while the batches may grow,
+        # batches of different databases and operating modes are interleaved
+        for next_id, next_request in list(itertools.islice(waiting.items(), 16)):
+            if len(seq_ids) >= max_sequences:
+                break
+            if (next_request.database, next_request.operating_mode) != (
+                bold_request.database,
+                bold_request.operating_mode,
+            ):
+                continue
+            waiting.pop(next_id)
+            replaced.append(next_id)
+            seq_ids += next_request.seq_ids
+
+        batch_size = self.batch_planner.take(
+            self.fasta_index.lengths(seq_ids), identity
+        )
+
+        # the request already fits the current limits
+        if len(replaced) == 1 and batch_size == len(seq_ids):
+            return request_id, bold_request, [], {}
+
+        # the remaining sequences go back to the front of the waiting queue
+        new_requests = {}
+        if batch_size < len(seq_ids):
+            new_requests.update(
+                [self.add_waiting(bold_request, seq_ids[batch_size:])]
+            )
+        request_id = self.new_request_id()
+        new_requests[request_id] = build_bold_request(
+            self.fasta_index,
+            seq_ids[:batch_size],
+            bold_request.database,
+            bold_request.operating_mode,
+        )
+
+        return request_id, new_requests[request_id], replaced, new_requests
+
+    def free_slots(self) -> int:
+        """Function to count the slots that are left for new submissions."""
+        return self.rate_controller.active_window - (
+            len(self.download_queue["active"]) + len(self.hedged)
+        )
+
+    def hedge_due(self, bold_request: BoldIdRequest, age: float) -> bool:
+        """Function to check if a request is slow enough to be submitted a second time.
+
+        Args:
+            bold_request (BoldIdRequest): The submitted request.
+            age (float): Seconds since the request has been submitted.
+
+        Returns:
+            bool: True if the request should be hedged now.
+        """
+        if self.hedge_percentile is None or bold_request.hedge:
+            return False
+
+        # new requests always come first, hedges only use spare capacity
+        if self.download_queue["waiting"] or self.free_slots() < 1:
+            return False
+        since_submission = datetime.datetime.now() - self.last_submission
+        if since_submission.total_seconds() < self.rate_controller.interval:
+            return False
+
+        turnarounds = sorted(
+            self.turnarounds[(bold_request.database, bold_request.operating_mode)]
+        )
+        if len(turnarounds) < self.hedge_min_samples:
+            return False
+
+        percentile = turnarounds[
+            round(self.hedge_percentile / 100 * (len(turnarounds) - 1))
+        ]
+
+        return age > percentile
+
+    async def hedge_request(self, request_id: int, bold_request: BoldIdRequest) -> None:
+        """Function to submit the sequences of a slow request a second time.
+
+        Args:
+            request_id (int): Id of the request in the active or late queue.
+            bold_request (BoldIdRequest): The submitted request.
+        """
+        # reserve the slot before submitting
+        self.hedged.add(request_id)
+        self.last_submission = datetime.datetime.now()
+
+        bold_request.hedge = await asyncio.to_thread(
+            build_post_request,
+            build_bold_request(
+                self.fasta_index,
+                bold_request.seq_ids,
+                bold_request.database,
+                bold_request.operating_mode,
+            ),
+            self.session,
+            self.rate_controller,
+        )
+
+        tqdm.write(
+            f"{datetime.datetime.now().strftime('%H:%M:%S')}: Request ID {request_id} is slower than usual. Submitted a second time."
+        )
+
+    def queue_finished(self) -> bool:
+        """Function to check if no request is waiting or submitted anymore."""
+        return not any(
+            self.download_queue[state] for state in ("waiting", "active", "late")
+        )
+
+    async def submit_requests(self) -> None:
+        """Task that moves requests from the waiting queue to the active queue.
+        The number of active requests and the pacing are set by the rate controller.
+        Runs until all requests are finished, since failing requests may come back.
+        """
+        while True:
+            # wait for a free slot before sending the next request
+            async with self.queue_changed:
+                await self.queue_changed.wait_for(
+                    lambda: self.queue_finished()
+                    or (self.download_queue["waiting"] and self.free_slots() > 0)
+                )
+
+            if self.queue_finished():
+                return
+
+            # retrieve the next batch from the waiting queue
+            request_id, current_request_object, replaced, new_requests = (
+                self.next_request()
+            )
+            if replaced:
+                await asyncio.to_thread(
+                    self.journal.rebatch, replaced, new_requests
+                )
+
+            # submitting blocks until BOLD accepts the request, run it in a thread
+            self.last_submission = datetime.datetime.now()
+            bold_request = await asyncio.to_thread(
+                build_post_request,
+                current_request_object,
+                self.session,
+                self.rate_controller,
+            )
+            await asyncio.to_thread(
+                self.journal.mark_submitted,
+                request_id,
+                bold_request.result_url,
+                bold_request.timestamp,
+            )
+            self.download_queue["active"][request_id] = bold_request
+
+            tqdm.write(
+                "{}: Request ID {} has been moved to the active downloads.".format(
+                    datetime.datetime.now().strftime("%H:%M:%S"),
+                    request_id,
+                )
+            )
+
+            self.start_polling(request_id)
+
+            # wait until sending the next request
+            await asyncio.sleep(self.rate_controller.interval)
+
+    def start_polling(self, request_id: int) -> None:
+        """Function to start the polling task for a submitted request.
+
+        Args:
+            request_id (int): Id of the request in the active or late queue.
+        """
+        self.task_group.create_task(self.poll_request(request_id))
+
+    def fetch_result(self, result_url: str) -> object:
+        """Function to check a result url. Only the headers are requested until the result
+        is ready, the body is then streamed, so it is downloaded only once.
+
+        Args:
+            result_url (str): Url of the result.
+
+        Returns:
+            object: The response, with an open body stream if the status code is 200.
+        """
+        if self.head_requests:
+            response = self.session.head(result_url)
+
+            if response.status_code in (405, 501):
+                self.head_requests = False
+            elif response.status_code != 200:
+                return response
+
+        response = self.session.get(result_url, stream=True)
+
+        # release the connection of all responses that are not read
+        if response.status_code != 200:
+            response.close()
+
+        return response
+
+    async def poll_request(self, request_id: int) -> None:
+        """Task that polls the result url of a single submitted request until it is ready,
+        expired or keeps failing.
+
+        Args:
+            request_id (int): Id of the request in the active or late queue.
+        """
+        bold_request = self.get_request(request_id)
+        poll_errors = 0
+        interval = self.polling_interval
+        # the result became available between the last check without it and the next one
+        last_miss = bold_request.timestamp
+
+        # initialize the last check for the request
+        if not bold_request.last_checked:
+            bold_request.last_checked = datetime.datetime.now()
+
+        while True:
+            age = (datetime.datetime.now() - bold_request.timestamp).total_seconds()
+
+            # the result url is given up, submit the sequences again
+            if age > self.expiry:
+                tqdm.write(
+                    f"{datetime.datetime.now().strftime('%H:%M:%S')}: Request ID {request_id} has expired. Will be resubmitted."
+                )
+                await self.resubmit_request(request_id)
+                return
+
+            # if the request is older than the timeout, free its slot but keep polling
+            if request_id in self.download_queue["active"] and age > self.timeout:
+                tqdm.write(
+                    f"{datetime.datetime.now().strftime('%H:%M:%S')}: Request ID {request_id} has timed out. Will be checked less frequently."
+                )
+                await self.move_to_late(request_id)
+
+            # slow requests are submitted a second time if there is capacity left
+            if self.hedge_due(bold_request, age):
+                await self.hedge_request(request_id, bold_request)
+
+            # wait until the url has not been checked for the polling interval
+            polling_interval = (
+                max(interval, self.late_polling_interval)
+                if request_id in self.download_queue["late"]
+                else interval
+            )
+            next_check = bold_request.last_checked + datetime.timedelta(
+                seconds=polling_interval
+            )
+            await asyncio.sleep(
+                max((next_check - datetime.datetime.now()).total_seconds(), 0)
+            )
+
+            checked_at = datetime.datetime.now()
+            response = await asyncio.to_thread(
+                self.fetch_result, bold_request.result_url
+            )
+            bold_request.last_checked = datetime.datetime.now()
+
+            # the hedge may finish first, it then replaces the original submission
+            if response.status_code != 200 and bold_request.hedge:
+                hedge_response = await asyncio.to_thread(
+                    self.fetch_result, bold_request.hedge.result_url
+                )
+                if hedge_response.status_code == 200:
                     tqdm.write(
-                        f"{datetime.datetime.now().strftime('%H:%M:%S')}: Request ID {key} has timed out. Will be requeued."
+                        f"{datetime.datetime.now().strftime('%H:%M:%S')}: Request ID {request_id} has been answered by its second submission first."
                     )
-                    active_queue.pop(key)
-                    return active_queue
-
-                # if the url has not been checked in the last 10 seconds, check again, else skip the url
-                if now - active_queue[key].last_checked > datetime.timedelta(
-                    seconds=15
-                ):
-                    response = session.get(active_queue[key].result_url)
-                else:
-                    continue
-                # if there's no data in the response yet, continue
-                if response.status_code == 404:
-                    active_queue[key].last_checked = datetime.datetime.now()
-                    continue
-                # if timing is sufficient AND data in the response, parse the response
-                else:
-                    # parse the response here and save, update the active queue
-                    parse_and_save_data(
-                        active_queue[key],
-                        response,
-                        fasta_order,
-                        key,
-                        project_directory,
-                        fasta_name,
+                    # a resumed run polls the url of the hedge, the turnaround still
+                    # counts from the first submission
+                    bold_request.result_url = bold_request.hedge.result_url
+                    await asyncio.to_thread(
+                        self.journal.mark_submitted,
+                        request_id,
+                        bold_request.result_url,
+                        bold_request.timestamp,
                     )
-                    active_queue.pop(key)
+                    if request_id in self.download_queue["late"]:
+                        await asyncio.to_thread(self.journal.mark_late, request_id)
+                    response = hedge_response
+
+            # if there's no data in the response yet, check again later
+            if response.status_code == 404:
+                last_miss = checked_at
+                poll_errors = 0
+                interval = min(
+                    interval * self.backoff_factor, self.max_polling_interval
+                )
+                continue
 
-                    # give user output
+            # the result url itself fails, submit the sequences again
+            if response.status_code != 200:
+                poll_errors += 1
+                if poll_errors >= self.max_poll_errors:
                     tqdm.write(
-                        f"{datetime.datetime.now().strftime('%H:%M:%S')}: Request ID {key} has successfully been downloaded."
+                        f"{datetime.datetime.now().strftime('%H:%M:%S')}: Request ID {request_id} returned errors. Will be resubmitted."
                     )
+                    await self.resubmit_request(request_id)
+                    return
+                continue
 
-                    # return the active queue
-                    return active_queue
+            # the growing polling interval is not counted as turnaround
+            bold_request.ready_at = last_miss + (checked_at - last_miss) / 2
 
+            # hand the response to the writer
+            await self.finished_requests.put((request_id, response))
+            return
 
-def parquet_to_duckdb(project_directory, database_path):
-    """Function to stream the parquet output to duckdb.
+    async def write_results(self) -> None:
+        """Task that parses and saves all finished requests, one at a time.
+        It is the only task that writes results to the project database.
+        """
+        connection = duckdb.connect(self.journal.database_path)
+        create_results_table(connection)
+        if self.pipeline:
+            self.pipeline.open(connection)
 
-    Args:
-        project_directory (str): Project directory to work in.
-        database_path (str): Path to the database.
-    """
-    # check if duck db already exists
-    db_exists = database_path.exists()
+        try:
+            await self.save_finished_requests(connection)
+        finally:
+            if self.pipeline:
+                self.pipeline.close(connection)
+            connection.close()
 
-    # fetch the parquet path
-    parquet_path = project_directory.joinpath(
-        "boldigger3_data", "request_id_*.parquet.snappy"
-    )
+    async def save_finished_requests(self, connection: object) -> None:
+        """Function to save finished requests until the stop signal is received.
 
-    # connect to the database
-    database = duckdb.connect(database_path)
+        Args:
+            connection (object): Connection to the project database.
+        """
+        while True:
+            finished_request = await self.finished_requests.get()
 
-    try:
-        # insert is db exists already, create table if not
-        if not db_exists:
-            # Create the table
-            database.execute(
-                f"""
-                CREATE TABLE id_engine_results AS
-                SELECT * FROM read_parquet('{parquet_path}')
-            """
+            # all requests have been handled
+            if finished_request is None:
+                return
+
+            request_id, response = finished_request
+            bold_request = self.get_request(request_id)
+
+            # parse the streamed response here and save, update the active queue
+            try:
+                id_engine_result = await asyncio.to_thread(
+                    parse_and_save_data,
+                    bold_request,
+                    response,
+                    self.fasta_order,
+                    connection,
+                    request_id,
+                    # the hashes of the submitted sequences, not of the current file
+                    dict(zip(bold_request.seq_ids, bold_request.seq_hashes)),
+                )
+            finally:
+                response.close()
+
+            # the completion latency drives the pacing and the size of the next submissions
+            latency = (
+                (bold_request.ready_at or datetime.datetime.now()) - bold_request.timestamp
+            ).total_seconds()
+            self.turnarounds[(bold_request.database, bold_request.operating_mode)].append(
+                latency
             )
-        else:
-            database.execute(
-                f"""
-            INSERT INTO id_engine_results
-            SELECT * FROM read_parquet('{parquet_path}')
-            """
+            self.rate_controller.on_completed(latency)
+            self.batch_planner.on_completed(
+                bold_request.params["mi"],
+                sum(self.fasta_index.lengths(bold_request.seq_ids)),
+                latency,
+            )
+            await self.finish_request(request_id)
+
+            # give user output
+            tqdm.write(
+                f"{datetime.datetime.now().strftime('%H:%M:%S')}: Request ID {request_id} has successfully been downloaded."
             )
-    except duckdb.IOException:
-        # if no parquet files are there dues to killed downloads, just continue
-        pass
+            self.pbar.update(len(bold_request.seq_ids))
+
+            # process the hits while the other requests are still downloading
+            if self.pipeline:
+                try:
+                    await asyncio.to_thread(
+                        self.pipeline.process,
+                        connection,
+                        bold_request,
+                        id_engine_result,
+                    )
+                except duckdb.Error:
+                    tqdm.write(
+                        f"{datetime.datetime.now().strftime('%H:%M:%S')}: Request ID {request_id} could not be processed yet. Will be processed after the download."
+                    )
 
-    # remove all parquet files if finished successfully
-    for file in project_directory.joinpath("boldigger3_data").glob("*.parquet.snappy"):
-        if file.is_file():
-            file.unlink()
+    async def run(self) -> None:
+        """Function to process the download queue until all requests are finished."""
+        self.queue_changed = asyncio.Condition()
+        self.finished_requests = asyncio.Queue()
 
+        async with asyncio.TaskGroup() as task_group:
+            self.task_group = task_group
 
-def main(fasta_path: str, database: int, operating_mode: int) -> None:
-    """Main function to run the BOLD identification engine.
+            writer = task_group.create_task(self.write_results())
+
+            # requests that were submitted in a previous run are polled again
+            for request_id in list(self.download_queue["active"].keys()) + list(
+                self.download_queue["late"].keys()
+            ):
+                self.start_polling(request_id)
+
+            # returns once every request has been downloaded
+            await self.submit_requests()
+            await self.finished_requests.put(None)
+            await writer
+
+        # keep what has been learned about the server for the next run
+        self.rate_controller.save()
+        self.batch_planner.save()
+
+
+def serve_from_cache(
+    hit_cache: HitCache,
+    fasta_index: FastaIndex,
+    seq_ids: list,
+    database_path: Path,
+    database: int,
+    operating_mode: int,
+) -> int:
+    """Function to copy the hits of all cached sequences into the project database.
 
     Args:
-        fasta_path (str): Path to the fasta file.
-        database (int): The database to use. Can be database 1-8, see readme for details.
-        operating_mode (int): The operating mode to use. Can be 1-3, see readme for details.
+        hit_cache (HitCache): The shared hit cache.
+        fasta_index (FastaIndex): The index of the fasta file.
+        seq_ids (list): Ids that have not been downloaded yet.
+        database_path (Path): Path to the project database.
+        database (int): The database to use.
+        operating_mode (int): The operating mode to use.
+
+    Returns:
+        int: Number of sequences served from the cache.
     """
-    # user output
-    tqdm.write(f"{datetime.datetime.now().strftime('%H:%M:%S')}: Reading input fasta.")
+    # the cache feeds the same table as the downloads, so create it up front
+    with duckdb.connect(database_path) as connection:
+        create_results_table(connection)
+
+    positions = [fasta_index.fasta_order[seq_id] for seq_id in seq_ids]
+    requested = pd.DataFrame(
+        {
+            "id": seq_ids,
+            "fasta_order": positions,
+            "seq_hash": fasta_index.records["seq_hash"][positions],
+            "sequence": [fasta_index.sequence(position).upper() for position in positions],
+        }
+    )
 
-    # read the input fasta into memory
-    fasta_dict, fasta_name, project_directory = parse_fasta(fasta_path)
+    return hit_cache.serve(database_path, requested, database, operating_mode)
+
+
+def store_in_cache(
+    hit_cache: HitCache,
+    fasta_index: FastaIndex,
+    database_path: Path,
+    database: int,
+    operating_mode: int,
+) -> int:
+    """Function to add the downloaded hits of the project to the hit cache.
 
-    # define the order of the fasta dict, can be used to add an order column in the output
-    fasta_dict_order = {key: idx for idx, key in enumerate(fasta_dict.keys())}
+    Args:
+        hit_cache (HitCache): The shared hit cache.
+        fasta_index (FastaIndex): The index of the fasta file.
+        database_path (Path): Path to the project database.
+        database (int): The database that was used.
+        operating_mode (int): The operating mode that was used.
 
-    # define a name for the duckdb database where the downloaded data will be stored
-    database_path = project_directory.joinpath(
-        "boldigger3_data", f"{fasta_name}.duckdb"
+    Returns:
+        int: Number of sequences added to the cache.
+    """
+    unique_ids = fasta_index.unique_ids()
+    downloaded = pd.DataFrame(
+        {
+            "id": list(unique_ids),
+            "seq_hash": fasta_index.records["seq_hash"][list(unique_ids.values())],
+            "sequence": [
+                fasta_index.sequence(position).upper()
+                for position in unique_ids.values()
+            ],
+        }
     )
 
-    # generate a name for the download queue
-    download_queue_name = project_directory.joinpath(
-        "boldigger3_data", "{}_download_queue.pkl".format(fasta_name)
+    return hit_cache.store(database_path, downloaded, database, operating_mode)
+
+
+def build_combinations(database, operating_mode) -> list:
+    """Function to combine one or several databases with one or several operating modes.
+
+    Args:
+        database (int | list): One or several databases, see readme for details.
+        operating_mode (int | list): One or several operating modes, see readme for details.
+
+    Returns:
+        list: Unique (database, operating mode) tuples in the given order.
+    """
+    databases = [database] if isinstance(database, int) else list(database)
+    operating_modes = (
+        [operating_mode] if isinstance(operating_mode, int) else list(operating_mode)
     )
 
-    # generate a data directory to save the data to, so the working directory won't be cluttered
-    data_dir = project_directory.joinpath("boldigger3_data")
-    data_dir.mkdir(exist_ok=True)
+    return list(
+        dict.fromkeys(
+            (database, operating_mode)
+            for database in databases
+            for operating_mode in operating_modes
+        )
+    )
 
-    # check if any data has been downloaded yet
-    fasta_dict = already_downloaded(fasta_dict, database_path)
 
-    # if all data has already been downloaded return to stop the function
-    if not fasta_dict:
-        tqdm.write(
-            "{}: All data has already been downloaded.".format(
-                datetime.datetime.now().strftime("%H:%M:%S")
+def build_missing_queue(
+    fasta_index: FastaIndex, missing_ids: dict, batch_planner: BatchPlanner
+) -> dict:
+    """Function to build one download queue for the missing ids of all combinations.
+
+    Args:
+        fasta_index (FastaIndex): Index to read the sequences from.
+        missing_ids (dict): (database, operating mode) -> ids that have not been downloaded yet.
+        batch_planner (BatchPlanner): Planner for the batch sizes.
+
+    Returns:
+        dict: The interleaved download queue.
+    """
+    # combinations with the same identity threshold share the batch limits
+    queued = {}
+    for (database, operating_mode), seq_ids in missing_ids.items():
+        identity = build_url_params(database, operating_mode)[1]["mi"]
+        queued[identity] = queued.get(identity, 0) + len(seq_ids)
+    for identity, sequences in queued.items():
+        batch_planner.limit_to_queue(identity, sequences)
+
+    return interleave_queues(
+        [
+            build_download_queue(
+                fasta_index, seq_ids, database, operating_mode, batch_planner
             )
+            for (database, operating_mode), seq_ids in missing_ids.items()
+            if seq_ids
+        ]
+    )
+
+
+def main(
+    fasta_path: str,
+    database,
+    operating_mode,
+    pool_size: int = 10,
+    rate_state_path: Path = RATE_STATE_PATH,
+    batch_state_path: Path = BATCH_STATE_PATH,
+    hedge_percentile: float = None,
+    max_batch_factor: float = 4.0,
+    cache_path: str = None,
+    cache_max_age: int = None,
+    cache_max_size: int = None,
+    pipeline: object = None,
+) -> None:
+    """Main function to run the BOLD identification engine.
+    Several databases and operating modes are identified in one run, their batches share one scheduler.
+
+    Args:
+        fasta_path (str): Path to the fasta file.
+        database (int | list): The database or databases to use. Can be database 1-8, see readme for details.
+        operating_mode (int | list): The operating mode or modes to use. Can be 1-3, see readme for details.
+        pool_size (int, optional): Number of pooled connections to the id engine. Defaults to 10.
+        rate_state_path (Path, optional): File to persist the learned submission pacing to.
+        batch_state_path (Path, optional): File to persist the learned batch sizes to.
+        hedge_percentile (float, optional): Percentile of the observed turnarounds after which slow requests are submitted a second time. Defaults to None (no hedging).
+        max_batch_factor (float, optional): Largest batches relative to the fixed batch sizes of earlier versions. Defaults to 4.0.
+        cache_path (str, optional): Path to a hit cache shared between projects. Defaults to None (no cache).
+        cache_max_age (int, optional): Maximum age of cached hits in days. Defaults to None (no limit).
+        cache_max_size (int, optional): Maximum number of cached sequences. Defaults to None (no limit).
+        pipeline (ResultPipeline, optional): Pipeline that processes every request as soon as it is downloaded. Defaults to None.
+    """
+    # user output
+    tqdm.write(f"{datetime.datetime.now().strftime('%H:%M:%S')}: Reading input fasta.")
+
+    # index the input fasta, sequences are only read when they are submitted
+    fasta_index, fasta_name, project_directory = parse_fasta(fasta_path)
+
+    # the fasta file is closed once the run ends
+    with fasta_index:
+        # define a name for the duckdb database where the downloaded data will be stored
+        database_path = project_directory.joinpath(
+            "boldigger3_data", f"{fasta_name}.duckdb"
         )
-        return None
 
-    # try to open an existing download queue first to finish unfinished downloads
-    try:
-        with open(download_queue_name, "rb") as download_queue_file:
-            download_queue = pickle.load(download_queue_file)
-            # user output
+        # generate a data directory to save the data to, so the working directory won't be cluttered
+        data_dir = project_directory.joinpath("boldigger3_data")
+        data_dir.mkdir(exist_ok=True)
+
+        # results of removed or changed sequences are downloaded again
+        changed = sync_completed(fasta_index, database_path)
+        if changed:
             tqdm.write(
-                "{}: Found unfinished downloads from previous runs. Continueing download.".format(
-                    datetime.datetime.now().strftime("%H:%M:%S")
+                "{}: {} sequences have been removed or changed since the last run.".format(
+                    datetime.datetime.now().strftime("%H:%M:%S"), changed
                 )
             )
-    except FileNotFoundError:
-        # if no download queue can be found build it
-        tqdm.write(
-            "{}: Building the download queue.".format(
-                datetime.datetime.now().strftime("%H:%M:%S")
-            )
-        )
-        # build the queue
-        download_queue = build_download_queue(fasta_dict, database, operating_mode)
-        with open(download_queue_name, "wb") as download_queue_file:
-            pickle.dump(download_queue, download_queue_file)
-        tqdm.write(
-            "{}: Added {} requests to the download queue.".format(
-                datetime.datetime.now().strftime("%H:%M:%S"),
-                len(download_queue["waiting"]),
-            )
-        )
 
-    # calculate the total amounts of downloads
-    total_downloads = len(download_queue["waiting"]) + len(download_queue["active"])
+        # every combination of database and operating mode is downloaded separately
+        combinations = build_combinations(database, operating_mode)
 
-    # as long as there is data in the download queue continue the download
-    with tqdm(total=total_downloads, desc="Finished downloads") as pbar:
-        while True:
-            try:
-                if download_queue["waiting"] or download_queue["active"]:
-                    # as long as there are not 4 active requests in the download queue
-                    # move on request from the waiting queue to the active queue
-                    if len(download_queue["active"]) < 10 and download_queue["waiting"]:
-                        # retrieve one request from the waiting queue
-                        request_id, current_request_object = download_queue[
-                            "waiting"
-                        ].popitem(last=False)
-
-                        # add this request to the active queue
-                        download_queue["active"][request_id] = build_post_request(
-                            current_request_object
-                        )
+        def find_missing_ids() -> dict:
+            return {
+                combination: already_downloaded(fasta_index, database_path, *combination)
+                for combination in combinations
+            }
 
-                        tqdm.write(
-                            "{}: Request ID {} has been moved to the active downloads.".format(
-                                datetime.datetime.now().strftime("%H:%M:%S"),
-                                request_id,
-                            )
-                        )
+        # check if any data has been downloaded yet
+        missing_ids = find_missing_ids()
 
-                        # wait for 10 seconds until sending the next request
-                        time.sleep(30)
-                    # check if any of the active queue objects has finished and can be saved and removed
-                    else:
-                        # check if any of the active downloads has been finished
-                        download_queue["active"] = download_json(
-                            download_queue["active"],
-                            fasta_dict_order,
-                            project_directory,
-                            fasta_name,
-                        )
-                        # update the progress bar
-                        pbar.update(1)
-                    # after every iteration override the download queue as it is changes along the way
-                    with open(download_queue_name, "wb") as out_stream:
-                        pickle.dump(download_queue, out_stream)
-                # if all downloads are finished raise download finished flag
+        # open the shared hit cache
+        hit_cache = (
+            HitCache(cache_path, cache_max_age, cache_max_size) if cache_path else None
+        )
+
+        # the journal holds the state of all requests, so unfinished downloads can be resumed
+        with DownloadJournal(database_path) as journal:
+            # earlier versions pickled the download queue, its requests are moved into the journal once
+            legacy_queue_path = data_dir.joinpath(f"{fasta_name}_download_queue.pkl")
+            if legacy_queue_path.is_file():
+                if journal.has_open_requests():
+                    legacy_queue_path.unlink()
+                    tqdm.write(
+                        f"{datetime.datetime.now().strftime('%H:%M:%S')}: Removed the download queue of an earlier version, the download journal is resumed instead."
+                    )
                 else:
-                    parquet_to_duckdb(project_directory, database_path)
-                    raise DownloadFinished
-            except DownloadFinished:
-                # check if all downloads are finished: if yes: delete download queue, break the loop
-                fasta_dict = already_downloaded(fasta_dict, database_path)
-                # if there is any unfinished download, requeue
-                if fasta_dict:
+                    imported = import_legacy_queue(
+                        legacy_queue_path, journal, fasta_index, missing_ids
+                    )
                     tqdm.write(
-                        "{}: Requeuing incomplete downloads.".format(
-                            datetime.datetime.now().strftime("%H:%M:%S")
+                        "{}: Moved {} unfinished requests of an earlier version into the download journal.".format(
+                            datetime.datetime.now().strftime("%H:%M:%S"), imported
                         )
                     )
-                    download_queue = build_download_queue(
-                        fasta_dict, database, operating_mode
+
+            resume_download = journal.has_open_requests()
+
+            # serve cached sequences without sending them to the id engine, unfinished
+            # download queues of previous runs are resumed as they are
+            if hit_cache and any(missing_ids.values()) and not resume_download:
+                served = sum(
+                    serve_from_cache(
+                        hit_cache,
+                        fasta_index,
+                        seq_ids,
+                        database_path,
+                        *combination,
                     )
-                    # recalculate the total downloads
-                    total_downloads = len(download_queue["active"]) + len(
-                        download_queue["waiting"]
+                    for combination, seq_ids in missing_ids.items()
+                    if seq_ids
+                )
+                tqdm.write(
+                    "{}: Found {} sequences in the hit cache.".format(
+                        datetime.datetime.now().strftime("%H:%M:%S"), served
                     )
-                    # reset the progress bar for the second round of downloads
-                    pbar.reset()
-                    pbar.total = total_downloads
-                    pbar.refresh()
-                else:
+                )
+                missing_ids = find_missing_ids()
+
+            # if all data has already been downloaded return to stop the function
+            if not any(missing_ids.values()):
+                tqdm.write(
+                    "{}: All data has already been downloaded.".format(
+                        datetime.datetime.now().strftime("%H:%M:%S")
+                    )
+                )
+                journal.clear()
+                if hit_cache:
+                    for combination in combinations:
+                        store_in_cache(hit_cache, fasta_index, database_path, *combination)
+                return None
+
+            # start with the batch sizes that have been learned in previous runs
+            batch_planner = BatchPlanner.load(
+                batch_state_path, max_batch_factor=max_batch_factor
+            )
+
+            # continue unfinished downloads of previous runs first
+            if resume_download:
+                download_queue = load_download_queue(journal, fasta_index)
+                # user output
+                tqdm.write(
+                    "{}: Found unfinished downloads from previous runs. Continueing download.".format(
+                        datetime.datetime.now().strftime("%H:%M:%S")
+                    )
+                )
+            else:
+                # if no download queue can be found build it
+                tqdm.write(
+                    "{}: Building the download queue.".format(
+                        datetime.datetime.now().strftime("%H:%M:%S")
+                    )
+                )
+                # identical sequences are only submitted once
+                duplicates = len(fasta_index) - len(fasta_index.unique_ids())
+                if duplicates:
                     tqdm.write(
-                        "{}: All downloads finished successfully.".format(
-                            datetime.datetime.now().strftime("%H:%M:%S"),
+                        "{}: Skipping {} duplicate sequences.".format(
+                            datetime.datetime.now().strftime("%H:%M:%S"), duplicates
                         )
                     )
-                    # finally remove the download queue
-                    os.remove(download_queue_name)
-                    break
+                # build the queue, batches of all combinations are interleaved
+                download_queue = build_missing_queue(
+                    fasta_index, missing_ids, batch_planner
+                )
+                journal.replace(download_queue)
+                tqdm.write(
+                    "{}: Added {} requests to the download queue.".format(
+                        datetime.datetime.now().strftime("%H:%M:%S"),
+                        len(download_queue["waiting"]),
+                    )
+                )
+
+            # continue with the pacing that has been learned in previous runs
+            rate_controller = RateController.load(rate_state_path)
+
+            # calculate the total amounts of downloads, batches may be merged or split on the way
+            total_downloads = sum(
+                len(bold_request.seq_ids)
+                for requests in download_queue.values()
+                for bold_request in requests.values()
+            )
+
+            # as long as there is data in the download queue continue the download
+            # all rounds share one session, so connections are reused for the whole run
+            with build_session(pool_size) as session, tqdm(
+                total=total_downloads, desc="Downloaded sequences"
+            ) as pbar:
+                while True:
+                    scheduler = DownloadScheduler(
+                        download_queue,
+                        journal,
+                        fasta_index,
+                        session,
+                        rate_controller,
+                        pbar,
+                        batch_planner,
+                        hedge_percentile=hedge_percentile,
+                        pipeline=pipeline,
+                    )
+                    asyncio.run(scheduler.run())
+
+                    # check if all downloads are finished: if yes: clear the journal, break the loop
+                    missing_ids = find_missing_ids()
+                    # if there is any unfinished download, requeue
+                    if any(missing_ids.values()):
+                        tqdm.write(
+                            "{}: Requeuing incomplete downloads.".format(
+                                datetime.datetime.now().strftime("%H:%M:%S")
+                            )
+                        )
+                        download_queue = build_missing_queue(
+                            fasta_index, missing_ids, batch_planner
+                        )
+                        journal.replace(download_queue)
+                        # recalculate the total downloads
+                        total_downloads = sum(len(ids) for ids in missing_ids.values())
+                        # reset the progress bar for the second round of downloads
+                        pbar.reset()
+                        pbar.total = total_downloads
+                        pbar.refresh()
+                    else:
+                        tqdm.write(
+                            "{}: All downloads finished successfully.".format(
+                                datetime.datetime.now().strftime("%H:%M:%S"),
+                            )
+                        )
+                        # finally clear the journal
+                        journal.clear()
+                        break
+
+        # share the downloaded hits with other projects
+        if hit_cache:
+            stored = sum(
+                store_in_cache(hit_cache, fasta_index, database_path, *combination)
+                for combination in combinations
+            )
+            tqdm.write(
+                "{}: Added {} sequences to the hit cache.".format(
+                    datetime.datetime.now().strftime("%H:%M:%S"), stored
+                )
+            )
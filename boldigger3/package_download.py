@@ -0,0 +1,328 @@
+import datetime, json, math, shutil, threading, time
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from requests.exceptions import RequestException
+from tqdm import tqdm
+from boldigger3.exceptions import PackageDownloadError
+
+
+class PackageDownload:
+    """A class to download the BOLD data package in several byte ranges at the same time.
+
+    If the server answers range requests, the package is split into parts that are written
+    to part files next to the output file. The layout of the parts is persisted, so a
+    download that has been interrupted continues with the missing bytes of every part in
+    the next run. Servers without range support are downloaded over a single connection.
+    The uid of a download url can only be used once, a refused url is replaced by a fresh
+    one. If the fresh url is refused as well, the package is downloaded over a single
+    connection. Before the joined file is used, its size is compared with the size announced
+    by the server and the parquet footer is read.
+
+    Attributes
+    ----------
+    session (object): Session to download the package with.
+    output_path (Path): Path of the downloaded package.
+    parts (int): Number of parts that are downloaded at the same time.
+    chunk_size (int): Bytes that are written at once.
+    retries (int): Number of retries per part after the connection has been lost.
+    retry_delay (float): Seconds to wait before the first retry, doubled with every retry.
+    timeout (float): Seconds without data until the connection counts as lost.
+    url_factory (callable): Function that returns a fresh download url of the package.
+    url (str): Download url of the last request.
+    refused (bool): True if a fresh download url has been refused.
+    """
+
+    def __init__(
+        self,
+        session: object,
+        output_path: Path,
+        parts: int = 4,
+        chunk_size: int = 1024 * 1024,
+        retries: int = 5,
+        retry_delay: float = 2.0,
+        timeout: float = 60.0,
+    ):
+        self.session = session
+        self.output_path = Path(output_path)
+        self.parts = parts
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.url_factory = None
+        self.url = None
+        self.refused = False
+        self.lock = threading.Lock()
+
+    @property
+    def state_path(self) -> Path:
+        return self.output_path.with_name(f"{self.output_path.name}.parts.json")
+
+    def part_path(self, part: int) -> Path:
+        return self.output_path.with_name(f"{self.output_path.name}.part{part}")
+
+    def part_size(self, part: int) -> int:
+        part_path = self.part_path(part)
+        return part_path.stat().st_size if part_path.is_file() else 0
+
+    def get(self, headers: dict) -> object:
+        """Function to request the package, with a fresh download url if the current one is refused.
+
+        Args:
+            headers (dict): Headers of the request, e.g. the requested byte range.
+
+        Returns:
+            object: The response with an open body stream.
+        """
+        url = self.url
+
+        for attempt in range(2):
+            response = self.session.get(
+                url, headers=headers, stream=True, timeout=self.timeout
+            )
+            if not 400 <= response.status_code < 500:
+                response.raise_for_status()
+                return response
+
+            response.close()
+            # the uid has been used already, every refused request gets its own one
+            if not attempt:
+                url = self.url_factory()
+                with self.lock:
+                    self.url = url
+
+        self.refused = True
+        raise PackageDownloadError(
+            f"The server refused a fresh download url with status {response.status_code}."
+        )
+
+    def probe(self) -> tuple:
+        """Function to find out the size of the package and if the server answers range requests.
+
+        Returns:
+            tuple: Size in bytes or None if unknown, True if ranges are supported, ETag or last modification of the package.
+        """
+        with self.get({"Range": "bytes=0-0"}) as response:
+            validator = response.headers.get("ETag") or response.headers.get(
+                "Last-Modified"
+            )
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+
+            if response.status_code == 206 and total.isdigit() and int(total):
+                return int(total), True, validator
+
+            size = int(response.headers.get("Content-Length", 0))
+            return size or None, False, validator
+
+    def plan(self, size: int, ranges: bool, validator: str) -> list:
+        """Function to split the package into parts or load the parts of an interrupted download.
+
+        Args:
+            size (int): Size of the package in bytes or None if unknown.
+            ranges (bool): True if the server answers range requests.
+            validator (str): ETag or last modification of the package.
+
+        Returns:
+            list: First and last byte of every part, the last byte is None if the size is unknown.
+        """
+        try:
+            with open(self.state_path, "r") as state_file:
+                state = json.load(state_file)
+            # parts can only be continued if the package has not changed
+            if ranges and state["size"] == size and state["validator"] == validator:
+                return [tuple(part) for part in state["parts"]]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError, TypeError):
+            pass
+
+        self.remove_parts()
+
+        if ranges:
+            part_length = math.ceil(size / max(min(self.parts, size), 1))
+            parts = [
+                (start, min(start + part_length, size) - 1)
+                for start in range(0, size, part_length)
+            ]
+        else:
+            parts = [(0, size - 1 if size else None)]
+
+        with open(self.state_path, "w") as state_file:
+            json.dump({"size": size, "validator": validator, "parts": parts}, state_file)
+
+        return parts
+
+    def remove_parts(self) -> None:
+        """Function to remove the part files and the layout of an earlier download."""
+        for part_path in self.output_path.parent.glob(f"{self.output_path.name}.part*"):
+            part_path.unlink()
+        self.state_path.unlink(missing_ok=True)
+
+    def download_part(
+        self,
+        part: int,
+        start: int,
+        end: int,
+        ranges: bool,
+        progress_bar: object,
+    ) -> None:
+        """Function to download the missing bytes of a single part.
+        Lost connections are retried, with range support the part continues where it stopped.
+
+        Args:
+            part (int): Number of the part.
+            start (int): First byte of the part.
+            end (int): Last byte of the part, None if the size is unknown.
+            ranges (bool): True if the server answers range requests.
+            progress_bar (object): Progress bar of the download.
+        """
+        part_path = self.part_path(part)
+        error = None
+
+        for attempt in range(self.retries + 1):
+            done = self.part_size(part)
+
+            # without range support the part has to start from the beginning
+            if done and not ranges:
+                self.update(progress_bar, -done)
+                done = 0
+            if end is not None and start + done > end:
+                return
+
+            headers = {"Range": f"bytes={start + done}-{end}"} if ranges else {}
+
+            try:
+                with self.get(headers) as response:
+                    if ranges and response.status_code != 206:
+                        raise PackageDownloadError(
+                            f"The server did not answer the range request of part {part}."
+                        )
+
+                    with open(part_path, "ab" if done else "wb") as part_file:
+                        for chunk in response.iter_content(chunk_size=self.chunk_size):
+                            part_file.write(chunk)
+                            self.update(progress_bar, len(chunk))
+
+                if end is None or self.part_size(part) == end - start + 1:
+                    return
+            except RequestException as request_error:
+                error = request_error
+
+            if attempt < self.retries:
+                tqdm.write(
+                    f"{datetime.datetime.now().strftime('%H:%M:%S')}: Connection of part {part} lost, resuming download."
+                )
+                time.sleep(self.retry_delay * 2**attempt)
+
+        raise PackageDownloadError(
+            f"Part {part} could not be downloaded completely."
+        ) from error
+
+    def update(self, progress_bar: object, n: int) -> None:
+        with self.lock:
+            progress_bar.update(n)
+
+    def join(self, parts: list) -> None:
+        """Function to join the parts into the output file and remove them."""
+        with open(self.output_path, "wb") as output_file:
+            for part in range(len(parts)):
+                with open(self.part_path(part), "rb") as part_file:
+                    shutil.copyfileobj(part_file, output_file, self.chunk_size)
+
+        self.remove_parts()
+
+    def verify(self, size: int) -> None:
+        """Function to check the size of the downloaded package and its parquet footer.
+        A package that fails the check is removed, so the next run downloads it again.
+
+        Args:
+            size (int): Size announced by the server, None if unknown.
+        """
+        try:
+            if size is not None and self.output_path.stat().st_size != size:
+                raise PackageDownloadError(
+                    f"Expected {size} bytes, but {self.output_path.stat().st_size} bytes were downloaded."
+                )
+            pq.read_metadata(self.output_path)
+        except PackageDownloadError:
+            self.output_path.unlink()
+            raise
+        except Exception as error:
+            self.output_path.unlink()
+            raise PackageDownloadError(
+                f"The downloaded package is not a valid parquet file: {error}"
+            ) from error
+
+    def download_parts(
+        self, parts: list, size: int, ranges: bool, description: str
+    ) -> None:
+        """Function to download all parts at the same time.
+
+        Args:
+            parts (list): First and last byte of every part.
+            size (int): Size of the package in bytes or None if unknown.
+            ranges (bool): True if the server answers range requests.
+            description (str): Description of the progress bar.
+        """
+        downloaded = sum(self.part_size(part) for part in range(len(parts))) if ranges else 0
+
+        if downloaded:
+            tqdm.write(
+                f"{datetime.datetime.now().strftime('%H:%M:%S')}: Resuming the download of {self.output_path.name}."
+            )
+
+        with tqdm(
+            total=size,
+            initial=downloaded,
+            unit="B",
+            unit_scale=True,
+            miniters=1,
+            desc=description,
+        ) as progress_bar, ThreadPoolExecutor(max_workers=len(parts)) as executor:
+            futures = [
+                executor.submit(
+                    self.download_part, part, start, end, ranges, progress_bar
+                )
+                for part, (start, end) in enumerate(parts)
+            ]
+            # all parts are finished before an error is raised, so they can be resumed
+            for future in futures:
+                future.result()
+
+    def run(
+        self, url_factory: object, description: str = "Downloading public database"
+    ) -> Path:
+        """Function to download the package, continuing an interrupted download.
+
+        Args:
+            url_factory (callable): Function that returns a fresh download url of the package.
+            description (str, optional): Description of the progress bar. Defaults to "Downloading public database".
+
+        Returns:
+            Path: Path to the downloaded and verified package.
+        """
+        self.url_factory, self.url, self.refused = url_factory, url_factory(), False
+
+        # a refused range request is downloaded over a single connection
+        try:
+            size, ranges, validator = self.probe()
+        except PackageDownloadError:
+            size, ranges, validator = None, False, None
+
+        parts = self.plan(size, ranges, validator)
+
+        try:
+            self.download_parts(parts, size, ranges, description)
+        except PackageDownloadError:
+            if not ranges or not self.refused:
+                raise
+            tqdm.write(
+                f"{datetime.datetime.now().strftime('%H:%M:%S')}: The server refused the range requests, downloading over a single connection."
+            )
+            ranges, self.refused = False, False
+            parts = self.plan(size, ranges, validator)
+            self.download_parts(parts, size, ranges, description)
+
+        self.join(parts)
+        self.verify(size)
+
+        return self.output_path
@@ -0,0 +1,154 @@
+import datetime, duckdb
+import pandas as pd
+from pathlib import Path
+from tqdm import tqdm
+from boldigger3 import add_metadata, select_top_hit
+from boldigger3.id_engine import build_combinations
+
+
+class ResultPipeline:
+    """A class to add the metadata and select the top hits of every batch as soon as it
+    has been downloaded, while the id engine is still working on the other batches.
+
+    The download scheduler hands every saved batch to the pipeline. The metadata of its
+    hits is looked up for the final_results view and the top hits of its ids are
+    written to a buffer of the pipeline. Once the download has finished, only the hits
+    that could not be processed on the way are left, e.g. after an interruption. The
+    outputs are the same as if the stages had run one after another.
+
+    Attributes
+    ----------
+    fasta_path (Path): Path to the fasta file that is identified.
+    metadata_db_path (Path): Path to the metadata database.
+    thresholds (list): Thresholds for the top hit selection.
+    combinations (list): Database and operating mode tuples that are identified.
+    """
+
+    def __init__(
+        self,
+        fasta_path: str,
+        metadata_db_path: str,
+        thresholds: list,
+        database,
+        operating_mode,
+    ):
+        self.fasta_path = Path(fasta_path)
+        self.metadata_db_path = Path(metadata_db_path)
+        self.thresholds = thresholds
+        self.combinations = build_combinations(database, operating_mode)
+        self.fasta_name = self.fasta_path.stem
+        self.data_dir = self.fasta_path.parent.joinpath("boldigger3_data")
+
+    def buffer_paths(self) -> list:
+        """Function to find the top hit buffers of the pipeline for all combinations.
+
+        Returns:
+            list: Paths of the buffers.
+        """
+        return [
+            buffer_path
+            for combination in self.combinations
+            for buffer_path in self.data_dir.glob(
+                "{}_top_hit_buffer_pipeline_*.parquet.snappy".format(
+                    select_top_hit.build_output_name(
+                        self.fasta_name, combination, self.combinations
+                    )
+                )
+            )
+        ]
+
+    def reset(self) -> None:
+        """Function to remove the buffers of an interrupted run, their hits are selected again."""
+        for buffer_path in self.buffer_paths():
+            buffer_path.unlink()
+
+    def open(self, connection: object) -> None:
+        """Function to prepare the connection of the download writer for the pipeline.
+
+        Args:
+            connection (object): Connection to the project database.
+        """
+        add_metadata.attach_metadata(connection, self.metadata_db_path)
+
+    def close(self, connection: object) -> None:
+        connection.execute("DETACH DATABASE IF EXISTS metadata")
+
+    def process(
+        self, connection: object, bold_request: object, batch: object
+    ) -> None:
+        """Function to add the metadata to a downloaded batch and select its top hits.
+
+        Args:
+            connection (object): Connection to the project database with the metadata attached.
+            bold_request (object): The downloaded request.
+            batch (object): Arrow table with the parsed hits of the request.
+        """
+        combination = (bold_request.database, bold_request.operating_mode)
+        if combination not in self.combinations or not batch.num_rows:
+            return
+
+        connection.register("batch", batch)
+
+        try:
+            add_metadata.merge_batch(connection, "batch")
+            hits = connection.execute(
+                """
+                SELECT * FROM final_results
+                WHERE fasta_order BETWEEN (SELECT min(fasta_order) FROM batch) AND (SELECT max(fasta_order) FROM batch)
+                AND database = ? AND operating_mode = ?
+                AND id IN (SELECT id FROM batch)
+                ORDER BY fasta_order ASC, pct_identity DESC, hit_order ASC
+                """,
+                list(combination),
+            ).df()
+        finally:
+            connection.unregister("batch")
+
+        top_hits = pd.concat(
+            [
+                select_top_hit.find_top_hit(hits_for_id, self.thresholds)
+                for hits_for_id in select_top_hit.split_hit_groups(
+                    select_top_hit.clean_dataframe(hits)
+                )
+            ],
+            axis=0,
+        ).reset_index(drop=True)
+
+        output_name = select_top_hit.build_output_name(
+            self.fasta_name, combination, self.combinations
+        )
+        # request ids start again with every round, the first fasta order is unique per combination
+        top_hits.to_parquet(
+            self.data_dir.joinpath(
+                "{}_top_hit_buffer_pipeline_{:012d}.parquet.snappy".format(
+                    output_name, int(top_hits["fasta_order"].min())
+                )
+            )
+        )
+
+    def finish(self, engine: str = "pandas", workers: int = 1) -> None:
+        """Function to process everything that has been left over and save the results.
+
+        Args:
+            engine (str, optional): Engine for the top hits that are left. Defaults to "pandas".
+            workers (int, optional): Number of processes for the top hits that are left. Defaults to 1.
+        """
+        tqdm.write(
+            f"{datetime.datetime.now().strftime('%H:%M:%S')}: Adding metadata to the remaining ID engine results."
+        )
+
+        with duckdb.connect(self.data_dir.joinpath(f"{self.fasta_name}.duckdb")) as connection:
+            self.open(connection)
+            try:
+                add_metadata.merge_missing_results(connection)
+            finally:
+                self.close(connection)
+
+        select_top_hit.main(
+            fasta_path=self.fasta_path,
+            thresholds=self.thresholds,
+            engine=engine,
+            workers=workers,
+            combinations=self.combinations,
+            pipelined=True,
+        )
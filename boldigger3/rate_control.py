@@ -0,0 +1,153 @@
+import json, threading
+from pathlib import Path
+
+# the learned pacing is shared by all projects of a user
+RATE_STATE_PATH = Path.home().joinpath(".boldigger3", "rate_control.json")
+
+
+class RateController:
+    """A class to pace the submissions to the BOLD id engine.
+
+    The submission rate and the number of active requests are adjusted with
+    additive-increase/multiplicative-decrease: both grow a little with every request that
+    finishes in time and are cut whenever the id engine answers with "Limit reached" or
+    the completion latency rises well above the best latency seen so far. The learned
+    values are persisted, so the next run starts where the last one stopped.
+
+    Attributes
+    ----------
+    rate (float): Submissions per minute.
+    window (float): Number of requests that may be active at the same time.
+    baseline_latency (float): Lowest recent completion latency in seconds.
+    """
+
+    def __init__(
+        self,
+        state_path: Path = None,
+        rate: float = 2.0,
+        window: float = 10.0,
+        min_rate: float = 0.1,
+        max_rate: float = 30.0,
+        min_window: float = 1.0,
+        max_window: float = 25.0,
+        rate_increase: float = 0.5,
+        decrease_factor: float = 0.5,
+        latency_tolerance: float = 2.0,
+        latency_drift: float = 0.05,
+    ):
+        """Constructs the neccessary attributes for the RateController object
+
+        Args:
+            state_path (Path, optional): File to persist the learned values to. Defaults to None (not persisted).
+            rate (float, optional): Initial submissions per minute. Defaults to 2.0.
+            window (float, optional): Initial number of active requests. Defaults to 10.0.
+            min_rate (float, optional): Lowest allowed submission rate. Defaults to 0.1.
+            max_rate (float, optional): Highest allowed submission rate. Defaults to 30.0.
+            min_window (float, optional): Lowest allowed number of active requests. Defaults to 1.0.
+            max_window (float, optional): Highest allowed number of active requests. Defaults to 25.0.
+            rate_increase (float, optional): Additive rate increase per completed request. Defaults to 0.5.
+            decrease_factor (float, optional): Multiplicative decrease on a limit response. Defaults to 0.5.
+            latency_tolerance (float, optional): Latency relative to the baseline that counts as congestion. Defaults to 2.0.
+            latency_drift (float, optional): Relative increase of the baseline per completed request. Defaults to 0.05.
+        """
+        self.state_path = state_path
+        self.rate = rate
+        self.window = window
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.min_window = min_window
+        self.max_window = max_window
+        self.rate_increase = rate_increase
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.latency_drift = latency_drift
+        self.baseline_latency = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, state_path: Path, **kwargs) -> "RateController":
+        """Function to create a rate controller from a previously persisted state.
+
+        Args:
+            state_path (Path): File the learned values have been persisted to.
+
+        Returns:
+            RateController: Controller starting from the persisted values or the defaults.
+        """
+        controller = cls(state_path=state_path, **kwargs)
+
+        try:
+            with open(state_path, "r") as state_file:
+                state = json.load(state_file)
+            controller.rate = controller.clamp_rate(float(state["rate"]))
+            controller.window = controller.clamp_window(float(state["window"]))
+            controller.baseline_latency = state.get("baseline_latency")
+        except (FileNotFoundError, json.JSONDecodeError, KeyError, TypeError, ValueError):
+            # start with the defaults if nothing has been learned yet
+            pass
+
+        return controller
+
+    def save(self) -> None:
+        """Function to persist the learned values."""
+        if self.state_path is None:
+            return
+
+        with self.lock:
+            state = {
+                "rate": self.rate,
+                "window": self.window,
+                "baseline_latency": self.baseline_latency,
+            }
+
+        Path(self.state_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(self.state_path, "w") as state_file:
+            json.dump(state, state_file)
+
+    def clamp_rate(self, rate: float) -> float:
+        return min(max(rate, self.min_rate), self.max_rate)
+
+    def clamp_window(self, window: float) -> float:
+        return min(max(window, self.min_window), self.max_window)
+
+    @property
+    def interval(self) -> float:
+        """Seconds to wait between two submissions."""
+        return 60 / self.rate
+
+    @property
+    def active_window(self) -> int:
+        """Number of requests that may currently be active."""
+        return int(self.window)
+
+    def on_limit_reached(self) -> None:
+        """Function to back off after the id engine answered with a limit response."""
+        with self.lock:
+            self.rate = self.clamp_rate(self.rate * self.decrease_factor)
+            self.window = self.clamp_window(self.window * self.decrease_factor)
+        self.save()
+
+    def on_completed(self, latency: float) -> None:
+        """Function to adapt the pacing to the latency of a completed request.
+
+        Args:
+            latency (float): Seconds between submission and download of the request.
+        """
+        with self.lock:
+            # the baseline slowly drifts upwards, so old values do not block increases forever
+            if self.baseline_latency is None:
+                self.baseline_latency = latency
+            else:
+                self.baseline_latency = min(
+                    latency, self.baseline_latency * (1 + self.latency_drift)
+                )
+
+            # a much slower request indicates a saturated server, back off smoothly
+            if latency > self.latency_tolerance * self.baseline_latency:
+                self.rate = self.clamp_rate(self.rate * (1 + self.decrease_factor) / 2)
+                self.window = self.clamp_window(
+                    self.window * (1 + self.decrease_factor) / 2
+                )
+            else:
+                self.rate = self.clamp_rate(self.rate + self.rate_increase)
+                self.window = self.clamp_window(self.window + 1 / self.window)
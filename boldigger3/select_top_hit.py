@@ -1,13 +1,29 @@
-import duckdb, datetime, more_itertools, re, time
+import duckdb, datetime, re, time, hashlib, json
 import pandas as pd
-import dask.dataframe as dd
+import pyarrow as pa
 import numpy as np
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from boldigger3.id_engine import parse_fasta
 from string import punctuation, digits
 
 
+def invalid_characters_pattern() -> str:
+    """Function to build the regex that matches taxon names with invalid characters.
+    Some species names contain a "-", so it is the only punctuation that is allowed.
+
+    Returns:
+        str: Character class matching all punctuation and digits except '-'.
+    """
+    specials = re.escape("".join(c for c in punctuation + digits if c != "-"))
+
+    return f"[{specials}]"
+
+
 def clean_dataframe(dataframe: object) -> object:
+    # the order of the hits is only needed to sort them
+    dataframe = dataframe.drop(columns="hit_order", errors="ignore")
+
     # replace missing values and empty strings in metadata to pd.NA
     metadata_columns = [
         "processid",
@@ -21,14 +37,17 @@ def clean_dataframe(dataframe: object) -> object:
         "nuc",
         "marker_code",
     ]
+    # the coordinates are already split into lat and lon by the final_results view
+    metadata_columns = [
+        column for column in metadata_columns if column in dataframe.columns
+    ]
 
     # clean na values
     dataframe[metadata_columns] = dataframe[metadata_columns].replace(
         [None, "None", ""], pd.NA
     )
     # remove all punctuation and digits except '-', some species names contain a "-"
-    specials = re.escape("".join(c for c in punctuation + digits if c != "-"))
-    pattern = f"[{specials}]"
+    pattern = invalid_characters_pattern()
 
     # Levels to clean
     levels = ["phylum", "class", "order", "family", "genus", "species"]
@@ -52,16 +71,23 @@ def clean_dataframe(dataframe: object) -> object:
     object_columns = dataframe.select_dtypes(include="object").columns
     dataframe[object_columns] = dataframe[object_columns].astype("string")
 
-    try:
-        # extract the lat lon values
-        dataframe[["lat", "lon"]] = (
-            dataframe["coord"].str.strip("[]").str.split(",", expand=True)
-        )
-        dataframe["lat"], dataframe["lon"] = dataframe["lat"].astype(
-            "float"
-        ), dataframe["lon"].astype("float")
-    except ValueError:
-        dataframe["lat"], dataframe["lon"] = np.nan, np.nan
+    if "coord" not in dataframe.columns:
+        dataframe = dataframe.astype({"lat": "float", "lon": "float"})
+        return dataframe
+
+    # extract the lat lon values, a malformed coordinate only affects its own row
+    coordinates = (
+        dataframe["coord"]
+        .str.strip("[]")
+        .str.split(",", n=1, expand=True)
+        .reindex(columns=[0, 1])
+    )
+    dataframe["lat"], dataframe["lon"] = [
+        pd.to_numeric(
+            coordinates[column].astype("string").str.strip(), errors="coerce"
+        ).astype("float")
+        for column in (0, 1)
+    ]
 
     # drop coord column
     dataframe = dataframe.drop("coord", axis=1)
@@ -69,30 +95,145 @@ def clean_dataframe(dataframe: object) -> object:
     return dataframe
 
 
-def stream_hits_to_excel(id_engine_db_path, project_directory, fasta_dict, fasta_name):
-    # chunk the fasta dicts keys to retrieve from duckdb
-    chunks = enumerate(more_itertools.chunked(fasta_dict.keys(), n=8_000), start=1)
+def duplicate_map(fasta_index) -> pd.DataFrame:
+    """Function to map every id of the fasta file to the id its hits were downloaded for.
+
+    Args:
+        fasta_index (FastaIndex): Index of the fasta file.
+
+    Returns:
+        pd.DataFrame: Dataframe with the columns id, fasta_order and representative in fasta order.
+    """
+    return pd.DataFrame(
+        {
+            "id": fasta_index.ids,
+            "fasta_order": np.arange(len(fasta_index)),
+            "representative": fasta_index.representative_ids(),
+        }
+    )
+
+
+def hit_order_column(connection: object) -> str:
+    """Function to find the column that keeps the order of hits with the same similarity.
+    The final_results view exposes it as hit_order, tables of earlier versions keep it in their rowid.
+
+    Args:
+        connection (object): Duckdb connection holding final_results.
+
+    Returns:
+        str: Name of the column.
+    """
+    hit_order = connection.execute(
+        """
+        SELECT count(*) FROM information_schema.columns
+        WHERE table_name = 'final_results' AND column_name = 'hit_order'
+        AND table_catalog = current_database() AND table_schema = current_schema()
+        """
+    ).fetchone()[0]
+
+    return "hit_order" if hit_order else "rowid"
+
+
+def combination_filter(combination: tuple = None, table: str = "final_results") -> str:
+    """Function to build the SQL condition that restricts the hits to one database and operating mode.
+
+    Args:
+        combination (tuple, optional): Database and operating mode. Defaults to None (all hits).
+        table (str, optional): Name of the table in the query. Defaults to "final_results".
+
+    Returns:
+        str: SQL condition.
+    """
+    if combination is None:
+        return "true"
+
+    database, operating_mode = combination
+
+    return f"{table}.database = {int(database)} AND {table}.operating_mode = {int(operating_mode)}"
+
+
+def part_fingerprint(chunk: pd.DataFrame, fasta_index, combination=None) -> str:
+    """Function to fingerprint the content of one part of the hit export.
+    The hits of an id only change with its sequence, database and operating mode.
+
+    Args:
+        chunk (pd.DataFrame): Ids of the part with their fasta order.
+        fasta_index (FastaIndex): Index of the fasta file.
+        combination (tuple, optional): Database and operating mode. Defaults to None (all hits).
+
+    Returns:
+        str: Hex digest of the ids, their sequence hashes and the combination.
+    """
+    fingerprint = hashlib.blake2b(digest_size=16)
+    fingerprint.update(repr(combination).encode("utf-8"))
+    fingerprint.update("\n".join(chunk["id"]).encode("utf-8"))
+    fingerprint.update(
+        np.ascontiguousarray(
+            fasta_index.records["seq_hash"][chunk["fasta_order"].to_numpy()]
+        ).tobytes()
+    )
+
+    return fingerprint.hexdigest()
+
+
+def stream_hits_to_excel(
+    id_engine_db_path, project_directory, fasta_index, fasta_name, combination=None
+):
+    # chunk the ids to retrieve from duckdb, duplicates receive the hits of their representative
+    id_map = duplicate_map(fasta_index)
+    chunks = enumerate(
+        (id_map.iloc[start : start + 8_000] for start in range(0, len(id_map), 8_000)),
+        start=1,
+    )
 
     # define the output path
     output_path = project_directory.joinpath("boldigger3_data")
 
+    # parts whose ids and sequences did not change since the last run are kept
+    state_path = output_path.joinpath(f"{fasta_name}_bold_results_parts.json")
+    try:
+        with open(state_path, "r") as state_file:
+            written_parts = json.load(state_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        written_parts = {}
+    fingerprints = {}
+
     with duckdb.connect(id_engine_db_path) as connection:
-        # retrieve one chunk of a maximum of 10_000 process_ids
+        hit_order = hit_order_column(connection)
+
+        # retrieve one chunk of a maximum of 8_000 ids
         for part, chunk in chunks:
-            query = f"""SELECT * FROM final_results 
-            WHERE id IN ?
-            ORDER BY fasta_order ASC, pct_identity DESC"""
-            chunk_data = connection.execute(query, [chunk]).df()
+            part_path = output_path.joinpath(f"{fasta_name}_bold_results_part_{part}.xlsx")
+            fingerprints[str(part)] = part_fingerprint(chunk, fasta_index, combination)
+            if (
+                written_parts.get(str(part)) == fingerprints[str(part)]
+                and part_path.is_file()
+            ):
+                continue
+
+            connection.register("chunk", chunk)
+            query = f"""SELECT final_results.* REPLACE (chunk.id AS id, chunk.fasta_order AS fasta_order)
+            FROM chunk
+            JOIN final_results ON final_results.id = chunk.representative
+            AND {combination_filter(combination)}
+            ORDER BY chunk.fasta_order ASC, final_results.pct_identity DESC, final_results.{hit_order} ASC"""
+            chunk_data = connection.execute(query).df()
+            connection.unregister("chunk")
             chunk_data = clean_dataframe(chunk_data)
 
             # drop the fasta order just before saving
             chunk_data = chunk_data.drop("fasta_order", axis=1)
 
-            chunk_data.to_excel(
-                output_path.joinpath(f"{fasta_name}_bold_results_part_{part}.xlsx"),
-                index=False,
-                engine="xlsxwriter",
-            )
+            chunk_data.to_excel(part_path, index=False, engine="xlsxwriter")
+
+    # remove parts that are left over from a longer fasta file
+    for part in written_parts.keys() - fingerprints.keys():
+        output_path.joinpath(f"{fasta_name}_bold_results_part_{part}.xlsx").unlink(
+            missing_ok=True
+        )
+
+    with open(state_path, "w") as state_file:
+        json.dump(fingerprints, state_file)
 
 
 def get_threshold(hit_for_id: object, thresholds: list) -> object:
@@ -391,58 +532,663 @@ def find_top_hit(hits_for_id: object, thresholds: list) -> object:
     return final_top_hit
 
 
+def flush_top_hits(
+    top_hits_buffer: list,
+    project_directory,
+    fasta_name: str,
+    buffer_counter: int,
+    shard: int = 0,
+) -> None:
+    """Function to spill the buffered top hits to a parquet file.
+    The file names are zero padded, so sorting them by name restores the fasta order.
+
+    Args:
+        top_hits_buffer (list): List of single line top hit dataframes.
+        project_directory (Path): Project directory to work in.
+        fasta_name (str): Name of the fasta file that was identified.
+        buffer_counter (int): Number of the buffer, used to name the file.
+        shard (int, optional): Number of the fasta order range the buffer belongs to. Defaults to 0.
+    """
+    parquet_output = project_directory.joinpath(
+        "boldigger3_data",
+        f"{fasta_name}_top_hit_buffer_{shard:05d}_{buffer_counter:06d}.parquet.snappy",
+    )
+    top_hits_buffer = pd.concat(top_hits_buffer, axis=0).reset_index(drop=True)
+    top_hits_buffer.to_parquet(parquet_output)
+
+
 def gather_top_hits(
-    fasta_dict, id_engine_db_path, project_directory, fasta_name, thresholds
+    fasta_dict,
+    id_engine_db_path,
+    project_directory,
+    fasta_name,
+    thresholds,
+    combination=None,
+    selected_only=False,
 ):
     # store top hits here until n are reached, flush to parquet inbetween
     top_hits_buffer = []
     buffer_counter = 0
 
+    # only scan the ids of the fasta dict, e.g. the ids that are new since the last run
+    fasta_orders = list(fasta_dict.values()) if selected_only else None
+
     with duckdb.connect(id_engine_db_path) as connection:
-        # extract the data per query from duckdb
-        for query in tqdm(fasta_dict.keys(), desc="Top hit calculation"):
-            sql_query = f"SELECT * FROM final_results WHERE id='{query}' ORDER BY fasta_order ASC, pct_identity DESC"
-            query = clean_dataframe(connection.execute(sql_query).df())
+        # final_results joins the metadata, so the hits of all ids are read in a single ordered scan
+        for query in tqdm(
+            iter_hit_groups(
+                connection, combination=combination, fasta_orders=fasta_orders
+            ),
+            total=len(fasta_dict),
+            desc="Top hit calculation",
+        ):
             # find the top hit
             top_hits_buffer.append(find_top_hit(query, thresholds))
             # spill to parquet whenever there are 1k hits in the buffer, ingest parquet later for saving
             if len(top_hits_buffer) >= 1_000:
-                parquet_output = project_directory.joinpath(
-                    "boldigger3_data",
-                    f"{fasta_name}_top_hit_buffer_{buffer_counter}.parquet.snappy",
+                flush_top_hits(
+                    top_hits_buffer, project_directory, fasta_name, buffer_counter
                 )
-                top_hits_buffer = pd.concat(top_hits_buffer, axis=0).reset_index(
-                    drop=True
+                buffer_counter += 1
+                top_hits_buffer = []
+
+        # final buffer flush
+        if top_hits_buffer:
+            flush_top_hits(top_hits_buffer, project_directory, fasta_name, buffer_counter)
+
+
+def iter_hit_groups(
+    connection: object,
+    batch_size: int = 50_000,
+    fasta_order_range: tuple = None,
+    combination: tuple = None,
+    fasta_orders: list = None,
+):
+    """Generator that scans final_results once in fasta order and yields the hits per id.
+    The table is read as arrow record batches. Groups that span two batches are carried
+    over to the next batch as zero-copy slices.
+
+    Args:
+        connection (object): Duckdb connection holding the final_results table.
+        batch_size (int, optional): Number of rows per record batch. Defaults to 50_000.
+        fasta_order_range (tuple, optional): First and last fasta order to scan. Defaults to None (all).
+        combination (tuple, optional): Database and operating mode to scan. Defaults to None (all).
+        fasta_orders (list, optional): Fasta orders of the ids to scan. Defaults to None (all).
+
+    Yields:
+        object: Cleaned dataframe with all hits of a single id.
+    """
+    if fasta_order_range is None:
+        fasta_order_range = (0, np.iinfo(np.int64).max)
+
+    # restrict the scan to selected ids, their range lets duckdb skip the rest of the table
+    selection = "true"
+    if fasta_orders is not None:
+        fasta_order_range = (min(fasta_orders, default=0), max(fasta_orders, default=-1))
+        connection.register(
+            "selected_orders", pd.DataFrame({"fasta_order": fasta_orders}, dtype="int64")
+        )
+        selection = "fasta_order IN (SELECT fasta_order FROM selected_orders)"
+
+    reader = connection.execute(
+        f"""SELECT * FROM final_results
+        WHERE fasta_order BETWEEN ? AND ? AND {combination_filter(combination)}
+        AND {selection}
+        ORDER BY fasta_order ASC, pct_identity DESC, {hit_order_column(connection)} ASC""",
+        list(fasta_order_range),
+    ).to_arrow_reader(batch_size)
+
+    carry = []
+
+    # the reader is closed even if the scan is not consumed completely
+    with reader:
+        for batch in reader:
+            if batch.num_rows == 0:
+                continue
+
+            # find the positions where a new id starts
+            fasta_order = batch.column("fasta_order").to_numpy()
+            boundaries = np.flatnonzero(fasta_order[1:] != fasta_order[:-1]) + 1
+
+            # the last group might continue in the next batch, hold it back
+            if not boundaries.size:
+                carry.append(batch)
+                continue
+
+            last_start = boundaries[-1]
+            complete = pa.Table.from_batches(carry + [batch.slice(0, last_start)])
+            carry = [batch.slice(last_start)]
+
+            # clean the complete groups at once, then split them into single ids
+            yield from split_hit_groups(clean_dataframe(complete.to_pandas()))
+
+    # the last group is always complete after the scan has finished
+    if carry:
+        yield from split_hit_groups(
+            clean_dataframe(pa.Table.from_batches(carry).to_pandas())
+        )
+
+
+def split_hit_groups(hits: object):
+    """Generator to split a dataframe that is sorted by fasta order into the hits per id.
+
+    Args:
+        hits (object): Dataframe sorted by fasta order.
+
+    Yields:
+        object: Dataframe with all hits of a single id.
+    """
+    fasta_order = hits["fasta_order"].to_numpy()
+    starts = np.flatnonzero(np.r_[True, fasta_order[1:] != fasta_order[:-1]])
+    ends = np.r_[starts[1:], len(fasta_order)]
+
+    for start, end in zip(starts, ends):
+        yield hits.iloc[start:end]
+
+
+def gather_top_hits_range(
+    id_engine_db_path,
+    project_directory,
+    fasta_name,
+    thresholds,
+    shard,
+    fasta_order_range,
+    combination=None,
+    fasta_orders=None,
+) -> int:
+    """Function to calculate the top hits for a contiguous range of the fasta order.
+    Runs in a worker process, opens the database read-only and writes its own parquet shards.
+
+    Args:
+        id_engine_db_path (Path): Path to the id engine database.
+        project_directory (Path): Project directory to work in.
+        fasta_name (str): Name of the fasta file that was identified.
+        thresholds (list): List of thresholds to perform the top hit selection with.
+        shard (int): Number of the range, used to name the output files.
+        fasta_order_range (tuple): First and last fasta order of the range.
+        combination (tuple, optional): Database and operating mode. Defaults to None (all hits).
+        fasta_orders (list, optional): Fasta orders of the ids to select in this range. Defaults to None (all).
+
+    Returns:
+        int: Number of top hits calculated in this range.
+    """
+    # store top hits here until n are reached, flush to parquet inbetween
+    top_hits_buffer = []
+    buffer_counter = 0
+    calculated_hits = 0
+
+    with duckdb.connect(id_engine_db_path, read_only=True) as connection:
+        for hits in iter_hit_groups(
+            connection,
+            fasta_order_range=fasta_order_range,
+            combination=combination,
+            fasta_orders=fasta_orders,
+        ):
+            top_hits_buffer.append(find_top_hit(hits, thresholds))
+            calculated_hits += 1
+            if len(top_hits_buffer) >= 1_000:
+                flush_top_hits(
+                    top_hits_buffer, project_directory, fasta_name, buffer_counter, shard
                 )
-                top_hits_buffer.to_parquet(parquet_output)
                 buffer_counter += 1
                 top_hits_buffer = []
 
         # final buffer flush
         if top_hits_buffer:
-            parquet_output = project_directory.joinpath(
-                "boldigger3_data",
-                f"{fasta_name}_top_hit_buffer_{buffer_counter}.parquet.snappy",
+            flush_top_hits(
+                top_hits_buffer, project_directory, fasta_name, buffer_counter, shard
             )
 
-            top_hits_buffer = pd.concat(top_hits_buffer, axis=0).reset_index(drop=True)
-            top_hits_buffer.to_parquet(parquet_output)
+    return calculated_hits
 
 
-def save_results(project_directory, fasta_name):
-    # load all data into dask dataframe
-    data_paths = project_directory.joinpath("boldigger3_data").glob(
-        f"{fasta_name}_top_hit_buffer_*.parquet.snappy"
+def gather_top_hits_parallel(
+    fasta_dict,
+    id_engine_db_path,
+    project_directory,
+    fasta_name,
+    thresholds,
+    workers,
+    combination=None,
+    selected_only=False,
+):
+    # split the fasta order into one contiguous range per worker
+    chunks = [
+        chunk
+        for chunk in np.array_split(np.fromiter(fasta_dict.values(), int), workers)
+        if chunk.size
+    ]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                gather_top_hits_range,
+                id_engine_db_path,
+                project_directory,
+                fasta_name,
+                thresholds,
+                shard,
+                (int(chunk[0]), int(chunk[-1])),
+                combination,
+                # only scan the ids of the fasta dict, e.g. the ids that are new since the last run
+                chunk.tolist() if selected_only else None,
+            )
+            for shard, chunk in enumerate(chunks)
+        ]
+
+        with tqdm(total=len(fasta_dict), desc="Top hit calculation") as pbar:
+            for future in as_completed(futures):
+                pbar.update(future.result())
+
+
+def build_top_hit_query(
+    thresholds: list,
+    combination: tuple = None,
+    hit_order: str = "rowid",
+    selected_only: bool = False,
+) -> str:
+    """Function to build a set-based SQL query that performs the same top hit selection
+    as find_top_hit for all ids in final_results at once.
+
+    Args:
+        thresholds (list): List of thresholds to perform the top hit selection with.
+        combination (tuple, optional): Database and operating mode to select the top hits for. Defaults to None (all hits).
+        hit_order (str, optional): Column that keeps the order of hits with the same similarity. Defaults to "rowid".
+        selected_only (bool, optional): Only select the fasta orders of the registered selected_orders table. Defaults to False.
+
+    Returns:
+        str: SQL query returning one top hit per id, ordered by fasta order.
+    """
+    # levels from the highest to the lowest taxonomic rank
+    all_levels = ["phylum", "class", "order", "family", "genus", "species"]
+
+    # the rank is the index in the thresholds list, rank 0 = species, rank 5 = phylum
+    rank_levels = all_levels[::-1]
+
+    # clean the levels the same way clean_dataframe does
+    pattern = invalid_characters_pattern().replace("'", "''")
+    cleaned_levels = ",\n".join(
+        f"""CASE WHEN "{level}" IN ('None', '') OR regexp_matches("{level}", '{pattern}')
+            THEN NULL ELSE "{level}" END AS "{level}\""""
+        for level in all_levels
+    )
+
+    # translate the maximum similarity into the starting rank of the threshold walk
+    start_rank = "\n".join(
+        f"WHEN max_identity >= {threshold} THEN {rank}"
+        for rank, threshold in enumerate(thresholds[:5])
+    )
+
+    # table of all ranks with their thresholds and the number of levels to group by
+    ranks = ", ".join(
+        f"({rank}, {threshold}, {6 - rank}, '{rank_levels[rank]}')"
+        for rank, threshold in enumerate(thresholds)
+    )
+
+    # mask all levels below the rank, so grouping by all levels equals grouping by the prefix
+    masked_levels = ",\n".join(
+        f'CASE WHEN r.depth >= {depth} THEN h."{level}" END AS "top_{level}"'
+        for depth, level in enumerate(all_levels, start=1)
     )
-    all_top_hits = dd.read_parquet([str(f) for f in data_paths])
 
-    # order values globally by fasta order, drop afterwards
+    # the selected level is the lowest level that has not been masked
+    selected_taxon = "CASE r.depth {} END".format(
+        " ".join(
+            f'WHEN {depth} THEN h."{level}"'
+            for depth, level in enumerate(all_levels, start=1)
+        )
+    )
+
+    # the top hits are all hits that match the non-na levels of the top group
+    top_hit_filter = " AND ".join(
+        f'(t."top_{level}" IS NULL OR h."{level}" = t."top_{level}")'
+        for level in all_levels
+    )
+
+    # remove information that is lower than the selected level
+    output_levels = ",\n".join(
+        f'CASE WHEN m.rank <= {6 - depth} THEN m."{level}" END AS "{level}"'
+        for depth, level in enumerate(all_levels, start=1)
+    )
+    no_match_levels = ", ".join(f'"{level}"' for level in all_levels)
+    blank_levels = ", ".join(f'NULL AS "{level}"' for level in all_levels)
+    no_match_check = ", ".join(f'"{level}"' for level in all_levels)
+    selection = (
+        "fasta_order IN (SELECT fasta_order FROM selected_orders)"
+        if selected_only
+        else "true"
+    )
+
+    return f"""
+    WITH hits AS (
+        SELECT
+            id,
+            fasta_order,
+            pct_identity,
+            NULLIF(status, '') AS status,
+            NULLIF(bin_uri, '') AS bin_uri,
+            CASE WHEN identification_method IN ('None', '') THEN NULL
+                ELSE identification_method END AS identification_method,
+            {cleaned_levels},
+            row_number() OVER (
+                PARTITION BY fasta_order ORDER BY pct_identity DESC, {hit_order} ASC
+            ) AS hit_rank
+        FROM final_results
+        WHERE {combination_filter(combination)} AND {selection}
+    ),
+    id_summary AS (
+        SELECT fasta_order, no_match, CASE {start_rank} ELSE 5 END AS start_rank
+        FROM (
+            SELECT
+                fasta_order,
+                max(pct_identity) AS max_identity,
+                coalesce(bool_or('no-match' IN ({no_match_check})), false) AS no_match
+            FROM hits
+            GROUP BY fasta_order
+        )
+    ),
+    ranks (rank, threshold, depth, level) AS (VALUES {ranks}),
+    groups AS (
+        SELECT
+            h.fasta_order,
+            r.rank,
+            {masked_levels},
+            count(*) AS records,
+            min(h.hit_rank) AS first_rank
+        FROM hits h
+        JOIN id_summary s ON h.fasta_order = s.fasta_order AND NOT s.no_match
+        JOIN ranks r ON r.rank >= s.start_rank AND h.pct_identity > r.threshold
+        WHERE {selected_taxon} IS NOT NULL
+        GROUP BY ALL
+    ),
+    selected_rank AS (
+        SELECT fasta_order, min(rank) AS rank FROM groups GROUP BY fasta_order
+    ),
+    top_group AS (
+        SELECT
+            *,
+            CAST(records AS DOUBLE) / sum(records) OVER (PARTITION BY fasta_order) AS records_ratio
+        FROM groups
+        JOIN selected_rank USING (fasta_order, rank)
+        QUALIFY row_number() OVER (
+            PARTITION BY fasta_order ORDER BY records DESC, first_rank ASC
+        ) = 1
+    ),
+    top_hit_members AS (
+        SELECT h.*, t.rank, t.records, t.records_ratio
+        FROM top_group t
+        JOIN hits h ON h.fasta_order = t.fasta_order AND {top_hit_filter}
+    ),
+    top_hit_bins AS (
+        SELECT fasta_order, string_agg(bin_uri, '|' ORDER BY first_rank) AS BIN
+        FROM (
+            SELECT fasta_order, bin_uri, min(hit_rank) AS first_rank
+            FROM top_hit_members
+            WHERE rank = 0 AND bin_uri IS NOT NULL
+            GROUP BY fasta_order, bin_uri
+        )
+        GROUP BY fasta_order
+    ),
+    top_hit_rows AS (
+        SELECT
+            *,
+            count(*) OVER w AS top_hit_count,
+            count(identification_method) OVER w AS methods,
+            bool_and(regexp_matches(identification_method, 'BOLD|ID|Tree|BIN')) OVER w AS reverse_bin,
+            bool_and(coalesce(status = 'private', false)) OVER w AS all_private
+        FROM top_hit_members
+        WINDOW w AS (PARTITION BY fasta_order)
+        QUALIFY row_number() OVER (PARTITION BY fasta_order ORDER BY hit_rank) = 1
+    ),
+    resolved AS (
+        SELECT
+            m.id,
+            {output_levels},
+            m.pct_identity,
+            m.status,
+            m.records,
+            m.records_ratio,
+            r.level AS selected_level,
+            coalesce(b.BIN, '') AS BIN,
+            concat_ws(
+                '|',
+                CASE WHEN m.methods > 0 AND m.reverse_bin THEN '1' ELSE '' END,
+                CASE WHEN m.records_ratio < 0.9 THEN '2' ELSE '' END,
+                CASE WHEN m.all_private THEN '3' ELSE '' END,
+                CASE WHEN m.top_hit_count = 1 THEN '4' ELSE '' END,
+                CASE WHEN contains(coalesce(b.BIN, ''), '|') THEN '5' ELSE '' END
+            ) AS flags,
+            m.fasta_order
+        FROM top_hit_rows m
+        JOIN ranks r ON m.rank = r.rank
+        LEFT JOIN top_hit_bins b ON m.fasta_order = b.fasta_order
+    ),
+    no_matches AS (
+        SELECT h.id, {no_match_levels}, h.pct_identity, h.status, h.fasta_order
+        FROM hits h
+        JOIN id_summary s ON h.fasta_order = s.fasta_order AND s.no_match
+        WHERE h.species = 'no-match'
+        QUALIFY row_number() OVER (PARTITION BY h.fasta_order ORDER BY h.hit_rank) = 1
+    ),
+    unresolved AS (
+        SELECT h.id, {blank_levels}, h.pct_identity, h.status, h.fasta_order
+        FROM hits h
+        JOIN id_summary s ON h.fasta_order = s.fasta_order AND NOT s.no_match
+        WHERE h.hit_rank = 1 AND h.fasta_order NOT IN (SELECT fasta_order FROM top_group)
+    )
+    SELECT * FROM resolved
+    UNION ALL BY NAME
+    SELECT
+        *,
+        0 AS records,
+        NULL AS records_ratio,
+        NULL AS selected_level,
+        NULL AS BIN,
+        '||||' AS flags
+    FROM (SELECT * FROM no_matches UNION ALL SELECT * FROM unresolved)
+    ORDER BY fasta_order
+    """
+
+
+def select_top_hits_duckdb(
+    connection: object,
+    thresholds: list,
+    combination: tuple = None,
+    fasta_orders: list = None,
+) -> object:
+    """Function to run the set-based top hit selection on an open duckdb connection.
+
+    Args:
+        connection (object): Duckdb connection holding the final_results table.
+        thresholds (list): List of thresholds to perform the top hit selection with.
+        combination (tuple, optional): Database and operating mode to select the top hits for. Defaults to None (all hits).
+        fasta_orders (list, optional): Fasta orders of the ids to select the top hits for. Defaults to None (all).
+
+    Returns:
+        object: Dataframe with one top hit per id in the same layout as find_top_hit.
+    """
+    if fasta_orders is not None:
+        connection.register(
+            "selected_orders", pd.DataFrame({"fasta_order": fasta_orders}, dtype="int64")
+        )
+
+    top_hits = connection.execute(
+        build_top_hit_query(
+            thresholds,
+            combination,
+            hit_order_column(connection),
+            selected_only=fasta_orders is not None,
+        )
+    ).df()
+
+    # use the same types as the pandas engine
+    string_columns = [
+        "id",
+        "phylum",
+        "class",
+        "order",
+        "family",
+        "genus",
+        "species",
+        "status",
+        "selected_level",
+        "BIN",
+        "flags",
+    ]
+    top_hits[string_columns] = top_hits[string_columns].astype("string")
+    top_hits = top_hits.astype(
+        {
+            "pct_identity": "float64",
+            "records": "int64",
+            "records_ratio": "float64",
+            "fasta_order": "int64",
+        }
+    )
+
+    return top_hits
+
+
+def gather_top_hits_duckdb(
+    id_engine_db_path,
+    project_directory,
+    fasta_name,
+    thresholds,
+    combination=None,
+    fasta_orders=None,
+):
+    with duckdb.connect(id_engine_db_path) as connection:
+        top_hits = select_top_hits_duckdb(
+            connection, thresholds, combination, fasta_orders
+        )
+
+    # write a single buffer, so the results can be saved the same way as for the pandas engine
+    flush_top_hits([top_hits], project_directory, fasta_name, 0)
+
+
+def fan_out_duplicates(top_hits: pd.DataFrame, fasta_index) -> pd.DataFrame:
+    """Function to copy the top hit of every representative to all ids with the same sequence.
+
+    Args:
+        top_hits (pd.DataFrame): Top hits of the representative ids in fasta order.
+        fasta_index (FastaIndex): Index of the fasta file.
+
+    Returns:
+        pd.DataFrame: One top hit per id of the fasta file in fasta order.
+    """
+    # nothing to do if all sequences are unique
+    if len(fasta_index.unique_ids()) == len(fasta_index):
+        return top_hits
+
+    columns = top_hits.columns
+    top_hits = top_hits.drop("fasta_order", axis=1).rename(
+        columns={"id": "representative"}
+    )
+
+    # the merge keeps the order of the id map, which is the fasta order
+    top_hits = duplicate_map(fasta_index).merge(
+        top_hits, on="representative", how="inner"
+    )
+
+    return top_hits[columns].reset_index(drop=True)
+
+
+def top_hit_parameters(thresholds: list, combination: tuple = None) -> str:
+    """Function to describe the parameters a top hit has been selected with."""
+    return "combination={};thresholds={}".format(
+        combination, ",".join(str(threshold) for threshold in thresholds)
+    )
+
+
+def load_top_hits(
+    project_directory, fasta_name, fasta_index, thresholds, combination=None
+):
+    """Function to load the top hits of previous runs that are still valid.
+    A top hit is kept if its id is still in the fasta file with the same sequence and it
+    has been selected with the same thresholds, database and operating mode.
+
+    Args:
+        project_directory (Path): Project directory to work in.
+        fasta_name (str): Name of the outputs.
+        fasta_index (FastaIndex): Index of the fasta file.
+        thresholds (list): Thresholds of the top hit selection.
+        combination (tuple, optional): Database and operating mode. Defaults to None.
+
+    Returns:
+        pd.DataFrame: Valid top hits with their current fasta order, None if there are none.
+    """
+    top_hits_path = project_directory.joinpath(
+        "boldigger3_data", f"{fasta_name}_top_hits.parquet.snappy"
+    )
+
+    if not top_hits_path.is_file():
+        return None
+
+    top_hits = pd.read_parquet(top_hits_path)
+    unique_ids = fasta_index.unique_ids()
+    top_hits = top_hits[
+        top_hits["id"].isin(unique_ids.keys())
+        & (top_hits["parameters"] == top_hit_parameters(thresholds, combination))
+    ]
+    top_hits = top_hits[
+        top_hits["seq_hash"].to_numpy()
+        == np.array(fasta_index.seq_hashes(top_hits["id"]), dtype="uint64")
+    ]
+
+    if top_hits.empty:
+        return None
+
+    # sequences may have been added before the known ones
+    top_hits = top_hits.assign(fasta_order=top_hits["id"].map(unique_ids))
+
+    return top_hits.drop(columns=["seq_hash", "parameters"]).reset_index(drop=True)
+
+
+def save_results(
+    project_directory,
+    fasta_name,
+    fasta_index=None,
+    stored_top_hits=None,
+    thresholds=None,
+    combination=None,
+):
+    # the buffers are written in fasta order and named accordingly, so they can be concatenated
+    data_paths = sorted(
+        project_directory.joinpath("boldigger3_data").glob(
+            f"{fasta_name}_top_hit_buffer_*.parquet.snappy"
+        )
+    )
+    all_top_hits = pd.concat(
+        ([stored_top_hits] if stored_top_hits is not None else [])
+        + [pd.read_parquet(f) for f in data_paths],
+        axis=0,
+    )
+
+    # buffers of batches that were processed during the download are not in fasta order,
+    # a new top hit replaces the stored one of the same id
     all_top_hits = (
-        all_top_hits.set_index("fasta_order", sorted=True)
+        all_top_hits.drop_duplicates("id", keep="last")
+        .sort_values("fasta_order", kind="stable")
         .reset_index(drop=True)
-        .compute()
     )
 
+    # keep the top hits of the representatives, later runs only select the top hits of new sequences
+    if fasta_index is not None and thresholds is not None:
+        all_top_hits.assign(
+            seq_hash=np.array(fasta_index.seq_hashes(all_top_hits["id"]), dtype="uint64"),
+            parameters=top_hit_parameters(thresholds, combination),
+        ).to_parquet(
+            project_directory.joinpath(
+                "boldigger3_data", f"{fasta_name}_top_hits.parquet.snappy"
+            )
+        )
+
+    # share the top hits of the representatives with their duplicates
+    if fasta_index is not None:
+        all_top_hits = fan_out_duplicates(all_top_hits, fasta_index)
+
+    # drop the fasta order just before saving
+    all_top_hits = all_top_hits.drop("fasta_order", axis=1)
+
     # write the output
     parquet_output = project_directory.joinpath(
         "boldigger3_data", "{}_identification_result.parquet.snappy".format(fasta_name)
@@ -463,35 +1209,178 @@ def save_results(project_directory, fasta_name):
             file.unlink()
 
 
-def main(fasta_path: str, thresholds: list):
+def build_output_name(fasta_name: str, combination: tuple, combinations: list) -> str:
+    """Function to name the outputs of one database and operating mode.
+
+    Args:
+        fasta_name (str): Name of the fasta file that was identified.
+        combination (tuple): Database and operating mode.
+        combinations (list): All combinations that are selected in this run.
+
+    Returns:
+        str: The fasta name, with database and operating mode if there are several combinations.
+    """
+    if len(combinations) > 1:
+        return "{}_db{}_mode{}".format(fasta_name, *combination)
+
+    return fasta_name
+
+
+def pipelined_ids(project_directory, output_name: str) -> set:
+    """Function to collect the ids whose top hits have been selected while they were downloaded.
+
+    Args:
+        project_directory (Path): Project directory to work in.
+        output_name (str): Name of the outputs of one database and operating mode.
+
+    Returns:
+        set: Ids with a top hit in the buffers of the pipeline.
+    """
+    data_paths = project_directory.joinpath("boldigger3_data").glob(
+        f"{output_name}_top_hit_buffer_pipeline_*.parquet.snappy"
+    )
+
+    return {
+        seq_id
+        for data_path in data_paths
+        for seq_id in pd.read_parquet(data_path, columns=["id"])["id"]
+    }
+
+
+def find_combinations(id_engine_db_path) -> list:
+    """Function to find all combinations of database and operating mode in final_results.
+
+    Args:
+        id_engine_db_path (Path): Path to the id engine database.
+
+    Returns:
+        list: (database, operating mode) tuples.
+    """
+    with duckdb.connect(id_engine_db_path) as connection:
+        return connection.execute(
+            """
+            SELECT DISTINCT database, operating_mode FROM final_results
+            WHERE database IS NOT NULL AND operating_mode IS NOT NULL
+            ORDER BY ALL
+            """
+        ).fetchall()
+
+
+def main(
+    fasta_path: str,
+    thresholds: list,
+    engine: str = "pandas",
+    workers: int = 1,
+    combinations: list = None,
+    pipelined: bool = False,
+):
     tqdm.write(
         f"{datetime.datetime.now().strftime('%H:%M:%S')}: Removing digits and punctuation from hits."
     )
 
     # load the fasta data
-    fasta_dict, fasta_name, project_directory = parse_fasta(fasta_path)
+    fasta_index, fasta_name, project_directory = parse_fasta(fasta_path)
 
-    # define the id engine database path
-    id_engine_db_path = project_directory.joinpath(
-        "boldigger3_data", f"{fasta_name}.duckdb"
-    )
+    # the fasta file is closed once the run ends
+    with fasta_index:
+        # top hits are only calculated once per unique sequence
+        fasta_dict = fasta_index.unique_ids()
 
-    tqdm.write(
-        f"{datetime.datetime.now().strftime('%H:%M:%S')}: Streaming all hits to excel."
-    )
+        # define the id engine database path
+        id_engine_db_path = project_directory.joinpath(
+            "boldigger3_data", f"{fasta_name}.duckdb"
+        )
 
-    # # stream the data from duckdb to excel first
-    stream_hits_to_excel(id_engine_db_path, project_directory, fasta_dict, fasta_name)
+        # select the top hits for every database and operating mode that has been identified
+        if combinations is None:
+            combinations = find_combinations(id_engine_db_path)
+
+        for combination in combinations:
+            # several combinations are saved with the database and operating mode in the file names
+            output_name = build_output_name(fasta_name, combination, combinations)
+            if len(combinations) > 1:
+                tqdm.write(
+                    "{}: Database {}, operating mode {}.".format(
+                        datetime.datetime.now().strftime("%H:%M:%S"), *combination
+                    )
+                )
 
-    tqdm.write(f"{datetime.datetime.now().strftime('%H:%M:%S')}: Calculating top hits.")
+            tqdm.write(
+                f"{datetime.datetime.now().strftime('%H:%M:%S')}: Streaming all hits to excel."
+            )
 
-    gather_top_hits(
-        fasta_dict, id_engine_db_path, project_directory, fasta_name, thresholds
-    )
-    tqdm.write(
-        f"{datetime.datetime.now().strftime('%H:%M:%S')}: Saving results. This may take a while."
-    )
+            # # stream the data from duckdb to excel first
+            stream_hits_to_excel(
+                id_engine_db_path, project_directory, fasta_index, output_name, combination
+            )
 
-    save_results(project_directory, fasta_name)
+            tqdm.write(
+                f"{datetime.datetime.now().strftime('%H:%M:%S')}: Calculating top hits."
+            )
+
+            # top hits of previous runs and of the download pipeline are not selected again
+            stored_top_hits = load_top_hits(
+                project_directory, output_name, fasta_index, thresholds, combination
+            )
+            finished_ids = (
+                pipelined_ids(project_directory, output_name) if pipelined else set()
+            )
+            if stored_top_hits is not None:
+                finished_ids.update(stored_top_hits["id"])
+
+            # every engine only reads the hits of the ids without a top hit
+            selected_only = bool(finished_ids)
+            remaining_ids = {
+                seq_id: position
+                for seq_id, position in fasta_dict.items()
+                if seq_id not in finished_ids
+            }
+
+            if remaining_ids:
+                # the duckdb engine selects all top hits with a single set-based query
+                if engine == "duckdb":
+                    gather_top_hits_duckdb(
+                        id_engine_db_path,
+                        project_directory,
+                        output_name,
+                        thresholds,
+                        combination,
+                        list(remaining_ids.values()) if selected_only else None,
+                    )
+                # split the pandas engine over multiple processes
+                elif workers > 1:
+                    gather_top_hits_parallel(
+                        remaining_ids,
+                        id_engine_db_path,
+                        project_directory,
+                        output_name,
+                        thresholds,
+                        workers,
+                        combination,
+                        selected_only,
+                    )
+                else:
+                    gather_top_hits(
+                        remaining_ids,
+                        id_engine_db_path,
+                        project_directory,
+                        output_name,
+                        thresholds,
+                        combination,
+                        selected_only,
+                    )
+
+            tqdm.write(
+                f"{datetime.datetime.now().strftime('%H:%M:%S')}: Saving results. This may take a while."
+            )
+
+            save_results(
+                project_directory,
+                output_name,
+                fasta_index,
+                stored_top_hits,
+                thresholds,
+                combination,
+            )
 
-    tqdm.write(f"{datetime.datetime.now().strftime('%H:%M:%S')}: Finished.")
+        tqdm.write(f"{datetime.datetime.now().strftime('%H:%M:%S')}: Finished.")
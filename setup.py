@@ -17,7 +17,6 @@ setuptools.setup(
     install_requires=[
         "Bio>=1.8.0",
         "biopython>=1.85",
-        "dask>=2025.3.0",
         "duckdb>=1.3.2",
         "luddite>=1.0.4",
         "more_itertools>=10.5.0",
@@ -0,0 +1,244 @@
+import json, re, threading, uuid
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from boldigger3 import id_engine
+
+
+class FakeIdEngine:
+    """Local stand-in for the BOLD identification engine.
+
+    Submissions are answered with a sub_id, result urls return 404 until they have
+    been polled `ready_after` times. While `error_polls` is positive, result urls answer
+    with a server error. Every check of a result url is recorded per http method, head
+    requests can be switched off. The first `stalled_submissions` submissions never
+    become ready. Sequences starting with N do not match anything.
+    """
+
+    def __init__(self, ready_after: int = 1):
+        self.ready_after = ready_after
+        self.limit_responses = 0
+        self.error_polls = 0
+        self.head_supported = True
+        self.stalled_submissions = 0
+        self.stalled = set()
+        self.checks = []
+        self.submissions = {}
+        self.polls = {}
+        self.lock = threading.Lock()
+
+    def submit(self, body: str) -> dict:
+        with self.lock:
+            if self.limit_responses:
+                self.limit_responses -= 1
+                return {"detail": "Limit reached"}
+
+            records = re.findall(r">(\S+)\r?\n([A-Za-z]+)", body)
+            sub_id = uuid.uuid4().hex
+            if len(self.submissions) < self.stalled_submissions:
+                self.stalled.add(sub_id)
+            self.submissions[sub_id] = records
+            self.polls[sub_id] = 0
+
+            return {"sub_id": sub_id}
+
+    def result(self, sub_id: str):
+        with self.lock:
+            if self.error_polls:
+                self.error_polls -= 1
+                return 500
+            if sub_id not in self.submissions:
+                return None
+            self.polls[sub_id] += 1
+            if self.polls[sub_id] <= self.ready_after or sub_id in self.stalled:
+                return None
+
+            return "\n".join(
+                json.dumps({"seqid": seq_id, "results": self.hits(seq)})
+                for seq_id, seq in self.submissions[sub_id]
+            )
+
+    @staticmethod
+    def hits(seq: str) -> dict:
+        if seq.upper().startswith("N"):
+            return {}
+
+        taxonomy = {
+            "phylum": "Arthropoda",
+            "class": "Insecta",
+            "order": "Diptera",
+            "family": "Culicidae",
+            "subfamily": "Culicinae",
+            "genus": "Culex",
+            "species": "Culex pipiens",
+            "taxid_count": 3,
+        }
+
+        return {
+            f"PROC{len(seq)}-{i}|COI-5P|BOLD:AAA000{i}|x|public": {
+                "pdist": float(i),
+                "taxonomy": taxonomy,
+            }
+            for i in range(3)
+        }
+
+    @property
+    def submitted_sequences(self) -> list:
+        return [record for records in self.submissions.values() for record in records]
+
+
+def make_handler(engine: FakeIdEngine):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send(self, status: int, body: str = ""):
+            data = body.encode()
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(data)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length).decode()
+            self.send(200, json.dumps(engine.submit(body)))
+
+        def do_GET(self):
+            sub_id = self.path.rstrip("/").split("/")[-1]
+            engine.checks.append(self.command)
+            if self.command == "HEAD" and not engine.head_supported:
+                return self.send(405)
+            result = engine.result(sub_id)
+            if result is None:
+                self.send(404, json.dumps({"detail": "Not found"}))
+            elif result == 500:
+                self.send(500, json.dumps({"detail": "Internal server error"}))
+            else:
+                self.send(200, result)
+
+        do_HEAD = do_GET
+
+    return Handler
+
+
+@pytest.fixture
+def id_engine_server(monkeypatch):
+    engine = FakeIdEngine()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(engine))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    monkeypatch.setattr(
+        id_engine, "ID_ENGINE_URL", f"http://127.0.0.1:{server.server_address[1]}"
+    )
+
+    yield engine
+
+    server.shutdown()
+    server.server_close()
+
+
+class FakePackageServer:
+    """Local stand-in for the BOLD data package download.
+
+    Requests without a uid are answered with a new uid, requests with a uid with the package.
+    With `one_time_uids` a uid that has been used already is refused with 403, with
+    `refused_ranges` every range request but the first byte is refused with 403.
+    Range requests are answered with the requested bytes while `ranges` is switched on.
+    The first `dropped_responses` package responses stop after `drop_after` bytes. Every
+    package request is recorded with its range header and the number of bytes sent.
+    """
+
+    def __init__(self, package: bytes = b""):
+        self.package = package
+        self.ranges = True
+        self.one_time_uids = False
+        self.refused_ranges = False
+        self.issued_uids = 0
+        self.used_uids = set()
+        self.refused = 0
+        self.dropped_responses = 0
+        self.drop_after = 0
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def bytes_sent(self) -> int:
+        return sum(sent for _, sent in self.requests)
+
+
+def make_package_handler(server: FakePackageServer):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if "uid=" not in self.path:
+                with server.lock:
+                    server.issued_uids += 1
+                    data = f'"{server.issued_uids:016x}"'.encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                return self.wfile.write(data)
+
+            uid = self.path.rpartition("uid=")[2]
+            with server.lock:
+                refused = (server.one_time_uids and uid in server.used_uids) or (
+                    server.refused_ranges
+                    and self.headers.get("Range", "bytes=0-0") != "bytes=0-0"
+                )
+                server.used_uids.add(uid)
+                server.refused += refused
+            if refused:
+                self.send_response(403)
+                self.send_header("Content-Length", "0")
+                return self.end_headers()
+
+            package = server.package
+            start, end = 0, len(package) - 1
+            requested = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+
+            if server.ranges and requested:
+                start = int(requested.group(1))
+                end = min(int(requested.group(2) or end), end)
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(package)}")
+            else:
+                self.send_response(200)
+            data = package[start : end + 1]
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("ETag", f'"{hash(package)}"')
+            self.end_headers()
+
+            with server.lock:
+                # the connection is lost in the middle of the response
+                if server.dropped_responses and len(data) > server.drop_after:
+                    server.dropped_responses -= 1
+                    data = data[: server.drop_after]
+                    self.close_connection = True
+                server.requests.append((self.headers.get("Range"), len(data)))
+
+            self.wfile.write(data)
+
+    return Handler
+
+
+@pytest.fixture
+def package_server():
+    package_server = FakePackageServer()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_package_handler(package_server))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    package_server.url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    yield package_server
+
+    server.shutdown()
+    server.server_close()
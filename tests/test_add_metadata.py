@@ -0,0 +1,194 @@
+import duckdb
+import numpy as np
+from boldigger3 import add_metadata, download_database, id_engine
+
+
+def make_project(tmp_path, n_ids: int = 40, seed: int = 0):
+    """Project database with hits saved out of fasta order and a metadata database."""
+    rng = np.random.default_rng(seed)
+    database_path = tmp_path.joinpath("test.duckdb")
+    metadata_path = tmp_path.joinpath("bold.duckdb")
+
+    with duckdb.connect(database_path) as connection:
+        id_engine.create_results_table(connection)
+        for fasta_order in rng.permutation(n_ids):
+            for hit in range(int(rng.integers(1, 6))):
+                connection.execute(
+                    "INSERT INTO id_engine_results (id, species, pct_identity, process_id, database, operating_mode, status, fasta_order) VALUES (?, ?, ?, ?, 1, 3, NULL, ?)",
+                    [
+                        f"OTU_{fasta_order}",
+                        f"species {hit}",
+                        float(rng.choice([99.0, 97.5, 90.0])),
+                        f"P-{fasta_order}-{hit}",
+                        int(fasta_order),
+                    ],
+                )
+
+    with duckdb.connect(metadata_path) as connection:
+        connection.execute(
+            "CREATE TABLE bold_public ({}, unused VARCHAR)".format(
+                ", ".join(f'"{column}" VARCHAR' for column in add_metadata.METADATA_COLUMNS)
+            )
+        )
+
+    return database_path, metadata_path
+
+
+def public_process_ids(database_path) -> list:
+    with duckdb.connect(database_path) as connection:
+        return [
+            row[0]
+            for row in connection.execute(
+                "SELECT process_id FROM id_engine_results ORDER BY process_id"
+            ).fetchall()[::2]
+        ]
+
+
+def make_public(database_path, metadata_path) -> None:
+    with duckdb.connect(metadata_path) as connection:
+        connection.executemany(
+            "INSERT INTO bold_public (processid, \"country/ocean\") VALUES (?, 'Germany')",
+            [[process_id] for process_id in public_process_ids(database_path)],
+        )
+
+
+def read_final_results(database_path) -> list:
+    with duckdb.connect(database_path) as connection:
+        return connection.execute(
+            "SELECT fasta_order, pct_identity, process_id, status, processid, \"country/ocean\" FROM final_results ORDER BY fasta_order, pct_identity DESC, hit_order"
+        ).fetchall()
+
+
+# ---------------------------------------------------------------------------
+# merge_in_additional_data
+# ---------------------------------------------------------------------------
+
+class TestMergeInAdditionalData:
+    def test_final_results_is_a_view_of_the_hits(self, tmp_path):
+        database_path, metadata_path = make_project(tmp_path)
+        make_public(database_path, metadata_path)
+        add_metadata.merge_in_additional_data(database_path, metadata_path)
+
+        with duckdb.connect(database_path) as connection:
+            assert add_metadata.table_type(connection, "final_results") == "VIEW"
+            columns = [row[0] for row in connection.execute("DESCRIBE final_results").fetchall()]
+            expected = connection.execute(
+                "SELECT fasta_order, pct_identity, process_id FROM id_engine_results ORDER BY fasta_order, pct_identity DESC, rowid"
+            ).fetchall()
+            # the metadata is stored once per process id
+            assert connection.execute(
+                "SELECT count(*), count(DISTINCT process_id) FROM hit_metadata"
+            ).fetchone() == connection.execute(
+                "SELECT count(DISTINCT process_id), count(DISTINCT process_id) FROM id_engine_results"
+            ).fetchone()
+
+        final_results = read_final_results(database_path)
+
+        # only the needed metadata columns, the hits in fasta order and the status derived from the join
+        assert "unused" not in columns
+        assert [row[:3] for row in final_results] == expected
+        assert all(
+            (status == "public") == (processid is not None) == (country == "Germany")
+            for *_, status, processid, country in final_results
+        )
+        assert {row[3] for row in final_results} == {"public", "private"}
+
+    def test_only_new_process_ids_are_looked_up(self, tmp_path):
+        database_path, metadata_path = make_project(tmp_path)
+        add_metadata.merge_in_additional_data(database_path, metadata_path)
+
+        with duckdb.connect(database_path) as connection:
+            add_metadata.attach_metadata(connection, metadata_path)
+            assert add_metadata.merge_missing_results(connection) == 0
+            connection.execute(
+                "INSERT INTO id_engine_results (id, pct_identity, process_id, database, operating_mode, fasta_order) VALUES ('OTU_40', 99.0, 'P-40-0', 1, 3, 40)"
+            )
+            assert add_metadata.merge_missing_results(connection) == 1
+
+    def test_tables_of_earlier_versions_are_converted(self, tmp_path):
+        database_path, metadata_path = make_project(tmp_path)
+        make_public(database_path, metadata_path)
+
+        # final_results as a full copy of the hits
+        with duckdb.connect(database_path) as connection:
+            connection.execute(f"ATTACH '{metadata_path}' AS metadata")
+            connection.execute(
+                """
+                CREATE TABLE final_results AS
+                SELECT * FROM id_engine_results
+                LEFT JOIN (SELECT * EXCLUDE (unused) FROM metadata.bold_public) AS bold_public
+                ON id_engine_results.process_id = bold_public.processid
+                ORDER BY id_engine_results.fasta_order ASC, id_engine_results.pct_identity DESC
+                """
+            )
+            connection.execute(
+                "UPDATE final_results SET status = CASE WHEN processid IS NULL THEN 'private' ELSE 'public' END"
+            )
+            expected = connection.execute(
+                "SELECT fasta_order, pct_identity, process_id, status, processid, \"country/ocean\" FROM final_results ORDER BY ALL"
+            ).fetchall()
+
+        # the metadata database is not needed anymore
+        metadata_path.unlink()
+        with duckdb.connect(database_path) as connection:
+            add_metadata.create_final_results(connection)
+
+        assert sorted(read_final_results(database_path)) == expected
+
+    def test_materialize_and_compact(self, tmp_path):
+        database_path, metadata_path = make_project(tmp_path, n_ids=400)
+        make_public(database_path, metadata_path)
+        add_metadata.merge_in_additional_data(database_path, metadata_path)
+        expected = read_final_results(database_path)
+
+        add_metadata.materialize_final_results(database_path)
+        with duckdb.connect(database_path) as connection:
+            assert add_metadata.table_type(connection, "final_results") == "BASE TABLE"
+            assert connection.execute(
+                "SELECT fasta_order, pct_identity, process_id, status, processid, \"country/ocean\" FROM final_results ORDER BY rowid"
+            ).fetchall() == expected
+            connection.execute(
+                "CREATE TABLE download_journal (request_id BIGINT, state VARCHAR)"
+            )
+            connection.execute("INSERT INTO download_journal VALUES (1, 'downloaded')")
+
+        # the next run replaces the table by the view, compaction gives back the space of the table
+        with duckdb.connect(database_path) as connection:
+            add_metadata.attach_metadata(connection, metadata_path)
+        materialized_size = database_path.stat().st_size
+        add_metadata.compact_database(database_path)
+
+        assert database_path.stat().st_size < materialized_size
+        assert read_final_results(database_path) == expected
+        with duckdb.connect(database_path) as connection:
+            assert add_metadata.table_type(connection, "final_results") == "VIEW"
+            assert add_metadata.table_type(connection, "download_journal") is None
+
+    def test_slim_database_gives_the_same_results(self, tmp_path):
+        database_path, metadata_path = make_project(tmp_path)
+        make_public(database_path, metadata_path)
+        with duckdb.connect(metadata_path) as connection:
+            connection.execute(
+                "UPDATE bold_public SET sex = 'female', coord = '[50.5, 7.25]', nuc = 'ACGT', marker_code = 'COI-5P'"
+            )
+            connection.execute(
+                f"COPY bold_public TO '{tmp_path.joinpath('package.parquet')}'"
+            )
+        slim_path = tmp_path.joinpath("slim.ddb")
+        download_database.build_database(tmp_path.joinpath("package.parquet"), slim_path)
+
+        results = []
+        for path in (metadata_path, slim_path):
+            add_metadata.merge_in_additional_data(database_path, path)
+            with duckdb.connect(database_path) as connection:
+                results.append(
+                    connection.execute(
+                        "SELECT * FROM final_results ORDER BY fasta_order, pct_identity DESC, hit_order"
+                    ).fetchall()
+                )
+                connection.execute("DELETE FROM hit_metadata")
+
+        assert results[0] == results[1]
+        # lat, lon and nuc come before the hit order
+        assert {row[-3:-1] for row in results[1] if row[-3] is not None} == {(50.5, 7.25)}
+        assert {row[-5] for row in results[1] if row[-5] is not None} == {"ACGT"}
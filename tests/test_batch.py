@@ -0,0 +1,168 @@
+import datetime
+import duckdb
+import pytest
+from boldigger3 import batch, id_engine, add_metadata
+from boldigger3.fasta_index import FastaIndex
+
+
+def write_fasta(path, records: dict):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("".join(f">{key}\n{seq}\n" for key, seq in records.items()))
+    return path
+
+
+def index_fasta(fasta_path):
+    return FastaIndex.open(fasta_path, fasta_path.parent.joinpath("boldigger3_data"))
+
+
+def make_pooled_project(pooled_path, db_path, combinations=((1, 3),)):
+    """Save hits for every pooled sequence and add the metadata, like the id engine would."""
+    pooled_index = index_fasta(pooled_path)
+    database_path = pooled_path.parent.joinpath(
+        "boldigger3_data", f"{pooled_path.stem}.duckdb"
+    )
+
+    with duckdb.connect(database_path) as connection:
+        id_engine.create_results_table(connection)
+        for database, operating_mode in combinations:
+            for seq_id, position in pooled_index.fasta_order.items():
+                for pct_identity, process_id in [(99.0, "A"), (99.0, "B")]:
+                    connection.execute(
+                        "INSERT INTO id_engine_results VALUES (?, 'Arthropoda', 'Insecta', 'Diptera', 'Culicidae', 'Culex', 'Culex pipiens', ?, ?, 'BOLD:AAA0001', ?, ?, ?, 'public', ?)",
+                        [
+                            seq_id,
+                            pct_identity,
+                            f"{process_id}-{seq_id}",
+                            datetime.datetime.now().strftime("%Y-%m-%d %X"),
+                            database,
+                            operating_mode,
+                            position,
+                        ],
+                    )
+        connection.execute(
+            "INSERT INTO id_engine_completed (id, database, operating_mode, fasta_order) SELECT DISTINCT id, database, operating_mode, fasta_order FROM id_engine_results"
+        )
+
+    add_metadata.main(fasta_path=pooled_path, db_path=db_path)
+
+    return database_path
+
+
+def make_metadata(tmp_path):
+    db_path = tmp_path.joinpath("bold.duckdb")
+    with duckdb.connect(db_path) as connection:
+        connection.execute(
+            "CREATE TABLE bold_public ({})".format(
+                ", ".join(f'"{column}" VARCHAR' for column in add_metadata.METADATA_COLUMNS)
+            )
+        )
+
+    return db_path
+
+
+# ---------------------------------------------------------------------------
+# batch mode
+# ---------------------------------------------------------------------------
+
+class TestBatch:
+    def test_glob_patterns_are_expanded(self, tmp_path):
+        first = write_fasta(tmp_path.joinpath("a.fasta"), {"OTU_1": "ACGT"})
+        second = write_fasta(tmp_path.joinpath("b.fasta"), {"OTU_1": "ACGT"})
+
+        assert batch.expand_fasta_paths(
+            [str(tmp_path.joinpath("*.fasta")), str(first)]
+        ) == [first, second]
+
+    def test_sequences_are_pooled_once(self, tmp_path):
+        first = index_fasta(
+            write_fasta(
+                tmp_path.joinpath("a.fasta"),
+                {"OTU_1": "ACGTACGT", "OTU_2": "TTTTACGT", "OTU_3": "acgtacgt"},
+            )
+        )
+        second = index_fasta(
+            write_fasta(
+                tmp_path.joinpath("b.fasta"),
+                {"ASV_1": "GGGGACGT", "ASV_2": "ACGTACGT"},
+            )
+        )
+        pooled_path = tmp_path.joinpath("pooled", "pooled.fasta")
+
+        assert batch.write_pooled_fasta([first, second], pooled_path) == 3
+        pooled_index = index_fasta(pooled_path)
+        assert [pooled_index[key] for key in pooled_index] == [
+            "ACGTACGT",
+            "TTTTACGT",
+            "GGGGACGT",
+        ]
+
+        # an unchanged pool is not rewritten, so its index and downloads stay valid
+        modified = pooled_path.stat().st_mtime_ns
+        batch.write_pooled_fasta([first, second], pooled_path)
+        assert pooled_path.stat().st_mtime_ns == modified
+
+    def test_different_sequences_with_the_same_hash_are_not_pooled(self, tmp_path):
+        first = index_fasta(write_fasta(tmp_path.joinpath("a.fasta"), {"OTU_1": "ACGTACGT"}))
+        second = index_fasta(write_fasta(tmp_path.joinpath("b.fasta"), {"ASV_1": "GGGGACGT"}))
+        # the sequence of the second file collides with the one of the first
+        records = second.records.copy()
+        records["seq_hash"] = first.records["seq_hash"][0]
+        second = FastaIndex(second.fasta_path, second.ids, records)
+        pooled_path = tmp_path.joinpath("pooled", "pooled.fasta")
+
+        with pytest.raises(ValueError, match="ASV_1"):
+            batch.write_pooled_fasta([first, second], pooled_path)
+        assert not pooled_path.exists()
+        assert not pooled_path.with_suffix(".tmp").exists()
+
+    def test_results_are_demultiplexed(self, tmp_path):
+        first_path = write_fasta(
+            tmp_path.joinpath("a", "a.fasta"),
+            {"OTU_1": "ACGTACGT", "OTU_2": "TTTTACGT", "OTU_3": "ACGTACGT"},
+        )
+        second_path = write_fasta(
+            tmp_path.joinpath("b", "b.fasta"), {"ASV_1": "GGGGACGT", "ASV_2": "TTTTACGT"}
+        )
+        fasta_indices = [index_fasta(first_path), index_fasta(second_path)]
+        pooled_path = tmp_path.joinpath("pooled", "pooled.fasta")
+        batch.write_pooled_fasta(fasta_indices, pooled_path)
+        pooled_database_path = make_pooled_project(
+            pooled_path, make_metadata(tmp_path), combinations=((1, 3), (2, 3))
+        )
+
+        for fasta_path, fasta_index in zip([first_path, second_path], fasta_indices):
+            database_path = fasta_path.parent.joinpath(
+                "boldigger3_data", f"{fasta_path.stem}.duckdb"
+            )
+            # demultiplexing twice replaces the rows of the first time
+            batch.demultiplex(fasta_index, database_path, pooled_database_path)
+            batch.demultiplex(fasta_index, database_path, pooled_database_path)
+
+            # the projects count as downloaded, duplicates within a file stay with their representative
+            assert id_engine.already_downloaded(fasta_index, database_path, 1, 3) == []
+            assert id_engine.already_downloaded(fasta_index, database_path, 2, 3) == []
+
+        with duckdb.connect(
+            first_path.parent.joinpath("boldigger3_data", "a.duckdb")
+        ) as connection:
+            final_results = connection.execute(
+                "SELECT id, fasta_order, process_id, database, \"country/ocean\" FROM final_results WHERE database = 1 ORDER BY fasta_order, hit_order"
+            ).fetchall()
+            assert connection.execute(
+                "SELECT count(*) FROM id_engine_results"
+            ).fetchone() == (8,)
+
+        assert [row[:2] for row in final_results] == [
+            ("OTU_1", 0),
+            ("OTU_1", 0),
+            ("OTU_2", 1),
+            ("OTU_2", 1),
+        ]
+        assert {row[2].split("-")[0] for row in final_results} == {"A", "B"}
+
+        with duckdb.connect(
+            second_path.parent.joinpath("boldigger3_data", "b.duckdb")
+        ) as connection:
+            assert connection.execute(
+                "SELECT DISTINCT id, fasta_order FROM final_results ORDER BY fasta_order"
+            ).fetchall() == [("ASV_1", 0), ("ASV_2", 1)]
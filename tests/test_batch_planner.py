@@ -0,0 +1,83 @@
+import pytest
+from boldigger3.batch_planner import BatchPlanner
+
+
+class TestBatchPlanner:
+    def test_starts_with_the_largest_batches(self):
+        planner = BatchPlanner()
+        batches = planner.plan([f"OTU_{i}" for i in range(25)], [650] * 25, 0.75)
+        assert [len(batch) for batch in batches] == [10, 10, 5]
+        assert planner.limits(0.94) == (100, None)
+
+    def test_long_sequences_are_sent_in_smaller_batches(self):
+        planner = BatchPlanner(min_samples=1)
+        # twice the median turnaround at 0.1 seconds per base pair allows 1000 base pairs per batch
+        planner.on_completed(0.75, 500, 50.0)
+        assert planner.limits(0.75)[1] == pytest.approx(1000.0)
+
+        lengths = [300, 300, 300, 300, 2000, 100]
+        batches = planner.plan(list("abcdef"), lengths, 0.75)
+        assert batches == [["a", "b", "c"], ["d"], ["e"], ["f"]]
+
+    def test_slow_and_failed_batches_shrink_fast_ones_grow(self):
+        planner = BatchPlanner(min_samples=3)
+        # turnarounds of half an hour are normal once they are the median
+        for _ in range(3):
+            planner.on_completed(0.9, 1000, 1800.0)
+        assert planner.limits(0.9)[0] == 39
+
+        # a single slow batch does not shrink the batches, a series does
+        planner.on_completed(0.9, 1000, 5000.0)
+        planner.on_completed(0.9, 1000, 1000.0)
+        planner.on_completed(0.9, 1000, 5000.0)
+        planner.on_completed(0.9, 1000, 5000.0)
+        assert planner.limits(0.9)[0] == 48
+        planner.on_completed(0.9, 1000, 5000.0)
+        assert planner.limits(0.9)[0] == 24
+
+        planner.on_failed(0.9, batch_size=6)
+        assert planner.limits(0.9)[0] == 3
+        # batches grow past the fixed sizes of earlier versions up to the cap
+        for _ in range(20):
+            planner.on_completed(0.9, 1000, 10.0)
+        assert planner.limits(0.9)[0] == 80
+
+    def test_the_cap_is_configurable(self):
+        planner = BatchPlanner(max_batch_factor=1.5)
+        for _ in range(10):
+            planner.on_completed(0.94, 1000, 10.0)
+        assert planner.limits(0.94)[0] == 150
+
+    def test_small_queues_are_split_into_several_batches(self):
+        planner = BatchPlanner()
+        planner.limit_to_queue(0.94, 250)
+        assert planner.limits(0.94)[0] == 25
+        # large queues start from the fixed sizes, tiny ones from the floor
+        planner.limit_to_queue(0.94, 5000)
+        assert planner.limits(0.94)[0] == 100
+        planner.limit_to_queue(0.94, 30)
+        assert planner.limits(0.94)[0] == 10
+
+    def test_batches_do_not_shrink_below_the_floor(self):
+        planner = BatchPlanner()
+        for _ in range(10):
+            planner.on_failed(0.94)
+        assert planner.limits(0.94)[0] == 10
+
+    def test_split_bisects_batches(self):
+        assert BatchPlanner.split(list("abcde")) == [["a", "b"], ["c", "d", "e"]]
+        assert BatchPlanner.split(["a"]) == [["a"]]
+
+    def test_state_is_persisted_between_runs(self, tmp_path):
+        state_path = tmp_path.joinpath("state", "batch_planner.json")
+        planner = BatchPlanner.load(state_path)
+        assert planner.limits(0.75) == (10, None)
+
+        planner.on_failed(0.75)
+        planner.on_completed(0.75, 1000, 30.0)
+        planner.save()
+
+        restored = BatchPlanner.load(state_path)
+        assert restored.batch_sizes == pytest.approx(planner.batch_sizes)
+        assert restored.seconds_per_bp[0.75] == pytest.approx(0.03)
+        assert list(restored.turnarounds[0.75]) == [30.0]
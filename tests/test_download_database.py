@@ -0,0 +1,104 @@
+import duckdb
+import pandas as pd
+import requests
+from boldigger3 import download_database
+
+
+def write_package(tmp_path):
+    """Write a small data package like the one of BOLD, not sorted by process id."""
+    package_path = tmp_path.joinpath("BOLD_Public.parquet")
+    pd.DataFrame(
+        {
+            "processid": ["C-1", "A-1", "B-1", "D-1"],
+            "sex": ["female", None, "male", "female"],
+            "life_stage": ["adult", "adult", None, "larva"],
+            "inst": ["ZFMK", "ZFMK", "CBG", "CBG"],
+            "country/ocean": ["Germany", "Canada", None, "Germany"],
+            "identified_by": ["A. Smith", None, "B. Jones", "A. Smith"],
+            "identification_method": ["morphology", "BIN", None, "BIN"],
+            "coord": ["[50.5, 7.25]", None, "not a coordinate", "[-12.0, 130.5]"],
+            "nuc": ["ACGT", "TTTT", None, "GGGG"],
+            "marker_code": ["COI-5P", "COI-5P", "COI-5P", "ITS"],
+            "bin_uri": ["BOLD:AAA0001"] * 4,
+        }
+    ).to_parquet(package_path)
+
+    return package_path
+
+
+# ---------------------------------------------------------------------------
+# build_database
+# ---------------------------------------------------------------------------
+
+class TestBuildDatabase:
+    def test_metadata_is_sorted_and_pruned(self, tmp_path):
+        ddb_path = tmp_path.joinpath("BOLD_Public.ddb")
+        download_database.build_database(write_package(tmp_path), ddb_path)
+
+        with duckdb.connect(ddb_path) as connection:
+            bold_public = connection.execute("SELECT * FROM bold_public").df()
+            types = dict(
+                connection.execute(
+                    "SELECT column_name, data_type FROM information_schema.columns WHERE table_name = 'bold_public'"
+                ).fetchall()
+            )
+            sequences = connection.execute(
+                "SELECT processid, marker_code, nuc FROM bold_sequences"
+            ).fetchall()
+
+        assert bold_public["processid"].tolist() == ["A-1", "B-1", "C-1", "D-1"]
+        assert "nuc" not in types and "coord" not in types and "bin_uri" not in types
+        for column in download_database.ENUM_COLUMNS:
+            assert types[column].startswith("ENUM")
+        assert types["lat"] == types["lon"] == "DOUBLE"
+        assert bold_public["lat"].tolist()[2:] == [50.5, -12.0]
+        assert bold_public["lon"].tolist()[2:] == [7.25, 130.5]
+        assert bold_public["lat"].iloc[:2].isna().all()
+        assert bold_public["country/ocean"].tolist()[0] == "Canada"
+        assert sequences == [
+            ("A-1", "COI-5P", "TTTT"),
+            ("B-1", "COI-5P", None),
+            ("C-1", "COI-5P", "ACGT"),
+            ("D-1", "ITS", "GGGG"),
+        ]
+
+    def test_sequences_can_be_left_out(self, tmp_path):
+        ddb_path = tmp_path.joinpath("BOLD_Public.ddb")
+        download_database.build_database(
+            write_package(tmp_path), ddb_path, sequences=False
+        )
+
+        with duckdb.connect(ddb_path) as connection:
+            assert connection.execute(
+                "SELECT table_name FROM information_schema.tables"
+            ).fetchall() == [("bold_public",)]
+
+
+# ---------------------------------------------------------------------------
+# download_and_save_database
+# ---------------------------------------------------------------------------
+
+class TestDownloadAndSaveDatabase:
+    def test_package_is_downloaded_and_built(
+        self, package_server, tmp_path, monkeypatch
+    ):
+        package_server.package = write_package(tmp_path).read_bytes()
+        package_server.dropped_responses = 1
+        package_server.drop_after = 100
+        monkeypatch.setattr(download_database, "BOLD_URL", package_server.url)
+        output_dir = tmp_path.joinpath("database")
+        output_dir.mkdir()
+
+        download_database.download_and_save_database(
+            output_dir,
+            requests.Session(),
+            "/index.php/datapackages/download?id=BOLD_Public",
+            "BOLD_Public",
+            parts=2,
+        )
+
+        # only the database is left, the lost connection has been resumed
+        assert [path.name for path in output_dir.iterdir()] == ["BOLD_Public.ddb"]
+        assert len(package_server.requests) == 4
+        with duckdb.connect(output_dir.joinpath("BOLD_Public.ddb")) as connection:
+            assert connection.execute("SELECT count(*) FROM bold_public").fetchone() == (4,)
@@ -0,0 +1,131 @@
+import os
+import pytest
+from Bio import SeqIO
+from pathlib import Path
+from boldigger3 import id_engine
+from boldigger3.fasta_index import FastaIndex, InvalidFastaError
+
+TEST_FASTA = Path(__file__).parent.joinpath("test_10.fasta")
+
+
+def open_index(tmp_path, text: str) -> FastaIndex:
+    fasta_path = tmp_path.joinpath("test.fasta")
+    fasta_path.write_text(text)
+    return FastaIndex.open(fasta_path, tmp_path.joinpath("boldigger3_data"))
+
+
+# ---------------------------------------------------------------------------
+# FastaIndex
+# ---------------------------------------------------------------------------
+
+class TestFastaIndex:
+    def test_matches_seqio(self, tmp_path):
+        fasta_path = tmp_path.joinpath("test_10.fasta")
+        fasta_path.write_bytes(TEST_FASTA.read_bytes())
+
+        fasta_index = FastaIndex.open(fasta_path, tmp_path)
+        expected = SeqIO.to_dict(SeqIO.parse(fasta_path, "fasta"))
+
+        assert list(fasta_index.keys()) == list(expected.keys())
+        for key, record in expected.items():
+            assert fasta_index[key] == str(record.seq)
+
+    def test_multi_line_sequences_and_descriptions(self, tmp_path):
+        fasta_index = open_index(
+            tmp_path, ">OTU_1 size=10\nACGT\nacgt\n\n>OTU_2\r\nNNNN\r\nACGT\r\n>OTU_3\n"
+        )
+
+        assert list(fasta_index.keys()) == ["OTU_1", "OTU_2", "OTU_3"]
+        assert fasta_index["OTU_1"] == "ACGTacgt"
+        assert fasta_index["OTU_2"] == "NNNNACGT"
+        assert fasta_index["OTU_3"] == ""
+        assert fasta_index.records["length"].tolist() == [8, 8, 0]
+        assert fasta_index.fasta_order == {"OTU_1": 0, "OTU_2": 1, "OTU_3": 2}
+
+    def test_identical_sequences_share_a_representative(self, tmp_path):
+        fasta_index = open_index(
+            tmp_path,
+            ">OTU_1\nACGT\nACGT\n>OTU_2\nTTTT\n>OTU_3\nacgtACGT\n>OTU_4\nTTTT\n>OTU_5\nACGTACG\n",
+        )
+
+        assert fasta_index.representative_ids() == ["OTU_1", "OTU_2", "OTU_1", "OTU_2", "OTU_5"]
+        assert fasta_index.unique_ids() == {"OTU_1": 0, "OTU_2": 1, "OTU_5": 4}
+
+    def test_hash_collisions_are_not_merged(self, tmp_path):
+        fasta_index = open_index(
+            tmp_path, ">OTU_1\nACGT\n>OTU_2\nTTTT\n>OTU_3\nacgt\n>OTU_4\nTTTT\n"
+        )
+        # all sequences share the same hash
+        records = fasta_index.records.copy()
+        records["seq_hash"] = 7
+        fasta_index = FastaIndex(fasta_index.fasta_path, fasta_index.ids, records)
+
+        assert fasta_index.representative_ids() == ["OTU_1", "OTU_2", "OTU_1", "OTU_2"]
+        assert fasta_index.unique_ids() == {"OTU_1": 0, "OTU_2": 1}
+
+    def test_duplicate_ids_are_rejected(self, tmp_path):
+        with pytest.raises(ValueError, match="OTU_1"):
+            open_index(tmp_path, ">OTU_1\nACGT\n>OTU_1\nACGT\n")
+
+    def test_invalid_characters_are_reported(self, tmp_path):
+        with pytest.raises(InvalidFastaError) as error:
+            open_index(tmp_path, ">OTU_1\nACGT\n>OTU_2\nAC-GT\n>OTU_3\nACGU\n")
+
+        assert error.value.invalid_ids == ["OTU_2", "OTU_3"]
+        assert not tmp_path.joinpath("boldigger3_data", "test_fasta_index.json").exists()
+
+    def test_index_is_reused(self, tmp_path, monkeypatch):
+        open_index(tmp_path, ">OTU_1\nACGT\n")
+
+        def fail(*args):
+            raise AssertionError("index has been rebuilt")
+
+        monkeypatch.setattr(FastaIndex, "build", classmethod(fail))
+        fasta_index = FastaIndex.open(
+            tmp_path.joinpath("test.fasta"), tmp_path.joinpath("boldigger3_data")
+        )
+
+        assert dict(fasta_index) == {"OTU_1": "ACGT"}
+
+    def test_stale_index_is_rebuilt(self, tmp_path):
+        open_index(tmp_path, ">OTU_1\nACGT\n")
+        fasta_index = open_index(tmp_path, ">OTU_1\nACGTACGT\n>OTU_2\nTTTT\n")
+
+        assert dict(fasta_index) == {"OTU_1": "ACGTACGT", "OTU_2": "TTTT"}
+
+    def test_fasta_file_is_closed_on_exit(self, tmp_path):
+        with open_index(tmp_path, ">OTU_1\nACGT\n") as fasta_index:
+            assert fasta_index["OTU_1"] == "ACGT"
+            handle = fasta_index.handle
+
+        assert handle.closed and fasta_index.handle is None
+        # the file is opened again on the next read
+        assert fasta_index["OTU_1"] == "ACGT"
+
+
+# ---------------------------------------------------------------------------
+# parse_fasta
+# ---------------------------------------------------------------------------
+
+class TestParseFasta:
+    def test_invalid_characters_exit(self, tmp_path, capsys):
+        fasta_path = tmp_path.joinpath("test.fasta")
+        fasta_path.write_text(">OTU_1\nAC-GT\n")
+
+        with pytest.raises(SystemExit):
+            id_engine.parse_fasta(fasta_path)
+
+        assert "Sequence OTU_1 contains invalid characters." in capsys.readouterr().out
+
+    def test_index_is_stored_with_the_project_data(self, tmp_path):
+        fasta_path = tmp_path.joinpath("test.fasta")
+        fasta_path.write_text(">OTU_1\nACGT\n")
+
+        fasta_index, fasta_name, project_directory = id_engine.parse_fasta(fasta_path)
+
+        assert (fasta_name, project_directory) == ("test", tmp_path)
+        assert sorted(os.listdir(tmp_path.joinpath("boldigger3_data"))) == [
+            "test_fasta_index.ids",
+            "test_fasta_index.json",
+            "test_fasta_index.npy",
+        ]
@@ -0,0 +1,163 @@
+import datetime
+import duckdb
+import pandas as pd
+import pytest
+from boldigger3 import id_engine
+from boldigger3.fasta_index import FastaIndex
+from boldigger3.hit_cache import HitCache
+
+
+def make_project(tmp_path, name: str, records: dict, hits: dict = None):
+    """Create a project with an indexed fasta file and optional downloaded hits per id."""
+    project = tmp_path.joinpath(name)
+    project.mkdir()
+    fasta_path = project.joinpath(f"{name}.fasta")
+    fasta_path.write_text("".join(f">{key}\n{seq}\n" for key, seq in records.items()))
+    fasta_index = FastaIndex.open(fasta_path, project.joinpath("boldigger3_data"))
+    database_path = project.joinpath("boldigger3_data", f"{name}.duckdb")
+
+    with duckdb.connect(database_path) as connection:
+        connection.execute(
+            f"CREATE TABLE id_engine_results ({id_engine.ID_ENGINE_RESULTS_SCHEMA})"
+        )
+        for seq_id, species in (hits or {}).items():
+            for pct_identity, process_id in [(99.0, "A"), (99.0, "B"), (90.0, "C")]:
+                connection.execute(
+                    "INSERT INTO id_engine_results VALUES (?, 'Arthropoda', 'Insecta', 'Diptera', 'Culicidae', 'Culex', ?, ?, ?, 'BOLD:AAA0001', ?, 1, 3, 'public', ?)",
+                    [
+                        seq_id,
+                        species,
+                        pct_identity,
+                        f"{process_id}-{seq_id}",
+                        datetime.datetime.now().strftime("%Y-%m-%d %X"),
+                        fasta_index.fasta_order[seq_id],
+                    ],
+                )
+
+    return fasta_index, database_path
+
+
+def read_results(database_path) -> pd.DataFrame:
+    with duckdb.connect(database_path) as connection:
+        return connection.execute(
+            "SELECT * FROM id_engine_results ORDER BY rowid"
+        ).df()
+
+
+# ---------------------------------------------------------------------------
+# HitCache
+# ---------------------------------------------------------------------------
+
+class TestHitCache:
+    def test_cached_hits_are_served_to_other_projects(self, tmp_path):
+        hit_cache = HitCache(tmp_path.joinpath("cache", "hits.duckdb"))
+        fasta_index, database_path = make_project(
+            tmp_path,
+            "first",
+            {"OTU_1": "ACGTACGT", "OTU_2": "TTTTACGT"},
+            {"OTU_1": "Culex pipiens", "OTU_2": "Culex torrentium"},
+        )
+        assert id_engine.store_in_cache(hit_cache, fasta_index, database_path, 1, 3) == 2
+        # storing again does not duplicate any hits
+        assert id_engine.store_in_cache(hit_cache, fasta_index, database_path, 1, 3) == 0
+
+        fasta_index, database_path = make_project(
+            tmp_path, "second", {"ASV_1": "GGGGACGT", "ASV_2": "ttttacgt"}
+        )
+        served = id_engine.serve_from_cache(
+            hit_cache, fasta_index, ["ASV_1", "ASV_2"], database_path, 1, 3
+        )
+        results = read_results(database_path)
+
+        assert served == 1
+        assert id_engine.already_downloaded(fasta_index, database_path, 1, 3) == ["ASV_1"]
+        assert results["id"].tolist() == ["ASV_2"] * 3
+        assert results["fasta_order"].tolist() == [1, 1, 1]
+        assert results["process_id"].tolist() == ["A-OTU_2", "B-OTU_2", "C-OTU_2"]
+        assert results["species"].unique().tolist() == ["Culex torrentium"]
+
+    def test_other_database_or_mode_is_not_served(self, tmp_path):
+        hit_cache = HitCache(tmp_path.joinpath("hits.duckdb"))
+        fasta_index, database_path = make_project(
+            tmp_path, "first", {"OTU_1": "ACGTACGT"}, {"OTU_1": "Culex pipiens"}
+        )
+        id_engine.store_in_cache(hit_cache, fasta_index, database_path, 1, 3)
+
+        fasta_index, database_path = make_project(tmp_path, "second", {"ASV_1": "ACGTACGT"})
+
+        assert id_engine.serve_from_cache(hit_cache, fasta_index, ["ASV_1"], database_path, 2, 3) == 0
+        assert id_engine.serve_from_cache(hit_cache, fasta_index, ["ASV_1"], database_path, 1, 1) == 0
+        assert read_results(database_path).empty
+
+    def test_other_sequences_with_the_same_hash_are_not_served(self, tmp_path):
+        hit_cache = HitCache(tmp_path.joinpath("hits.duckdb"))
+        fasta_index, database_path = make_project(
+            tmp_path, "first", {"OTU_1": "ACGTACGT"}, {"OTU_1": "Culex pipiens"}
+        )
+        id_engine.store_in_cache(hit_cache, fasta_index, database_path, 1, 3)
+        seq_hash = fasta_index.records["seq_hash"][0]
+
+        # a different sequence whose hash collides with the cached one
+        fasta_index, database_path = make_project(
+            tmp_path, "second", {"ASV_1": "ACGTACGT", "ASV_2": "GGGGACGT"}
+        )
+        records = fasta_index.records.copy()
+        records["seq_hash"] = seq_hash
+        fasta_index = FastaIndex(fasta_index.fasta_path, fasta_index.ids, records)
+
+        served = id_engine.serve_from_cache(
+            hit_cache, fasta_index, ["ASV_1", "ASV_2"], database_path, 1, 3
+        )
+
+        assert served == 1
+        assert read_results(database_path)["id"].unique().tolist() == ["ASV_1"]
+        assert id_engine.already_downloaded(fasta_index, database_path, 1, 3) == ["ASV_2"]
+
+    def test_expired_entries_are_not_served(self, tmp_path):
+        cache_path = tmp_path.joinpath("hits.duckdb")
+        fasta_index, database_path = make_project(
+            tmp_path, "first", {"OTU_1": "ACGTACGT"}, {"OTU_1": "Culex pipiens"}
+        )
+        id_engine.store_in_cache(HitCache(cache_path), fasta_index, database_path, 1, 3)
+
+        with duckdb.connect(cache_path) as connection:
+            connection.execute(
+                "UPDATE cache_entries SET request_date = request_date - INTERVAL 40 DAY"
+            )
+
+        fasta_index, database_path = make_project(tmp_path, "second", {"ASV_1": "ACGTACGT"})
+        hit_cache = HitCache(cache_path, max_age=30)
+
+        assert id_engine.serve_from_cache(hit_cache, fasta_index, ["ASV_1"], database_path, 1, 3) == 0
+        with duckdb.connect(cache_path) as connection:
+            assert connection.execute("SELECT count(*) FROM cache_hits").fetchone() == (0,)
+
+    @pytest.mark.parametrize("max_size", [1, 2])
+    def test_least_recently_used_entries_are_evicted(self, tmp_path, max_size):
+        cache_path = tmp_path.joinpath("hits.duckdb")
+        records = {"OTU_1": "ACGTACGT", "OTU_2": "TTTTACGT", "OTU_3": "GGGGACGT"}
+        fasta_index, database_path = make_project(
+            tmp_path, "first", records, dict.fromkeys(records, "Culex pipiens")
+        )
+        id_engine.store_in_cache(HitCache(cache_path), fasta_index, database_path, 1, 3)
+
+        # OTU_1 has been used last, OTU_3 first
+        with duckdb.connect(cache_path) as connection:
+            for hours, seq_hash in enumerate(fasta_index.records["seq_hash"]):
+                connection.execute(
+                    "UPDATE cache_entries SET last_used = last_used - ? * INTERVAL 1 HOUR WHERE seq_hash = ?",
+                    [hours, int(seq_hash)],
+                )
+
+        # serving OTU_3 again makes it the most recently used entry
+        fasta_index, database_path = make_project(tmp_path, "second", {"ASV_3": "GGGGACGT"})
+        assert id_engine.serve_from_cache(HitCache(cache_path), fasta_index, ["ASV_3"], database_path, 1, 3) == 1
+
+        hit_cache = HitCache(cache_path, max_size=max_size)
+        fasta_index, database_path = make_project(tmp_path, "third", records)
+        served = id_engine.serve_from_cache(
+            hit_cache, fasta_index, list(records), database_path, 1, 3
+        )
+
+        assert served == max_size
+        assert read_results(database_path)["id"].unique().tolist() == ["OTU_1", "OTU_3"][-max_size:]
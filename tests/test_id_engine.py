@@ -0,0 +1,690 @@
+import asyncio
+import json
+import pickle
+import duckdb
+import pytest
+from boldigger3 import id_engine
+from boldigger3.rate_control import RateController
+from boldigger3.download_journal import DownloadJournal
+from boldigger3.batch_planner import BatchPlanner
+from conftest import FakeIdEngine
+
+
+def write_fasta(path, records: dict):
+    path.write_text("".join(f">{key}\n{seq}\n" for key, seq in records.items()))
+    return path
+
+
+def make_records(n: int) -> dict:
+    return {f"OTU_{i}": "ACGT" * (10 + i) for i in range(1, n + 1)}
+
+
+def fast_rate_controller(**kwargs) -> RateController:
+    """Rate controller that submits without pacing delays."""
+    return RateController(rate=6000, max_rate=6000, **kwargs)
+
+
+class NoProgress:
+    def update(self, n=1):
+        pass
+
+
+# ---------------------------------------------------------------------------
+# process_download_queue
+# ---------------------------------------------------------------------------
+
+class TestProcessDownloadQueue:
+    def run_queue(
+        self,
+        tmp_path,
+        download_queue,
+        fasta_index,
+        rate_controller=None,
+        resume=False,
+        **scheduler_options,
+    ):
+        data_dir = tmp_path.joinpath("boldigger3_data")
+        data_dir.mkdir(exist_ok=True)
+
+        with id_engine.build_session() as session, DownloadJournal(
+            data_dir.joinpath("test.duckdb")
+        ) as journal:
+            if not resume:
+                journal.replace(download_queue)
+            scheduler = id_engine.DownloadScheduler(
+                download_queue,
+                journal,
+                fasta_index,
+                session,
+                rate_controller or fast_rate_controller(),
+                NoProgress(),
+                **{"polling_interval": 0, **scheduler_options},
+            )
+            asyncio.run(scheduler.run())
+
+        with duckdb.connect(data_dir.joinpath("test.duckdb")) as connection:
+            return connection.execute(
+                "SELECT * FROM id_engine_results ORDER BY fasta_order, pct_identity DESC"
+            ).df()
+
+    def test_all_requests_are_downloaded(self, tmp_path, id_engine_server):
+        fasta_path = write_fasta(tmp_path.joinpath("test.fasta"), make_records(25))
+        fasta_dict, _, _ = id_engine.parse_fasta(fasta_path)
+        # 10 sequences per request in operating mode 3
+        download_queue = id_engine.build_download_queue(
+            fasta_dict, list(fasta_dict.keys()), 1, 3
+        )
+
+        results = self.run_queue(
+            tmp_path,
+            download_queue,
+            fasta_dict,
+            fast_rate_controller(window=2, max_window=2),
+        )
+
+        assert not download_queue["waiting"] and not download_queue["active"]
+        assert results["id"].unique().tolist() == list(fasta_dict.keys())
+        assert results["fasta_order"].is_monotonic_increasing
+        assert len(id_engine_server.submissions) == 3
+
+    def test_no_match_rows(self, tmp_path, id_engine_server):
+        fasta_path = write_fasta(
+            tmp_path.joinpath("test.fasta"), {"OTU_1": "ACGTACGT", "OTU_2": "NNNNACGT"}
+        )
+        fasta_dict, _, _ = id_engine.parse_fasta(fasta_path)
+        download_queue = id_engine.build_download_queue(
+            fasta_dict, list(fasta_dict.keys()), 1, 3
+        )
+
+        results = self.run_queue(tmp_path, download_queue, fasta_dict)
+
+        no_match = results.query("id == 'OTU_2'")
+        assert len(no_match) == 1
+        assert no_match["species"].item() == "no-match"
+        assert len(results.query("id == 'OTU_1'")) == 3
+
+    def test_duplicate_sequences_are_submitted_once(self, tmp_path, id_engine_server):
+        fasta_path = write_fasta(
+            tmp_path.joinpath("test.fasta"),
+            {"OTU_1": "ACGTACGT", "OTU_2": "TTTTACGT", "OTU_3": "acgtacgt", "OTU_4": "ACGTACGT"},
+        )
+        fasta_index, _, _ = id_engine.parse_fasta(fasta_path)
+        missing_ids = id_engine.already_downloaded(
+            fasta_index, tmp_path.joinpath("boldigger3_data", "test.duckdb"), 1, 3
+        )
+        download_queue = id_engine.build_download_queue(fasta_index, missing_ids, 1, 3)
+
+        results = self.run_queue(tmp_path, download_queue, fasta_index)
+
+        assert missing_ids == ["OTU_1", "OTU_2"]
+        assert [seq_id for seq_id, _ in id_engine_server.submitted_sequences] == ["OTU_1", "OTU_2"]
+        assert results.drop_duplicates("id")[["id", "fasta_order"]].values.tolist() == [
+            ["OTU_1", 0],
+            ["OTU_2", 1],
+        ]
+
+    def test_active_requests_are_resumed(self, tmp_path, id_engine_server):
+        fasta_path = write_fasta(tmp_path.joinpath("test.fasta"), make_records(15))
+        fasta_dict, _, _ = id_engine.parse_fasta(fasta_path)
+        download_queue = id_engine.build_download_queue(
+            fasta_dict, list(fasta_dict.keys()), 1, 3
+        )
+
+        database_path = tmp_path.joinpath("boldigger3_data", "test.duckdb")
+
+        # submit the first request as if it was sent in a previous run
+        with id_engine.build_session() as session, DownloadJournal(database_path) as journal:
+            journal.replace(download_queue)
+            bold_request = id_engine.build_post_request(
+                download_queue["waiting"][1], session, fast_rate_controller()
+            )
+            journal.mark_submitted(1, bold_request.result_url, bold_request.timestamp)
+
+        # the queue is rebuilt from the journal
+        with DownloadJournal(database_path) as journal:
+            assert journal.has_open_requests()
+            download_queue = id_engine.load_download_queue(journal, fasta_dict)
+
+        assert list(download_queue["active"]) == [1]
+        assert list(download_queue["waiting"]) == [2]
+        assert download_queue["active"][1].result_url == bold_request.result_url
+
+        results = self.run_queue(tmp_path, download_queue, fasta_dict, resume=True)
+
+        assert results["id"].unique().tolist() == list(fasta_dict.keys())
+        assert len(id_engine_server.submissions) == 2
+        with DownloadJournal(database_path) as journal:
+            assert not journal.has_open_requests()
+
+    def test_requests_are_rebuilt_after_the_fasta_was_edited(
+        self, tmp_path, id_engine_server
+    ):
+        records = make_records(15)
+        fasta_path = write_fasta(tmp_path.joinpath("test.fasta"), records)
+        fasta_index, _, _ = id_engine.parse_fasta(fasta_path)
+        download_queue = id_engine.build_download_queue(
+            fasta_index, list(fasta_index.keys()), 1, 3
+        )
+
+        database_path = tmp_path.joinpath("boldigger3_data", "test.duckdb")
+
+        with id_engine.build_session() as session, DownloadJournal(database_path) as journal:
+            journal.replace(download_queue)
+            bold_request = id_engine.build_post_request(
+                download_queue["waiting"][1], session, fast_rate_controller()
+            )
+            journal.mark_submitted(1, bold_request.result_url, bold_request.timestamp)
+
+        # one sequence of each request is removed, one of the submitted request changed
+        del records["OTU_12"]
+        records["OTU_3"] = "TTGA" * 20
+        fasta_index, _, _ = id_engine.parse_fasta(write_fasta(fasta_path, records))
+
+        with DownloadJournal(database_path) as journal:
+            download_queue = id_engine.load_download_queue(journal, fasta_index)
+
+        assert not download_queue["active"]
+        assert [
+            bold_request.seq_ids for bold_request in download_queue["waiting"].values()
+        ] == [list(records)[:10], list(records)[10:]]
+        assert min(download_queue["waiting"]) > 2
+
+        results = self.run_queue(tmp_path, download_queue, fasta_index, resume=True)
+
+        assert results["id"].unique().tolist() == list(records)
+        assert ("OTU_3", records["OTU_3"]) in id_engine_server.submitted_sequences
+        with duckdb.connect(database_path) as connection:
+            seq_hashes = dict(
+                connection.execute("SELECT id, seq_hash FROM id_engine_completed").fetchall()
+            )
+        assert seq_hashes == dict(zip(records, fasta_index.seq_hashes(list(records))))
+        with DownloadJournal(database_path) as journal:
+            assert not journal.has_open_requests()
+
+    def test_pickled_queues_of_earlier_versions_are_imported(
+        self, tmp_path, id_engine_server
+    ):
+        records = make_records(25)
+        fasta_path = write_fasta(tmp_path.joinpath("test.fasta"), records)
+        fasta_index, _, _ = id_engine.parse_fasta(fasta_path)
+        download_queue = id_engine.build_download_queue(
+            fasta_index, list(fasta_index.keys()), 1, 3
+        )
+
+        # requests as pickled by earlier versions, the first two have been submitted
+        with id_engine.build_session() as session:
+            legacy_queue = {"waiting": {}, "active": {}}
+            for request_id, bold_request in download_queue["waiting"].items():
+                bold_request.query_data = [
+                    f">{seq_id}\n{records[seq_id]}\n" for seq_id in bold_request.seq_ids
+                ]
+                del bold_request.seq_ids, bold_request.hedge
+                if request_id < 3:
+                    id_engine.build_post_request(bold_request, session, fast_rate_controller())
+                    legacy_queue["active"][request_id] = bold_request
+                else:
+                    legacy_queue["waiting"][request_id] = bold_request
+
+        # the second request holds a sequence that has been edited since
+        write_fasta(fasta_path, {**records, "OTU_15": "TTTT" * 10})
+        fasta_index, _, _ = id_engine.parse_fasta(fasta_path)
+        queue_path = tmp_path.joinpath("boldigger3_data", "test_download_queue.pkl")
+        with open(queue_path, "wb") as queue_file:
+            pickle.dump(legacy_queue, queue_file)
+
+        database_path = tmp_path.joinpath("boldigger3_data", "test.duckdb")
+        with DownloadJournal(database_path) as journal:
+            assert id_engine.import_legacy_queue(
+                queue_path, journal, fasta_index, {(1, 3): list(records)}
+            ) == 3
+            download_queue = id_engine.load_download_queue(journal, fasta_index)
+
+        assert not queue_path.is_file()
+        assert list(download_queue["active"]) == [1]
+        assert list(download_queue["waiting"]) == [2, 3]
+        assert download_queue["active"][1].result_url == legacy_queue["active"][1].result_url
+
+        results = self.run_queue(tmp_path, download_queue, fasta_index, resume=True)
+
+        assert results["id"].unique().tolist() == list(records)
+        # only the edited request is submitted again
+        assert len(id_engine_server.submissions) == 4
+        assert ("OTU_15", "TTTT" * 10) in id_engine_server.submitted_sequences
+
+    def test_timed_out_requests_are_polled_late(self, tmp_path, id_engine_server):
+        fasta_path = write_fasta(tmp_path.joinpath("test.fasta"), make_records(15))
+        fasta_index, _, _ = id_engine.parse_fasta(fasta_path)
+        download_queue = id_engine.build_download_queue(
+            fasta_index, list(fasta_index.keys()), 1, 3
+        )
+        id_engine_server.ready_after = 3
+
+        # every request times out before its first poll
+        results = self.run_queue(
+            tmp_path,
+            download_queue,
+            fasta_index,
+            timeout=0,
+            late_polling_interval=0,
+        )
+
+        assert results["id"].unique().tolist() == list(fasta_index.keys())
+        assert not download_queue["late"]
+        assert len(id_engine_server.submissions) == 2
+
+    def test_failing_result_urls_are_bisected(self, tmp_path, id_engine_server):
+        fasta_path = write_fasta(tmp_path.joinpath("test.fasta"), make_records(5))
+        fasta_index, _, _ = id_engine.parse_fasta(fasta_path)
+        download_queue = id_engine.build_download_queue(
+            fasta_index, list(fasta_index.keys()), 1, 3
+        )
+        id_engine_server.error_polls = 2
+
+        results = self.run_queue(
+            tmp_path, download_queue, fasta_index, max_poll_errors=2
+        )
+        batch_sizes = [len(records) for records in id_engine_server.submissions.values()]
+
+        assert results["id"].unique().tolist() == list(fasta_index.keys())
+        assert len(results) == 15
+        # the failed batch is sent again in smaller batches
+        assert batch_sizes[0] == 5 and max(batch_sizes[1:]) <= 3
+        assert sum(batch_sizes[1:]) == 5
+
+    def test_waiting_batches_follow_the_planner(self, tmp_path, id_engine_server):
+        fasta_path = write_fasta(tmp_path.joinpath("test.fasta"), make_records(25))
+        fasta_index, _, _ = id_engine.parse_fasta(fasta_path)
+        download_queue = id_engine.build_download_queue(
+            fasta_index, list(fasta_index.keys()), 1, 3
+        )
+
+        # the batches shrink after the queue has been built
+        batch_planner = BatchPlanner()
+        batch_planner.on_failed(0.75, batch_size=8)
+        results = self.run_queue(
+            tmp_path,
+            download_queue,
+            fasta_index,
+            fast_rate_controller(window=1, max_window=1),
+            batch_planner=batch_planner,
+        )
+        batch_sizes = [len(records) for records in id_engine_server.submissions.values()]
+
+        assert results["id"].unique().tolist() == list(fasta_index.keys())
+        # the batches grow again while the server keeps up
+        assert batch_sizes == [4, 5, 6, 7, 3]
+        with DownloadJournal(tmp_path.joinpath("boldigger3_data", "test.duckdb")) as journal:
+            assert not journal.has_open_requests()
+
+    def test_late_requests_are_resumed(self, tmp_path, id_engine_server):
+        fasta_path = write_fasta(tmp_path.joinpath("test.fasta"), make_records(5))
+        fasta_index, _, _ = id_engine.parse_fasta(fasta_path)
+        download_queue = id_engine.build_download_queue(
+            fasta_index, list(fasta_index.keys()), 1, 3
+        )
+        database_path = tmp_path.joinpath("boldigger3_data", "test.duckdb")
+
+        with id_engine.build_session() as session, DownloadJournal(database_path) as journal:
+            journal.replace(download_queue)
+            bold_request = id_engine.build_post_request(
+                download_queue["waiting"][1], session, fast_rate_controller()
+            )
+            journal.mark_submitted(1, bold_request.result_url, bold_request.timestamp)
+            journal.mark_late(1)
+
+        with DownloadJournal(database_path) as journal:
+            assert journal.has_open_requests()
+            download_queue = id_engine.load_download_queue(journal, fasta_index)
+
+        assert list(download_queue["late"]) == [1]
+        assert not download_queue["active"] and not download_queue["waiting"]
+
+        results = self.run_queue(
+            tmp_path, download_queue, fasta_index, resume=True, late_polling_interval=0
+        )
+
+        assert results["id"].unique().tolist() == list(fasta_index.keys())
+        assert len(id_engine_server.submissions) == 1
+
+    @pytest.mark.parametrize("head_supported", [True, False])
+    def test_results_are_downloaded_once(self, tmp_path, id_engine_server, head_supported):
+        fasta_path = write_fasta(tmp_path.joinpath("test.fasta"), make_records(15))
+        fasta_index, _, _ = id_engine.parse_fasta(fasta_path)
+        download_queue = id_engine.build_download_queue(
+            fasta_index, list(fasta_index.keys()), 1, 3
+        )
+        id_engine_server.ready_after = 3
+        id_engine_server.head_supported = head_supported
+
+        results = self.run_queue(
+            tmp_path, download_queue, fasta_index, backoff_factor=2
+        )
+
+        assert results["id"].unique().tolist() == list(fasta_index.keys())
+        if head_supported:
+            # three checks without result and one that finds it per request
+            assert id_engine_server.checks.count("HEAD") == 8
+            assert id_engine_server.checks.count("GET") == 2
+        else:
+            # at most one rejected head request per request, then only get requests
+            assert id_engine_server.checks.count("HEAD") <= 2
+            assert id_engine_server.checks.count("GET") == 8
+
+    def test_turnaround_is_measured_when_the_result_is_ready(
+        self, tmp_path, id_engine_server
+    ):
+        fasta_path = write_fasta(tmp_path.joinpath("test.fasta"), make_records(5))
+        fasta_index, _, _ = id_engine.parse_fasta(fasta_path)
+        download_queue = id_engine.build_download_queue(
+            fasta_index, list(fasta_index.keys()), 1, 3
+        )
+        batch_planner = BatchPlanner()
+
+        # checks after 0.2 and 1.0 seconds, the result is ready from the second check on
+        self.run_queue(
+            tmp_path,
+            download_queue,
+            fasta_index,
+            batch_planner=batch_planner,
+            polling_interval=0.2,
+            backoff_factor=4,
+        )
+
+        # the turnaround lies between the last check without result and the one with it
+        assert 0.3 < batch_planner.turnarounds[0.75][0] < 0.9
+
+    def test_slow_requests_are_hedged(self, tmp_path, id_engine_server):
+        fasta_path = write_fasta(tmp_path.joinpath("test.fasta"), make_records(6))
+        fasta_index, _, _ = id_engine.parse_fasta(fasta_path)
+        # a single sequence per batch
+        batch_planner = BatchPlanner(growth_factor=1.0)
+        batch_planner.batch_sizes[0.75] = 1
+        download_queue = id_engine.build_download_queue(
+            fasta_index, list(fasta_index.keys()), 1, 3, batch_planner
+        )
+        # the first batch would never finish without a second submission
+        id_engine_server.stalled_submissions = 1
+
+        results = self.run_queue(
+            tmp_path,
+            download_queue,
+            fasta_index,
+            batch_planner=batch_planner,
+            hedge_percentile=50,
+            hedge_min_samples=3,
+        )
+
+        assert results["id"].unique().tolist() == list(fasta_index.keys())
+        assert len(results) == 18
+        # other requests may be hedged as well once nothing is waiting, depending on timing
+        submitted = [seq_id for seq_id, _ in id_engine_server.submitted_sequences]
+        assert submitted.count("OTU_1") == 2
+        assert max(submitted.count(seq_id) for seq_id in fasta_index.keys()) == 2
+
+        # the journal points to the hedge, its turnaround counts from the first submission
+        with duckdb.connect(tmp_path.joinpath("boldigger3_data", "test.duckdb")) as connection:
+            result_url, submitted_at, first_submission = connection.execute(
+                """
+                SELECT result_url, submitted_at, (SELECT min(submitted_at) FROM download_journal)
+                FROM download_journal WHERE list_contains(seq_ids, 'OTU_1')
+                """
+            ).fetchone()
+        assert result_url.rsplit("/", 1)[1] not in id_engine_server.stalled
+        assert submitted_at == first_submission
+
+    def test_combinations_share_one_queue(self, tmp_path, id_engine_server):
+        fasta_path = write_fasta(tmp_path.joinpath("test.fasta"), make_records(15))
+        fasta_index, _, _ = id_engine.parse_fasta(fasta_path)
+        missing_ids = {
+            (1, 3): list(fasta_index.keys()),
+            (2, 3): list(fasta_index.keys())[5:],
+        }
+        # the 25 queued sequences are split into batches of 3
+        download_queue = id_engine.build_missing_queue(
+            fasta_index, missing_ids, BatchPlanner()
+        )
+
+        assert [
+            (bold_request.database, len(bold_request.seq_ids))
+            for bold_request in download_queue["waiting"].values()
+        ] == [(1, 3), (2, 3)] * 3 + [(1, 3), (2, 1), (1, 3)]
+
+        results = self.run_queue(tmp_path, download_queue, fasta_index)
+        database_path = tmp_path.joinpath("boldigger3_data", "test.duckdb")
+
+        # results of both databases are stored side by side
+        assert results.groupby("database")["id"].nunique().to_dict() == {1: 15, 2: 10}
+        assert id_engine.already_downloaded(fasta_index, database_path, 1, 3) == []
+        assert id_engine.already_downloaded(fasta_index, database_path, 2, 3) == list(fasta_index.keys())[:5]
+        assert id_engine.already_downloaded(fasta_index, database_path, 2, 1) == list(fasta_index.keys())
+
+    def test_limit_responses_slow_down_submissions(self, tmp_path, id_engine_server):
+        fasta_path = write_fasta(tmp_path.joinpath("test.fasta"), make_records(5))
+        fasta_dict, _, _ = id_engine.parse_fasta(fasta_path)
+        download_queue = id_engine.build_download_queue(
+            fasta_dict, list(fasta_dict.keys()), 1, 3
+        )
+        id_engine_server.limit_responses = 2
+
+        rate_controller = fast_rate_controller(state_path=tmp_path.joinpath("rate.json"))
+        results = self.run_queue(tmp_path, download_queue, fasta_dict, rate_controller)
+
+        assert results["id"].unique().tolist() == list(fasta_dict.keys())
+        assert RateController.load(tmp_path.joinpath("rate.json")).window < 10
+
+
+# ---------------------------------------------------------------------------
+# parse_response
+# ---------------------------------------------------------------------------
+
+class FakeResponse:
+    def __init__(self, results: list):
+        self.lines = [json.dumps(result).encode() for result in results]
+
+    def iter_lines(self):
+        # keep-alive new lines are part of real responses
+        return iter(self.lines + [b""])
+
+
+class TestParseResponse:
+    def make_request(self):
+        bold_request = id_engine.BoldIdRequest()
+        bold_request.database = 2
+        bold_request.operating_mode = 3
+        return bold_request
+
+    def make_response(self):
+        hits = FakeIdEngine.hits("ACGT")
+        # taxonomy without genus and species
+        hits["PROC-9|COI-5P|BOLD:AAA0009|x"] = {
+            "pdist": 2.5,
+            "taxonomy": {"phylum": "Arthropoda", "class": "Insecta", "order": "Diptera", "family": "Culicidae"},
+        }
+        return FakeResponse(
+            [{"seqid": "OTU_2", "results": hits}, {"seqid": "OTU_1", "results": {}}]
+        )
+
+    def test_schema_and_values(self):
+        table = id_engine.parse_response(
+            self.make_request(), self.make_response(), {"OTU_1": 0, "OTU_2": 1}
+        )
+        result = table.to_pydict()
+
+        assert table.schema == id_engine.ID_ENGINE_RESULTS_ARROW_SCHEMA
+        assert result["id"] == ["OTU_2"] * 4 + ["OTU_1"]
+        assert result["fasta_order"] == [1, 1, 1, 1, 0]
+        assert result["pct_identity"] == [100.0, 99.0, 98.0, 97.5, 0.0]
+        assert result["status"] == ["public"] * 3 + ["", ""]
+        assert result["bin_uri"][-2:] == ["BOLD:AAA0009", ""]
+        assert result["species"][-2:] == [None, "no-match"]
+        assert set(result["database"]) == {2} and set(result["operating_mode"]) == {3}
+
+    def test_standard_library_decoder_gives_the_same_table(self, monkeypatch):
+        fasta_order = {"OTU_1": 0, "OTU_2": 1}
+        table = id_engine.parse_response(
+            self.make_request(), self.make_response(), fasta_order
+        )
+        monkeypatch.setattr(id_engine, "json_loads", json.loads)
+        fallback = id_engine.parse_response(
+            self.make_request(), self.make_response(), fasta_order
+        )
+
+        assert table.drop(["request_date"]).equals(fallback.drop(["request_date"]))
+
+
+# ---------------------------------------------------------------------------
+# parse_and_save_data
+# ---------------------------------------------------------------------------
+
+class TestParseAndSaveData:
+    def test_saving_a_request_twice_replaces_its_rows(self, tmp_path):
+        bold_request = id_engine.BoldIdRequest()
+        bold_request.database, bold_request.operating_mode = 1, 3
+        results = [
+            {"seqid": "OTU_1", "results": FakeIdEngine.hits("ACGT")},
+            {"seqid": "OTU_2", "results": {}},
+        ]
+
+        with duckdb.connect(tmp_path.joinpath("test.duckdb")) as connection:
+            id_engine.create_results_table(connection)
+            for _ in range(2):
+                id_engine.parse_and_save_data(
+                    bold_request, FakeResponse(results), {"OTU_1": 0, "OTU_2": 1}, connection
+                )
+            rows = connection.execute(
+                "SELECT id, count(*) FROM id_engine_results GROUP BY id ORDER BY id"
+            ).fetchall()
+
+        assert rows == [("OTU_1", 3), ("OTU_2", 1)]
+        assert not list(tmp_path.glob("*.parquet.snappy"))
+
+
+# ---------------------------------------------------------------------------
+# already_downloaded
+# ---------------------------------------------------------------------------
+
+class TestAlreadyDownloaded:
+    def test_completion_table_is_maintained_at_ingest(self, tmp_path):
+        fasta_path = write_fasta(tmp_path.joinpath("test.fasta"), make_records(3))
+        fasta_index, _, _ = id_engine.parse_fasta(fasta_path)
+        database_path = tmp_path.joinpath("boldigger3_data", "test.duckdb")
+        bold_request = id_engine.BoldIdRequest()
+        bold_request.database, bold_request.operating_mode = 1, 3
+
+        assert id_engine.already_downloaded(fasta_index, database_path, 1, 3) == ["OTU_1", "OTU_2", "OTU_3"]
+
+        with duckdb.connect(database_path) as connection:
+            id_engine.create_results_table(connection)
+            id_engine.parse_and_save_data(
+                bold_request,
+                FakeResponse([{"seqid": "OTU_2", "results": FakeIdEngine.hits("ACGT")}]),
+                fasta_index.fasta_order,
+                connection,
+                seq_hashes={"OTU_2": 42},
+            )
+            assert connection.execute("SELECT * FROM id_engine_completed").fetchall() == [("OTU_2", 1, 3, 1, 42)]
+
+        assert id_engine.already_downloaded(fasta_index, database_path, 1, 3) == ["OTU_1", "OTU_3"]
+
+    def test_projects_without_completion_table_are_indexed(self, tmp_path):
+        fasta_path = write_fasta(tmp_path.joinpath("test.fasta"), make_records(3))
+        fasta_index, _, _ = id_engine.parse_fasta(fasta_path)
+        database_path = tmp_path.joinpath("boldigger3_data", "test.duckdb")
+
+        # hit table as written by earlier versions
+        with duckdb.connect(database_path) as connection:
+            connection.execute(
+                f"CREATE TABLE id_engine_results ({id_engine.ID_ENGINE_RESULTS_SCHEMA})"
+            )
+            connection.execute(
+                """
+                INSERT INTO id_engine_results (id, pct_identity, database, operating_mode, fasta_order)
+                VALUES ('OTU_3', 99.0, 1, 3, 2), ('OTU_3', 98.0, 1, 3, 2), ('OTU_1', 97.0, 1, 3, 0)
+                """
+            )
+
+        assert id_engine.already_downloaded(fasta_index, database_path, 1, 3) == ["OTU_2"]
+
+
+    def test_completion_tables_without_combinations_are_rebuilt(self, tmp_path):
+        fasta_path = write_fasta(tmp_path.joinpath("test.fasta"), make_records(3))
+        fasta_index, _, _ = id_engine.parse_fasta(fasta_path)
+        database_path = tmp_path.joinpath("boldigger3_data", "test.duckdb")
+
+        # completion table keyed by id only
+        with duckdb.connect(database_path) as connection:
+            connection.execute(
+                f"CREATE TABLE id_engine_results ({id_engine.ID_ENGINE_RESULTS_SCHEMA})"
+            )
+            connection.execute(
+                """
+                INSERT INTO id_engine_results (id, pct_identity, database, operating_mode, fasta_order)
+                VALUES ('OTU_1', 99.0, 1, 3, 0), ('OTU_2', 98.0, 2, 3, 1)
+                """
+            )
+            connection.execute(
+                "CREATE TABLE id_engine_completed (id VARCHAR PRIMARY KEY, fasta_order BIGINT)"
+            )
+            connection.execute("INSERT INTO id_engine_completed VALUES ('OTU_1', 0), ('OTU_2', 1)")
+
+        assert id_engine.already_downloaded(fasta_index, database_path, 1, 3) == ["OTU_2", "OTU_3"]
+        assert id_engine.already_downloaded(fasta_index, database_path, 2, 3) == ["OTU_1", "OTU_3"]
+
+    def test_changed_and_removed_sequences_are_downloaded_again(self, tmp_path):
+        fasta_path = write_fasta(tmp_path.joinpath("test.fasta"), make_records(3))
+        fasta_index, _, _ = id_engine.parse_fasta(fasta_path)
+        database_path = tmp_path.joinpath("boldigger3_data", "test.duckdb")
+        bold_request = id_engine.BoldIdRequest()
+        bold_request.database, bold_request.operating_mode = 1, 3
+
+        with duckdb.connect(database_path) as connection:
+            id_engine.create_results_table(connection)
+            id_engine.parse_and_save_data(
+                bold_request,
+                FakeResponse(
+                    [
+                        {"seqid": seq_id, "results": FakeIdEngine.hits("ACGT")}
+                        for seq_id in fasta_index.keys()
+                    ]
+                ),
+                fasta_index.fasta_order,
+                connection,
+                seq_hashes=dict(
+                    zip(fasta_index.keys(), fasta_index.seq_hashes(list(fasta_index.keys())))
+                ),
+            )
+
+        # OTU_1 is removed, OTU_2 is changed and OTU_3 moves to the front behind a new sequence
+        records = make_records(3)
+        write_fasta(
+            fasta_path,
+            {"OTU_4": "GGGGGGGG", "OTU_3": records["OTU_3"], "OTU_2": records["OTU_2"] + "A"},
+        )
+        fasta_index, _, _ = id_engine.parse_fasta(fasta_path)
+
+        assert id_engine.sync_completed(fasta_index, database_path) == 2
+        assert id_engine.sync_completed(fasta_index, database_path) == 0
+        assert id_engine.already_downloaded(fasta_index, database_path, 1, 3) == ["OTU_4", "OTU_2"]
+        with duckdb.connect(database_path) as connection:
+            assert connection.execute(
+                "SELECT DISTINCT id, fasta_order FROM id_engine_results"
+            ).fetchall() == [("OTU_3", 1)]
+
+
+# ---------------------------------------------------------------------------
+# build_session
+# ---------------------------------------------------------------------------
+
+class TestBuildSession:
+    def test_connection_pool_is_shared(self, id_engine_server):
+        with id_engine.build_session(pool_size=4) as session:
+            adapter = session.get_adapter(id_engine.ID_ENGINE_URL)
+            assert adapter is session.get_adapter("https://id.boldsystems.org")
+            assert adapter._pool_maxsize == 4
+
+            for _ in range(3):
+                session.get(f"{id_engine.ID_ENGINE_URL}/submission/results/missing")
+
+            # all requests went through a single kept-alive connection
+            pools = [adapter.poolmanager.pools[key] for key in adapter.poolmanager.pools.keys()]
+            assert [pool.num_connections for pool in pools] == [1]
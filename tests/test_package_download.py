@@ -0,0 +1,136 @@
+import io
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+from boldigger3.exceptions import PackageDownloadError
+from boldigger3.package_download import PackageDownload
+
+
+def make_package(rows: int = 20000) -> bytes:
+    """Parquet file of a few hundred kilobytes that does not compress away."""
+    rng = np.random.default_rng(0)
+    package = io.BytesIO()
+    pd.DataFrame(
+        {
+            "processid": [f"PROC{i}" for i in range(rows)],
+            "value": rng.random(rows),
+        }
+    ).to_parquet(package)
+
+    return package.getvalue()
+
+
+def download(package_server, tmp_path, **kwargs) -> PackageDownload:
+    package_download = PackageDownload(
+        requests.Session(),
+        tmp_path.joinpath("BOLD_Public.parquet"),
+        chunk_size=4096,
+        retry_delay=0,
+        **kwargs,
+    )
+    session = package_download.session
+    package_download.run(
+        lambda: "{}/package?uid={}".format(
+            package_server.url,
+            session.get(f"{package_server.url}/package").text.strip('"'),
+        )
+    )
+
+    return package_download
+
+
+# ---------------------------------------------------------------------------
+# PackageDownload
+# ---------------------------------------------------------------------------
+
+class TestPackageDownload:
+    def test_package_is_downloaded_in_parallel_ranges(self, package_server, tmp_path):
+        package_server.package = make_package()
+        package_download = download(package_server, tmp_path, parts=4)
+
+        assert package_download.output_path.read_bytes() == package_server.package
+        # one probe and one request per part, every byte is sent once
+        assert len(package_server.requests) == 5
+        assert package_server.bytes_sent == len(package_server.package) + 1
+        assert [path.name for path in tmp_path.iterdir()] == ["BOLD_Public.parquet"]
+
+    def test_servers_without_ranges_use_a_single_connection(
+        self, package_server, tmp_path
+    ):
+        package_server.package = make_package()
+        package_server.ranges = False
+        package_download = download(package_server, tmp_path, parts=4)
+
+        assert package_download.output_path.read_bytes() == package_server.package
+        assert len(package_server.requests) == 2
+
+    def test_lost_connections_are_resumed(self, package_server, tmp_path):
+        package_server.package = make_package()
+        package_server.dropped_responses = 2
+        package_server.drop_after = 10000
+        package_download = download(package_server, tmp_path, parts=2)
+
+        assert package_download.output_path.read_bytes() == package_server.package
+        # the retries only ask for the missing bytes
+        assert package_server.bytes_sent == len(package_server.package) + 1
+
+    def test_used_uids_are_replaced(self, package_server, tmp_path):
+        package_server.package = make_package()
+        package_server.one_time_uids = True
+        package_server.dropped_responses = 2
+        package_server.drop_after = 10000
+        package_download = download(package_server, tmp_path, parts=4)
+
+        assert package_download.output_path.read_bytes() == package_server.package
+        # every request after the probe needs a fresh uid, no byte is sent twice
+        assert package_server.refused == len(package_server.requests) - 1
+        assert package_server.bytes_sent == len(package_server.package) + 1
+
+    def test_refused_ranges_use_a_single_connection(self, package_server, tmp_path):
+        package_server.package = make_package()
+        package_server.one_time_uids = True
+        package_server.refused_ranges = True
+        package_download = download(package_server, tmp_path, parts=4)
+
+        assert package_download.output_path.read_bytes() == package_server.package
+        assert [range_header for range_header, _ in package_server.requests] == [
+            "bytes=0-0",
+            None,
+        ]
+
+    def test_interrupted_download_continues_in_the_next_run(
+        self, package_server, tmp_path
+    ):
+        package_server.package = make_package()
+        package_server.dropped_responses = 4
+        package_server.drop_after = 10000
+
+        with pytest.raises(PackageDownloadError):
+            download(package_server, tmp_path, parts=4, retries=0)
+        assert len(list(tmp_path.glob("BOLD_Public.parquet.part*"))) == 5
+
+        package_server.requests = []
+        package_download = download(package_server, tmp_path, parts=4, retries=0)
+
+        assert package_download.output_path.read_bytes() == package_server.package
+        assert package_server.bytes_sent == len(package_server.package) + 1 - 4 * 10000
+
+    def test_changed_package_is_downloaded_again(self, package_server, tmp_path):
+        package_server.package = make_package()
+        package_server.dropped_responses = 4
+        package_server.drop_after = 10000
+        with pytest.raises(PackageDownloadError):
+            download(package_server, tmp_path, parts=4, retries=0)
+
+        package_server.package = make_package(rows=30000)
+        package_download = download(package_server, tmp_path, parts=4)
+
+        assert package_download.output_path.read_bytes() == package_server.package
+
+    def test_corrupted_package_is_removed(self, package_server, tmp_path):
+        package_server.package = make_package()[:-100] + bytes(100)
+
+        with pytest.raises(PackageDownloadError):
+            download(package_server, tmp_path, parts=4)
+        assert list(tmp_path.iterdir()) == []
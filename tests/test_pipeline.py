@@ -0,0 +1,159 @@
+import asyncio
+import duckdb
+import pandas as pd
+from boldigger3 import id_engine, select_top_hit
+from boldigger3.download_journal import DownloadJournal
+from boldigger3.batch_planner import BatchPlanner
+from boldigger3.pipeline import ResultPipeline
+from boldigger3.rate_control import RateController
+
+THRESHOLDS = [97, 95, 90, 85, 75, 50]
+
+METADATA_COLUMNS = [
+    "processid",
+    "sex",
+    "life_stage",
+    "inst",
+    '"country/ocean"',
+    "identified_by",
+    "identification_method",
+    "coord",
+    "nuc",
+    "marker_code",
+]
+
+
+class NoProgress:
+    def update(self, n=1):
+        pass
+
+
+def make_metadata(tmp_path):
+    db_path = tmp_path.joinpath("bold.duckdb")
+    with duckdb.connect(db_path) as connection:
+        connection.execute(
+            "CREATE TABLE bold_public ({})".format(
+                ", ".join(f"{column} VARCHAR" for column in METADATA_COLUMNS)
+            )
+        )
+
+    return db_path
+
+
+def download_with_pipeline(result_pipeline, combinations):
+    """Download all sequences of the project with a pipeline attached to the writer."""
+    fasta_index, _, _ = id_engine.parse_fasta(result_pipeline.fasta_path)
+    batch_planner = BatchPlanner()
+    download_queue = id_engine.build_missing_queue(
+        fasta_index,
+        {combination: list(fasta_index.keys()) for combination in combinations},
+        batch_planner,
+    )
+    requests = len(download_queue["waiting"])
+
+    with id_engine.build_session() as session, DownloadJournal(
+        result_pipeline.data_dir.joinpath("test.duckdb")
+    ) as journal:
+        journal.replace(download_queue)
+        scheduler = id_engine.DownloadScheduler(
+            download_queue,
+            journal,
+            fasta_index,
+            session,
+            RateController(rate=6000, max_rate=6000),
+            NoProgress(),
+            batch_planner,
+            polling_interval=0,
+            pipeline=result_pipeline,
+        )
+        asyncio.run(scheduler.run())
+
+    return requests
+
+
+def read_output(result_pipeline, output_name):
+    return pd.read_parquet(
+        result_pipeline.data_dir.joinpath(
+            f"{output_name}_identification_result.parquet.snappy"
+        )
+    )
+
+
+# ---------------------------------------------------------------------------
+# ResultPipeline
+# ---------------------------------------------------------------------------
+
+class TestResultPipeline:
+    def make_pipeline(self, tmp_path, combinations):
+        fasta_path = tmp_path.joinpath("test.fasta")
+        fasta_path.write_text(
+            "".join(f">OTU_{i}\n{'ACGT' * (i % 7 + 5)}\n" for i in range(25))
+        )
+        result_pipeline = ResultPipeline(
+            fasta_path,
+            make_metadata(tmp_path),
+            THRESHOLDS,
+            [database for database, _ in combinations],
+            3,
+        )
+        result_pipeline.reset()
+
+        return result_pipeline
+
+    def test_requests_are_processed_during_the_download(
+        self, tmp_path, id_engine_server
+    ):
+        combinations = [(1, 3), (2, 3)]
+        result_pipeline = self.make_pipeline(tmp_path, combinations)
+        requests = download_with_pipeline(result_pipeline, combinations)
+
+        # every request has been joined and selected before the download finished
+        assert len(result_pipeline.buffer_paths()) == requests
+        with duckdb.connect(result_pipeline.data_dir.joinpath("test.duckdb")) as connection:
+            assert connection.execute(
+                "SELECT count(*) FROM final_results WHERE status = 'private'"
+            ).fetchone() == connection.execute(
+                "SELECT count(*) FROM id_engine_results"
+            ).fetchone()
+
+        result_pipeline.finish()
+        assert result_pipeline.buffer_paths() == []
+        pipelined = [
+            read_output(result_pipeline, f"test_db{database}_mode3")
+            for database in (1, 2)
+        ]
+
+        # the same top hits as selecting them after the download
+        for state_path in result_pipeline.data_dir.glob("*_top_hits.parquet.snappy"):
+            state_path.unlink()
+        select_top_hit.main(
+            result_pipeline.fasta_path, THRESHOLDS, combinations=combinations
+        )
+        for database, top_hits in zip((1, 2), pipelined):
+            expected = read_output(result_pipeline, f"test_db{database}_mode3")
+            assert len(top_hits) == 25
+            pd.testing.assert_frame_equal(top_hits, expected)
+
+    def test_left_over_requests_are_processed_at_the_end(
+        self, tmp_path, id_engine_server
+    ):
+        result_pipeline = self.make_pipeline(tmp_path, [(1, 3)])
+        download_with_pipeline(result_pipeline, [(1, 3)])
+
+        # an interruption after saving the first request, before it has been processed
+        first_buffer = sorted(result_pipeline.buffer_paths())[0]
+        first_ids = pd.read_parquet(first_buffer)["id"].tolist()
+        first_buffer.unlink()
+        with duckdb.connect(result_pipeline.data_dir.joinpath("test.duckdb")) as connection:
+            connection.execute(
+                "DELETE FROM hit_metadata WHERE process_id IN (SELECT process_id FROM id_engine_results WHERE id IN (SELECT unnest(?)))",
+                [first_ids],
+            )
+
+        result_pipeline.finish()
+        top_hits = read_output(result_pipeline, "test")
+        result_pipeline.data_dir.joinpath("test_top_hits.parquet.snappy").unlink()
+
+        select_top_hit.main(result_pipeline.fasta_path, THRESHOLDS, combinations=[(1, 3)])
+        pd.testing.assert_frame_equal(top_hits, read_output(result_pipeline, "test"))
+        assert len(top_hits) == 25
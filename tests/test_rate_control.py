@@ -0,0 +1,66 @@
+import pytest
+from boldigger3.rate_control import RateController
+
+
+class TestRateController:
+    def test_limit_reached_halves_rate_and_window(self):
+        controller = RateController(rate=4.0, window=10.0)
+        controller.on_limit_reached()
+        assert controller.rate == 2.0
+        assert controller.active_window == 5
+        assert controller.interval == 30.0
+
+    def test_fast_completions_increase_additively(self):
+        controller = RateController(rate=2.0, window=4.0, rate_increase=0.5)
+        for _ in range(4):
+            controller.on_completed(60.0)
+        assert controller.rate == 4.0
+        assert controller.active_window == 4
+        controller.on_completed(60.0)
+        assert controller.active_window == 5
+
+    def test_server_goes_faster_than_one_batch_per_30_seconds_when_idle(self):
+        controller = RateController()
+        for _ in range(20):
+            controller.on_completed(60.0)
+        assert controller.interval < 30.0
+
+    def test_slow_completion_backs_off_smoothly(self):
+        controller = RateController(rate=8.0, window=8.0)
+        controller.on_completed(60.0)
+        rate, window = controller.rate, controller.window
+        controller.on_completed(600.0)
+        assert rate * 0.5 < controller.rate < rate
+        assert window * 0.5 < controller.window < window
+
+    def test_bounds_are_respected(self):
+        controller = RateController(min_rate=1.0, min_window=2.0, max_rate=3.0, max_window=3.0)
+        for _ in range(10):
+            controller.on_limit_reached()
+        assert controller.rate == 1.0
+        assert controller.active_window == 2
+        for _ in range(100):
+            controller.on_completed(10.0)
+        assert controller.rate == 3.0
+        assert controller.active_window == 3
+
+    def test_state_is_persisted_between_runs(self, tmp_path):
+        state_path = tmp_path.joinpath("state", "rate_control.json")
+        controller = RateController.load(state_path)
+        assert controller.rate == 2.0
+
+        controller.on_completed(42.0)
+        controller.on_limit_reached()
+        controller.save()
+
+        restored = RateController.load(state_path)
+        assert restored.rate == pytest.approx(controller.rate)
+        assert restored.window == pytest.approx(controller.window)
+        assert restored.baseline_latency == 42.0
+
+    def test_broken_state_falls_back_to_defaults(self, tmp_path):
+        state_path = tmp_path.joinpath("rate_control.json")
+        state_path.write_text("not json")
+        controller = RateController.load(state_path)
+        assert controller.rate == 2.0
+        assert controller.active_window == 10
@@ -1,9 +1,26 @@
 import pytest
+import duckdb
 import pandas as pd
 import numpy as np
-from boldigger3.select_top_hit import get_threshold, move_threshold_up, flag_hits, find_top_hit
+import shutil
+from pathlib import Path
+from boldigger3.select_top_hit import (
+    get_threshold,
+    move_threshold_up,
+    flag_hits,
+    find_top_hit,
+    clean_dataframe,
+    select_top_hits_duckdb,
+    iter_hit_groups,
+    gather_top_hits_parallel,
+    save_results,
+    fan_out_duplicates,
+    main as select_top_hit_main,
+)
+from boldigger3.fasta_index import FastaIndex
 
 THRESHOLDS = [97, 95, 90, 85, 75, 50]
+DATA_DIR = Path(__file__).parent.joinpath("boldigger3_data")
 
 
 def make_hits(rows: list[dict]) -> pd.DataFrame:
@@ -285,3 +302,340 @@ class TestFindTopHit:
         assert pd.isna(result["selected_level"].item())
         assert pd.isna(result["phylum"].item())
         assert result["records"].item() == 0
+
+
+# ---------------------------------------------------------------------------
+# select_top_hits_duckdb
+# ---------------------------------------------------------------------------
+
+def run_duckdb_engine(hits: pd.DataFrame) -> pd.DataFrame:
+    """Load hits into an in-memory final_results table and run the duckdb engine."""
+    with duckdb.connect() as connection:
+        connection.execute("CREATE TABLE final_results AS SELECT * FROM hits")
+        return select_top_hits_duckdb(connection, THRESHOLDS)
+
+
+def assert_same_top_hit(result: pd.DataFrame, expected: pd.DataFrame) -> None:
+    pd.testing.assert_frame_equal(
+        result.reset_index(drop=True),
+        expected.reset_index(drop=True).reindex(columns=result.columns),
+        check_dtype=False,
+    )
+
+
+class TestSelectTopHitsDuckdb:
+    @pytest.mark.parametrize(
+        "rows",
+        [
+            [
+                {"species": "Drosophila melanogaster", "pct_identity": 99.0},
+                {"species": "Drosophila melanogaster", "pct_identity": 98.5},
+                {"species": "Drosophila simulans", "pct_identity": 98.9},
+            ],
+            [
+                {"species": pd.NA, "genus": "Drosophila", "pct_identity": 99.0},
+                {"species": pd.NA, "genus": "Drosophila", "pct_identity": 98.5},
+            ],
+            [
+                {"species": pd.NA, "pct_identity": 99.0},
+                {"species": pd.NA, "pct_identity": 98.0},
+                {"genus": "Scaptomyza", "species": "Scaptomyza pallida", "pct_identity": 97.5},
+            ],
+            [
+                {"species": "Drosophila melanogaster", "pct_identity": 96.0, "status": "private"},
+                {"species": "Drosophila melanogaster", "pct_identity": 95.5, "status": "private"},
+            ],
+            [
+                {"pct_identity": 99.0, "bin_uri": "BOLD:AAA0001"},
+                {"pct_identity": 98.5, "bin_uri": "BOLD:AAA0002", "identification_method": "BOLD ID Engine"},
+                {"pct_identity": 80.0, "bin_uri": "BOLD:AAA0003"},
+            ],
+            [{"pct_identity": 97.0, "identification_method": "BIN Taxonomy Match"}],
+            [{"pct_identity": 30.0}],
+            [
+                {"pct_identity": 60.0, "phylum": pd.NA},
+                {"pct_identity": 55.0, "phylum": pd.NA},
+            ],
+            [{
+                "pct_identity": 0.0, "status": "private",
+                "phylum": "no-match", "class": "no-match", "order": "no-match",
+                "family": "no-match", "genus": "no-match", "species": "no-match",
+            }],
+        ],
+    )
+    def test_matches_find_top_hit(self, rows):
+        hits = make_hits(rows)
+        expected = find_top_hit(hits, THRESHOLDS)
+        assert_same_top_hit(run_duckdb_engine(hits), expected)
+
+    def test_invalid_taxon_names_are_cleaned(self):
+        # names with digits or punctuation are treated as missing, like clean_dataframe does
+        hits = make_hits([
+            {"species": "Drosophila sp. 1", "pct_identity": 99.0},
+            {"species": "Drosophila sp. 1", "pct_identity": 98.0},
+        ])
+        result = run_duckdb_engine(hits)
+        assert result["selected_level"].item() == "genus"
+        assert pd.isna(result["species"].item())
+
+    def test_one_result_per_id_in_fasta_order(self):
+        hits = make_hits([
+            {"id": "seq2", "fasta_order": 1, "pct_identity": 99.0},
+            {"id": "seq1", "fasta_order": 0, "pct_identity": 92.0},
+            {"id": "seq2", "fasta_order": 1, "pct_identity": 98.0},
+        ])
+        result = run_duckdb_engine(hits)
+        assert result["id"].tolist() == ["seq1", "seq2"]
+        assert result["selected_level"].tolist() == ["family", "species"]
+
+    def test_matches_pandas_engine_on_project_database(self):
+        with duckdb.connect(DATA_DIR.joinpath("test_10.duckdb"), read_only=True) as connection:
+            result = select_top_hits_duckdb(connection, THRESHOLDS)
+            ids = connection.execute(
+                "SELECT DISTINCT id, fasta_order FROM final_results ORDER BY fasta_order"
+            ).fetchall()
+            expected = pd.concat(
+                [
+                    find_top_hit(
+                        clean_dataframe(
+                            connection.execute(
+                                "SELECT * FROM final_results WHERE id = ? ORDER BY pct_identity DESC, rowid ASC",
+                                [seq_id],
+                            ).df()
+                        ),
+                        THRESHOLDS,
+                    )
+                    for seq_id, _ in ids
+                ]
+            )
+        assert_same_top_hit(result, expected)
+
+
+# ---------------------------------------------------------------------------
+# clean_dataframe
+# ---------------------------------------------------------------------------
+
+class TestCleanDataframe:
+    def test_malformed_coordinates_only_affect_their_row(self):
+        hits = make_hits(
+            [
+                {"fasta_order": 0, "coord": "[50.5, 7.25]"},
+                {"fasta_order": 1, "coord": "not a coordinate"},
+                {"fasta_order": 2, "coord": None},
+                {"fasta_order": 3, "coord": "[-12.0,130.5]"},
+            ]
+        )
+        cleaned = clean_dataframe(hits)
+
+        assert "coord" not in cleaned.columns
+        assert cleaned["lat"].tolist()[::3] == [50.5, -12.0]
+        assert cleaned["lon"].tolist()[::3] == [7.25, 130.5]
+        assert cleaned[["lat", "lon"]].iloc[1:3].isna().all().all()
+
+
+# ---------------------------------------------------------------------------
+# iter_hit_groups
+# ---------------------------------------------------------------------------
+
+class TestIterHitGroups:
+    @pytest.mark.parametrize("batch_size", [7, 99, 100_000])
+    def test_groups_match_per_id_queries(self, batch_size):
+        with duckdb.connect(DATA_DIR.joinpath("test_10.duckdb"), read_only=True) as connection:
+            groups = list(iter_hit_groups(connection, batch_size=batch_size))
+            ids = connection.execute(
+                "SELECT DISTINCT id, fasta_order FROM final_results ORDER BY fasta_order"
+            ).fetchall()
+            assert [group["id"].unique().tolist() for group in groups] == [[seq_id] for seq_id, _ in ids]
+
+            for group, (seq_id, _) in zip(groups, ids):
+                expected = clean_dataframe(
+                    connection.execute(
+                        "SELECT * FROM final_results WHERE id = ? ORDER BY pct_identity DESC, rowid ASC",
+                        [seq_id],
+                    ).df()
+                )
+                assert_same_top_hit(
+                    find_top_hit(group, THRESHOLDS), find_top_hit(expected, THRESHOLDS)
+                )
+
+
+# ---------------------------------------------------------------------------
+# gather_top_hits_parallel
+# ---------------------------------------------------------------------------
+
+class TestGatherTopHitsParallel:
+    @pytest.mark.parametrize("workers", [2, 4])
+    def test_shards_concatenate_in_fasta_order(self, tmp_path, workers):
+        tmp_path.joinpath("boldigger3_data").mkdir()
+        database_path = tmp_path.joinpath("boldigger3_data", "test_10.duckdb")
+        shutil.copy(DATA_DIR.joinpath("test_10.duckdb"), database_path)
+
+        with duckdb.connect(database_path, read_only=True) as connection:
+            fasta_dict = dict(
+                connection.execute(
+                    "SELECT DISTINCT id, fasta_order FROM final_results ORDER BY fasta_order"
+                ).fetchall()
+            )
+
+        gather_top_hits_parallel(
+            fasta_dict, database_path, tmp_path, "test_10", THRESHOLDS, workers
+        )
+        save_results(tmp_path, "test_10")
+
+        result = pd.read_parquet(
+            tmp_path.joinpath("boldigger3_data", "test_10_identification_result.parquet.snappy")
+        )
+        expected = pd.read_parquet(
+            DATA_DIR.joinpath("test_10_identification_result.parquet.snappy")
+        )
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+# ---------------------------------------------------------------------------
+# fan_out_duplicates
+# ---------------------------------------------------------------------------
+
+class TestFanOutDuplicates:
+    def test_duplicates_receive_the_top_hit_of_their_representative(self, tmp_path):
+        fasta_path = tmp_path.joinpath("test.fasta")
+        fasta_path.write_text(">seq1\nACGT\n>seq2\nTTTT\n>seq3\nACGT\n>seq4\nTTTT\n")
+        fasta_index = FastaIndex.open(fasta_path, tmp_path)
+
+        top_hits = pd.DataFrame(
+            {
+                "id": ["seq1", "seq2"],
+                "species": ["Culex pipiens", "Aedes vexans"],
+                "fasta_order": [0, 1],
+            }
+        )
+        result = fan_out_duplicates(top_hits, fasta_index)
+
+        assert result.columns.tolist() == ["id", "species", "fasta_order"]
+        assert result.values.tolist() == [
+            ["seq1", "Culex pipiens", 0],
+            ["seq2", "Aedes vexans", 1],
+            ["seq3", "Culex pipiens", 2],
+            ["seq4", "Aedes vexans", 3],
+        ]
+
+    def test_unique_sequences_are_unchanged(self, tmp_path):
+        fasta_path = tmp_path.joinpath("test.fasta")
+        fasta_path.write_text(">seq1\nACGT\n>seq2\nTTTT\n")
+        fasta_index = FastaIndex.open(fasta_path, tmp_path)
+
+        top_hits = pd.DataFrame({"id": ["seq1", "seq2"], "fasta_order": [0, 1]})
+        assert fan_out_duplicates(top_hits, fasta_index) is top_hits
+
+
+# ---------------------------------------------------------------------------
+# several databases and operating modes
+# ---------------------------------------------------------------------------
+
+class TestCombinations:
+    @pytest.mark.parametrize("engine", ["pandas", "duckdb"])
+    def test_top_hits_are_selected_per_combination(self, tmp_path, engine):
+        fasta_path = tmp_path.joinpath("test_10.fasta")
+        shutil.copy(Path(__file__).parent.joinpath("test_10.fasta"), fasta_path)
+        tmp_path.joinpath("boldigger3_data").mkdir()
+        database_path = tmp_path.joinpath("boldigger3_data", "test_10.duckdb")
+        shutil.copy(DATA_DIR.joinpath("test_10.duckdb"), database_path)
+
+        # the same hits identified with a second database, only the species differ
+        with duckdb.connect(database_path) as connection:
+            connection.execute(
+                """
+                INSERT INTO final_results
+                SELECT * REPLACE (
+                    1 AS database,
+                    CASE WHEN species = 'no-match' THEN species ELSE 'Culex pipiens' END AS species
+                )
+                FROM final_results ORDER BY rowid
+                """
+            )
+
+        select_top_hit_main(fasta_path, THRESHOLDS, engine=engine)
+
+        expected = pd.read_parquet(
+            DATA_DIR.joinpath("test_10_identification_result.parquet.snappy")
+        )
+        results = {
+            database: pd.read_parquet(
+                tmp_path.joinpath(
+                    "boldigger3_data",
+                    f"test_10_db{database}_mode3_identification_result.parquet.snappy",
+                )
+            )
+            for database in (1, 3)
+        }
+
+        pd.testing.assert_frame_equal(results[3], expected, check_dtype=False)
+        assert results[1]["id"].tolist() == expected["id"].tolist()
+        assert set(results[1]["species"].dropna()) <= {"Culex pipiens", "no-match"}
+        assert not tmp_path.joinpath(
+            "boldigger3_data", "test_10_identification_result.parquet.snappy"
+        ).exists()
+
+
+# ---------------------------------------------------------------------------
+# incremental runs
+# ---------------------------------------------------------------------------
+
+class TestIncrementalRuns:
+    def make_project(self, tmp_path):
+        fasta_path = tmp_path.joinpath("test_10.fasta")
+        shutil.copy(Path(__file__).parent.joinpath("test_10.fasta"), fasta_path)
+        tmp_path.joinpath("boldigger3_data").mkdir()
+        database_path = tmp_path.joinpath("boldigger3_data", "test_10.duckdb")
+        shutil.copy(DATA_DIR.joinpath("test_10.duckdb"), database_path)
+
+        return fasta_path, database_path
+
+    @pytest.mark.parametrize(
+        "engine, workers", [("pandas", 1), ("duckdb", 1), ("pandas", 2)]
+    )
+    def test_only_new_top_hits_are_selected(self, tmp_path, engine, workers):
+        fasta_path, database_path = self.make_project(tmp_path)
+        select_top_hit_main(fasta_path, THRESHOLDS)
+        output_path = tmp_path.joinpath(
+            "boldigger3_data", "test_10_identification_result.parquet.snappy"
+        )
+        expected = pd.read_parquet(output_path)
+
+        # the last id is new, the changed hits of all other ids are not read again
+        state_path = tmp_path.joinpath("boldigger3_data", "test_10_top_hits.parquet.snappy")
+        top_hits = pd.read_parquet(state_path)
+        new_id = top_hits["id"].iloc[-1]
+        top_hits.iloc[:-1].to_parquet(state_path)
+        with duckdb.connect(database_path) as connection:
+            connection.execute(
+                """
+                UPDATE final_results SET species = 'Culex pipiens'
+                WHERE id <> ? AND species <> 'no-match'
+                """,
+                [new_id],
+            )
+
+        select_top_hit_main(fasta_path, THRESHOLDS, engine=engine, workers=workers)
+        pd.testing.assert_frame_equal(pd.read_parquet(output_path), expected)
+
+        # top hits of other thresholds are not reused, all hits are selected again
+        select_top_hit_main(
+            fasta_path, [99, 95, 90, 85, 75, 50], engine=engine, workers=workers
+        )
+        results = pd.read_parquet(output_path)
+        assert results["id"].tolist() == expected["id"].tolist()
+        assert "Culex pipiens" in set(results["species"])
+
+    def test_unchanged_hit_exports_are_not_rewritten(self, tmp_path):
+        fasta_path, _ = self.make_project(tmp_path)
+        select_top_hit_main(fasta_path, THRESHOLDS)
+        part_path = tmp_path.joinpath("boldigger3_data", "test_10_bold_results_part_1.xlsx")
+        modified = part_path.stat().st_mtime_ns
+
+        select_top_hit_main(fasta_path, THRESHOLDS)
+        assert part_path.stat().st_mtime_ns == modified
+
+        # a changed sequence changes the hits of its part
+        fasta_path.write_text(fasta_path.read_text().replace("A", "C", 1))
+        select_top_hit_main(fasta_path, THRESHOLDS)
+        assert part_path.stat().st_mtime_ns != modified